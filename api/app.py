@@ -0,0 +1,90 @@
+# api/app.py  # noqa: INP001
+
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+
+import api.routers.routers as routers
+from util.admission_util import AdmissionRejected, admission_retry_after
+from util.compression_util import CompressionMiddleware
+from util.cpu_util import configure_cpu
+from util.response_util import FastJSONResponse
+from util.result_util import TableQueryError
+from util.util import InvalidRequestError
+from util.warmup_util import start_warmup
+
+templates = Jinja2Templates(directory="templates")
+
+# ==================================================================================================
+# アプリの構成
+# ==================================================================================================
+
+
+def create_app() -> FastAPI:
+    """ルーター・ミドルウェア・例外ハンドラーを登録したアプリを作成する
+
+    NOTE: main.pyとベンチマーク（benchmark/bench_endpoints.py）で同じ構成のアプリを使うため、
+          RedisのDockerコンテナの起動やモデルの読み込みなど、プロセス全体に関わる処理はここでは行わない
+
+    Returns:
+        FastAPI: アプリ
+    """
+    app = FastAPI(default_response_class=FastJSONResponse)  # レスポンスのJSONはorjsonで高速にシリアライズする
+    app.include_router(routers.text_router)
+    app.include_router(routers.object_detection_router)
+    app.include_router(routers.admin_router)
+    app.include_router(routers.health_router)
+    app.include_router(routers.notify_router)
+    app.include_router(routers.report_router)
+    # レスポンスの圧縮と、圧縮されたリクエストボディの展開
+    app.add_middleware(CompressionMiddleware)
+    app.mount(path="/static", app=StaticFiles(directory="static"), name="static")
+    app.add_api_route("/", top_page, response_class=HTMLResponse)
+    app.router.add_event_handler("startup", warmup)
+    app.add_exception_handler(AdmissionRejected, admission_rejected)
+    app.add_exception_handler(TableQueryError, table_query_error)
+    app.add_exception_handler(InvalidRequestError, invalid_request_error)
+    return app
+
+
+async def warmup():
+    """ワーカーの起動時にモデルのウォームアップを開始する（完了するまで/health/readyは503を返す）"""
+    # gunicornのワーカーはpost_forkで設定済み（WORKER_INDEXが設定される）のため、uvicorn単体の場合だけ設定する
+    if "WORKER_INDEX" not in os.environ:
+        configure_cpu()
+    start_warmup()
+
+
+async def admission_rejected(_request: Request, exc: AdmissionRejected):
+    """実行枠を待てなかったリクエストにステータスコード503を返す（クライアントはRetry-After秒後に再送する）"""
+    return FastJSONResponse(
+        status_code=503,
+        content={"message": "サーバーが混雑しています", "priority": exc.priority, "reason": exc.reason},
+        headers={"Retry-After": str(admission_retry_after)},
+    )
+
+
+async def table_query_error(_request: Request, exc: TableQueryError):
+    """表の取得条件（範囲・列・絞り込み）が正しくないリクエストにステータスコード400を返す"""
+    return FastJSONResponse(status_code=400, content={"message": str(exc)})
+
+
+async def invalid_request_error(_request: Request, exc: InvalidRequestError):
+    """リクエストボディの値（数値・範囲など）が正しくないリクエストにステータスコード400を返す"""
+    return FastJSONResponse(status_code=400, content={"message": str(exc)})
+
+
+async def top_page(request: Request):
+    """トップページを開く
+
+    Args:
+        request (Request): リクエスト
+
+    Returns:
+        _type_: テンプレートレスポンスを返す
+    """
+
+    return templates.TemplateResponse("top.html", {"request": request, "title": "YOLO REST Server"})
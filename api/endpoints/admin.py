@@ -0,0 +1,73 @@
+import os
+
+from util.admission_util import admission_report
+from util.cpu_util import cpu_report
+from util.metrics_util import metrics_snapshot, reset_metrics
+from util.redis_util import redis_memory_report
+from util.util import is_reload_enabled
+
+# ==================================================================================================
+# REDISメモリ使用状況取得処理
+# ==================================================================================================
+
+
+def get_redis_memory(json_data: dict) -> dict:
+    """REDISのメモリ使用状況とサイズの大きいキーの一覧を取得する
+
+    Args:
+        json_data (dict): {'topN': <一覧に含めるキーの数（省略時は20）>,
+                           'maxKeys': <調べるキーの数の上限（省略時はREDIS_MEMORY_REPORT_MAX_KEYS）>}
+
+    Returns:
+        dict: メモリ使用状況（JSON形式）
+    """
+    if is_reload_enabled():
+        print("[JSON for redis_memory]", json_data)
+
+    try:
+        top_n = max(int(json_data.get("topN", 20)), 0)
+        max_keys = json_data.get("maxKeys")
+        max_keys = None if max_keys is None else max(int(max_keys), 0)
+    except (TypeError, ValueError):
+        return {"message": "topNとmaxKeysは整数で指定してください"}
+    return redis_memory_report(top_n, max_keys)
+
+
+# ==================================================================================================
+# CPU設定取得処理
+# ==================================================================================================
+
+
+def get_cpu_settings() -> dict:
+    """このワーカーで有効になっている推論のスレッド数とCPUアフィニティを取得する
+
+    Returns:
+        dict: CPUの設定（JSON形式）
+    """
+    results = cpu_report(os.environ.get("WORKER_INDEX"))
+    results["message"] = None
+    return results
+
+
+# ==================================================================================================
+# メトリクス取得処理
+# ==================================================================================================
+
+
+def get_metrics(json_data: dict) -> dict:
+    """このワーカーで集計したメトリクス（カスケード検出で大きいモデルを使った件数、アドミッション制御の待ち時間など）を取得する
+
+    Args:
+        json_data (dict): {'reset': <Trueの場合、取得後に集計を消去する>}
+
+    Returns:
+        dict: メトリクス（JSON形式）
+    """
+    results = metrics_snapshot()
+    results["admission"] = admission_report()
+    results["pid"] = os.getpid()
+    results["workerIndex"] = os.environ.get("WORKER_INDEX")
+    if json_data.get("reset"):
+        reset_metrics()
+    results["message"] = None
+    return results
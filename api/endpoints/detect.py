@@ -3,13 +3,28 @@ import os
 import sys
 import time
 
-import aiofiles
+import cv2
+import numpy as np
 from dotenv import load_dotenv
-from ultralytics import SAM, YOLO
 
-from util.redis_util import redis_box_get, redis_image_get, redis_image_put
-from util.util import getNoteId, is_reload_enabled
-from util.yolo_util import yolo_detect_objects
+from util.cpu_util import engine_threads
+from util.image_util import encode_jpeg, preprocess_image
+from util.mask_util import encode_rle, mask_bbox, mask_polygons, render_overlay
+from util.model_util import get_sam_model, sam_lock
+from util.redis_util import (
+    make_key,
+    redis_box_get,
+    redis_box_put,
+    redis_bulk_get,
+    redis_image_get,
+    redis_image_put,
+    redis_mask_get,
+    redis_mask_image_get,
+    redis_mask_put,
+)
+from util.result_util import DetectionResult, SegmentationResult, SegmentMask, merge_page_results, unpack_result
+from util.util import getNoteId, is_reload_enabled, parse_flag
+from util.yolo_util import yolo_cascade, yolo_detect_image, yolo_detect_pdf
 
 load_dotenv()
 
@@ -23,13 +38,25 @@ if local_folder is None:
 yolo_model_file = os.environ.get("YOLO_MODEL_FILE")
 sam_model_file = os.environ.get("SAM_MODEL_FILE")
 
+# PDFの物体検出の設定（ページを画像にする解像度とリクエストで指定できる範囲、画像化を並列に行うプロセス数、
+# まとめて検出するページ数、サムネイルの長辺）
+pdf_detect_dpi = int(os.environ.get("PDF_DETECT_DPI", "100"))
+pdf_detect_min_dpi = int(os.environ.get("PDF_DETECT_MIN_DPI", "36"))
+pdf_detect_max_dpi = int(os.environ.get("PDF_DETECT_MAX_DPI", "300"))
+pdf_detect_workers = int(os.environ.get("PDF_DETECT_WORKERS", "2"))
+pdf_detect_batch_size = int(os.environ.get("PDF_DETECT_BATCH_SIZE", "4"))
+thumbnail_size = int(os.environ.get("DETECT_THUMBNAIL_SIZE", "640"))
+
+# セグメンテーションのマスクの輪郭を多角形に単純化するときの許容誤差（ピクセル）
+sam_polygon_tolerance = float(os.environ.get("SAM_POLYGON_TOLERANCE", "2.0"))
+
 # ==================================================================================================
 # 物体検出処理
 # ==================================================================================================
 
 
 def detect_objects(json_data: dict):
-    """eYACHO/GEMBA Noteから送信されてきた画像情報をファイルに保存し、YOLOの物体検出を実行する
+    """eYACHO/GEMBA Noteから送信されてきた画像を前処理し、YOLOの物体検出を実行する
 
     Args:
         json_data (dict): クライアント（eYACHO/GEMBA Note）からの画像情報
@@ -40,53 +67,46 @@ def detect_objects(json_data: dict):
     results = {}
     results["message"] = "不明なエラーが発生しました"
 
+    # PDFが送信された場合は、全ページを物体検出する
+    if "inputPDF" in json_data:
+        return detect_pdf_objects(json_data)
+
     if ("inputImage" in json_data) is False:
         results["message"] = "入力画像が設定されていません"
         return results
 
     # Base64文字列をdecodeし中身を取り出す
     split_string = json_data["inputImage"].split(",")
-    print("[SPLIT]", split_string)
+    if is_reload_enabled():
+        print("[SPLIT]", split_string[0])  # Base64文字列は長いため、ヘッダー（data:image/...;base64）だけを表示する
     img_binary = base64.b64decode(split_string[1])
 
-    # ファイル拡張子を取得
-    split_string = split_string[0].split("/")  # data:image/jpeg;base64
-    extension = split_string[1].split(";")  # jpeg;base64
-
-    # 保存する画像ファイル名を準備する
-    note_id = getNoteId(json_data["_noteLink"])
-    filename = note_id + "-" + str(time.strftime("%Y%m%d%H%M%S")) + "." + extension[0]
-    file_path = local_folder + "/" + filename
-
-    # 画像ファイルを保存
+    # 画像をデコードし、向きを補正して推論用のサイズに縮小する（ファイルには保存しない）
     try:
-        with open(file_path, "wb") as f:
-            f.write(img_binary)
+        image = preprocess_image(img_binary)
     except OSError as e:
         print(e)
+        results["message"] = "入力画像を読み込めません"
         return results
 
-    if is_reload_enabled():
-        print("[SAVED]", file_path)
-
-    # 物体を検出する
-    annotated_image_path = local_folder + "/detected-" + filename
-    detected = yolo_detect_objects(file_path, annotated_image_path, yolo_model_file)
+    # 物体を検出し、座標を元の画像の座標に戻す
+    cascade = parse_flag(json_data.get("cascade"), yolo_cascade)
+    detected, annotated = yolo_detect_image(image.array, yolo_model_file, cascade)
+    detected = image.to_original(detected)
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページID(ページで固有)から生成する
-    key = note_id + "-" + json_data["_pageId"]
+    note_id = getNoteId(json_data["_noteLink"])
+    key = make_key(note_id, json_data["_pageId"])
     if is_reload_enabled():
         print("[DETECTED]", detected)
         print("[REDIS KEY]", key)
-    os.remove(file_path)
 
     if len(detected["records"]) < 1:
         results["message"] = "何も検出されませんでした"
         return results
 
-    # 生成した画像と認識結果を登録する
-    status = redis_image_put(key, annotated_image_path, detected)
-    os.remove(annotated_image_path)
+    # 生成した画像（余白を除いたもの）と認識結果を登録する
+    status = redis_image_put(key, encode_jpeg(image.crop(annotated)), detected, (note_id, json_data["_pageId"]))
 
     if status is False:
         results["message"] = "検出結果がありません"
@@ -95,6 +115,102 @@ def detect_objects(json_data: dict):
     return detected
 
 
+# ==================================================================================================
+# PDFの物体検出処理
+# ==================================================================================================
+
+
+def _encode_thumbnail(image) -> bytes:
+    """検出結果を描画した画像を長辺がthumbnail_sizeのJPEGに変換する"""
+    height, width = image.shape[:2]
+    scale = thumbnail_size / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    return encode_jpeg(image, 85)
+
+
+def detect_pdf_objects(json_data: dict):
+    """eYACHO/GEMBA Noteから送信されてきたPDFの全ページを画像にして、YOLOの物体検出を実行する
+
+    NOTE: 全ページの検出結果（pageを含む）は「<キー>」に格納し、ノートの索引に登録する（一括取得ではこちらを返す）。
+          物体が検出されたページの検出結果とサムネイルは「<キー>-p<ページ番号>」に格納するが、一括取得で同じ検出結果が
+          2回返らないよう、索引には登録しない。格納に失敗したページの番号はfailedPagesで返す
+
+    Args:
+        json_data (dict): クライアント（eYACHO/GEMBA Note）からのPDF情報
+            （dpiを指定すると、PDF_DETECT_MIN_DPI〜PDF_DETECT_MAX_DPIの範囲で解像度を変更できる）
+
+    Returns:
+        _type_: 全ページの物体が検出された領域（JSON形式）
+    """
+    results = {}
+    results["message"] = "不明なエラーが発生しました"
+
+    # 解像度は設定した範囲に収める（大きすぎる値でページの画像がメモリを使い切らないようにする）
+    try:
+        dpi = int(json_data.get("dpi", pdf_detect_dpi))
+    except (TypeError, ValueError):
+        results["message"] = "dpiが正しくありません"
+        return results
+    dpi = min(max(dpi, pdf_detect_min_dpi), pdf_detect_max_dpi)
+
+    # Base64文字列をdecodeし中身を取り出す
+    split_string = json_data["inputPDF"].split(",")  # data:application/pdf;base64, <エンコード文字列>に分割
+    pdf_binary = base64.b64decode(split_string[1])
+
+    # 保存するPDFファイル名を準備する
+    note_id = getNoteId(json_data["_noteLink"])
+    filename = note_id + "-" + str(time.strftime("%Y%m%d%H%M%S")) + ".pdf"
+    file_path = local_folder + "/" + filename
+
+    # PDFファイルを保存
+    try:
+        with open(file_path, "wb") as f:
+            f.write(pdf_binary)
+    except OSError as e:
+        print(e)
+        return results
+
+    # 格納するキーはeYACHO/GEMBA NoteのノートIDとページID(ページで固有)から生成する
+    key = make_key(note_id, json_data["_pageId"])
+    all_records = []
+    failed_pages = []
+
+    def on_page(page_index, detected, annotated):
+        # 物体が検出されたページだけ、検出結果とサムネイルを格納し、全ページの検出結果にページ番号を付けて追加する
+        if not detected["records"]:
+            return
+        page_key = make_key(note_id, json_data["_pageId"] + "-p" + str(page_index + 1))
+        if redis_image_put(page_key, _encode_thumbnail(annotated), detected) is False:
+            failed_pages.append(page_index + 1)
+        all_records.extend({"page": page_index + 1, **record} for record in detected["records"])
+        if is_reload_enabled():
+            print("[DETECTED PAGE]", page_key, len(detected["records"]))
+
+    cascade = parse_flag(json_data.get("cascade"), yolo_cascade)
+    try:
+        pages = yolo_detect_pdf(file_path, yolo_model_file, dpi, pdf_detect_workers, pdf_detect_batch_size, on_page, cascade)
+    finally:
+        os.remove(file_path)
+
+    detected = {
+        "keys": ["page", *DetectionResult.KEYS],
+        "records": all_records,
+        "pages": pages,
+        "failedPages": sorted(failed_pages),
+        "message": "送信終了",
+    }
+    if len(all_records) < 1:
+        results["message"] = "何も検出されませんでした"
+        return results
+
+    if redis_box_put(key, detected, (note_id, json_data["_pageId"])) is False:
+        results["message"] = "検出結果がありません"
+        return results
+
+    return detected
+
+
 # ==================================================================================================
 # 物体検出結果取得処理
 # ==================================================================================================
@@ -115,12 +231,32 @@ def get_detected_boxes(json_data: dict) -> dict:
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
     noteId = getNoteId(json_data["_NOTE_LINK"])
-    key = noteId + "-" + json_data["_PAGE_ID"]
+    key = make_key(noteId, json_data["_PAGE_ID"])
     results = redis_box_get(key)
 
     return results
 
 
+# ==================================================================================================
+# 物体検出結果の一括取得処理
+# ==================================================================================================
+def get_detected_boxes_bulk(json_data: dict) -> dict:
+    """ノートの複数ページの物体検出結果を1回でまとめて取得する
+
+    Args:
+        json_data (dict): {'_NOTE_LINK': <ノートのURL>, '_PAGE_IDS': <ページIDのリスト、またはワイルドカード（省略時は"*"）>}
+
+    Returns:
+        dict: 全ページの物体が検出された領域（JSON形式, 各レコードにpageIdを含む）
+    """
+    if is_reload_enabled():
+        print("[JSON for detected_boxes_bulk]", json_data)
+
+    note_id = getNoteId(json_data["_NOTE_LINK"])
+    pages = redis_bulk_get(note_id, json_data.get("_PAGE_IDS", "*"), "boxes")
+    return merge_page_results([(page_id, unpack_result(packed)) for page_id, packed in pages])
+
+
 # ==================================================================================================
 # 物体検出画像取得処理
 # ==================================================================================================
@@ -130,7 +266,7 @@ def get_detected_image(json_data: dict):
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
     noteId = getNoteId(json_data["_NOTE_LINK"])
-    key = noteId + "-" + json_data["_PAGE_ID"]
+    key = make_key(noteId, json_data["_PAGE_ID"])
     results = redis_image_get(key)  # 画像データを取得する
 
     print("[REDIS IMAGE]", results)
@@ -142,8 +278,8 @@ def get_detected_image(json_data: dict):
 # ==================================================================================================
 # 物体セグメンテーション処理
 # ==================================================================================================
-async def segment_anything(json_data: dict):
-    """eYACHO/GEMBA Noteから送信されてきた画像情報をファイルに保存し、SAMを実行する
+def segment_anything(json_data: dict):
+    """eYACHO/GEMBA Noteから送信されてきた画像を前処理し、SAMを実行する
 
     Args:
         json_data (dict): クライアント（eYACHO/GEMBA Note）からの画像情報
@@ -156,72 +292,145 @@ async def segment_anything(json_data: dict):
         results["message"] = "入力画像が設定されていません"
         return results
 
-    # Base64文字列をバイナリファイルに保存
+    # Base64文字列をdecodeし中身を取り出す
     split_string = json_data["inputImage"].split(",")
-    print("[SPLIT]", split_string)
+    if is_reload_enabled():
+        print("[SPLIT]", split_string[0])  # Base64文字列は長いため、ヘッダー（data:image/...;base64）だけを表示する
     img_binary = base64.b64decode(split_string[1])
 
-    # ファイル拡張子を取得
-    split_string = split_string[0].split("/")  # data:image/jpeg;base64
-    extension = split_string[1].split(";")  # jpeg;base64
-
-    # 保存する画像ファイル名を準備する
-    note_id = getNoteId(json_data["_noteLink"])
-    filename = note_id + "-" + str(time.strftime("%Y%m%d%H%M%S")) + "." + extension[0]
-    file_path = local_folder + "/" + filename
-
-    # 画像ファイルを保存
+    # 画像をデコードし、向きを補正して推論用のサイズに縮小する（ファイルには保存しない）
     try:
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(img_binary)
+        image = preprocess_image(img_binary)
     except OSError as e:
         print(e)
+        results["message"] = "入力画像を読み込めません"
         return results
 
-    if is_reload_enabled():
-        print("[SAVED]", file_path)
-
     # SAMを実行する
-    annotated_image_path = local_folder + "/segmented-" + filename
-    model = SAM(sam_model_file)
-    sam_results = model.predict(file_path, save=False)
-    for result in sam_results:
-        # print(result.verbose())
-        result.save(annotated_image_path, boxes=False, labels=False)
+    model = get_sam_model(sam_model_file)
+    with sam_lock, engine_threads("sam"):
+        sam_results = model.predict(image.array, save=False)
+    segmentation = _to_segmentation(sam_results[0], image)
+    background = _encode_thumbnail(image.crop(image.array))
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページID(ページで固有)から生成する
-    key = note_id + "-" + json_data["_pageId"]
+    note_id = getNoteId(json_data["_noteLink"])
+    key = make_key(note_id, json_data["_pageId"])
     if is_reload_enabled():
         print("[REDIS KEY]", key)
-    os.remove(file_path)
+        print("[SEGMENTED]", len(segmentation.records))
 
-    # 生成した画像と認識結果を登録する
-    status = redis_image_put(key, annotated_image_path, results)
-    os.remove(annotated_image_path)
+    # マスク（RLE・多角形）と、描画時の背景にする入力画像の縮小版を登録する
+    status = redis_mask_put(key, segmentation.to_dict(), background, (note_id, json_data["_pageId"]))
 
     if status is False:
         results["message"] = "セグメンテーション結果がありません"
         return results
     else:
         results["message"] = "セグメンテーションが完了しました"
+    results["count"] = len(segmentation.records)
 
     return results
 
 
+def _to_segmentation(result, image) -> SegmentationResult:
+    """SAMの結果から、マスクごとのRLE・多角形・面積・外接矩形を求める
+
+    NOTE: マスクは前処理で縮小した画像の大きさのままRLEにし、面積・外接矩形・多角形は元の画像の座標にする
+    """
+    segmentation = SegmentationResult(width=image.width, height=image.height, message="送信終了")
+    if result.masks is None:
+        return segmentation
+
+    masks = result.masks.data.cpu().numpy().astype(bool)
+    scores = result.boxes.conf.cpu().numpy() if result.boxes is not None else np.ones(len(masks))
+    scale = image.scale
+    for mask_id, (mask, score) in enumerate(zip(masks, scores, strict=False)):
+        mask = image.crop(mask)
+        top_x, top_y, bottom_x, bottom_y = mask_bbox(mask)
+        segmentation.records.append(
+            SegmentMask(
+                mask_id,
+                round(float(score), 4),
+                round(int(mask.sum()) / (scale * scale)),
+                round(top_x / scale),
+                round(top_y / scale),
+                round(bottom_x / scale),
+                round(bottom_y / scale),
+                encode_rle(mask),
+                mask_polygons(mask, sam_polygon_tolerance, scale),
+            )
+        )
+    return segmentation
+
+
 # ==================================================================================================
 # 物体セグメンテーション結果取得処理
 # ==================================================================================================
 def get_segmented_image(json_data: dict):
+    """セグメンテーション結果のマスクを入力画像の縮小版に描画した画像を取得する（取得時に描画する）
+
+    Args:
+        json_data (dict): クライアント（eYACHO/GEMBA Note）からの情報
+
+    Returns:
+        dict: 描画した画像（JSON形式）
+    """
     if is_reload_enabled():
         print("[JSON for detected_results]", json_data)
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
     noteId = getNoteId(json_data["_NOTE_LINK"])
-    key = noteId + "-" + json_data["_PAGE_ID"]
-    results = redis_image_get(key)  # 画像データを取得する
+    key = make_key(noteId, json_data["_PAGE_ID"])
+    segmentation = redis_mask_get(key)
+    if segmentation is None:
+        # 移行前に格納された描画済みの画像
+        return redis_image_get(key)
+
+    background_jpeg = redis_mask_image_get(key)
+    background = None
+    if background_jpeg is not None:
+        background = cv2.imdecode(np.frombuffer(background_jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    overlay = render_overlay([record["rle"] for record in segmentation["records"]], background)
+    if overlay is None:
+        return {"message": "セグメンテーション画像はありません"}
+
+    # 背景がない場合は、透明な背景のPNGにする
+    if background is None:
+        _, encoded = cv2.imencode(".png", overlay)
+        data_url = "data:image/png;base64," + base64.b64encode(encoded.tobytes()).decode("utf-8")
+    else:
+        data_url = "data:image/jpeg;base64," + base64.b64encode(encode_jpeg(overlay, 85)).decode("utf-8")
+
+    return {"keys": ["outputImage"], "records": [{"outputImage": data_url}], "message": None}
 
+
+# ==================================================================================================
+# 物体セグメンテーション結果（マスク）取得処理
+# ==================================================================================================
+def get_segments(json_data: dict) -> dict:
+    """セグメンテーションで抽出したマスクの一覧（RLE・多角形・面積・外接矩形）を取得する
+
+    Args:
+        json_data (dict): クライアント（eYACHO/GEMBA Note）からの情報。
+            fieldsに出力するキーのリストを指定すると、rleやpolygonsを省略できる
+
+    Returns:
+        dict: マスクの一覧（JSON形式）
+        {'keys': ['maskId', 'score', 'area', 'topX', 'topY', 'bottomX', 'bottomY', 'rle', 'polygons'],
+         'records': [{'maskId': 0, 'score': 0.98, 'area': 5120, ..., 'rle': {'size': [h, w], 'counts': [...]},
+                      'polygons': [[x1, y1, x2, y2, ...]]}, ...],
+         'width': <元の画像の幅>, 'height': <元の画像の高さ>, 'message': <コメント>}
+    """
     if is_reload_enabled():
-        print("[REDIS IMAGE]", results)
-        print(type(results))
+        print("[JSON for segments]", json_data)
 
-    return results
+    # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
+    noteId = getNoteId(json_data["_NOTE_LINK"])
+    key = make_key(noteId, json_data["_PAGE_ID"])
+    segmentation = redis_mask_get(key)
+    if segmentation is None:
+        return {"message": "セグメンテーション結果がありません"}
+
+    keys = [name for name in SegmentationResult.KEYS if name in json_data.get("fields", SegmentationResult.KEYS)]
+    return SegmentationResult.from_dict(segmentation).to_dict(keys)
@@ -0,0 +1,27 @@
+from util.response_util import FastJSONResponse
+from util.warmup_util import get_warmup_status
+
+# ==================================================================================================
+# ヘルスチェック処理
+# ==================================================================================================
+
+
+def get_liveness() -> dict:
+    """サーバーが起動しているかを返す
+
+    Returns:
+        dict: {'status': 'ok'}
+    """
+    return {"status": "ok"}
+
+
+def get_readiness():
+    """推論を受け付けられるか（モデルのウォームアップが完了したか）を返す
+
+    Returns:
+        _type_: 完了していればウォームアップの状態と所要時間、完了していなければステータスコード503
+    """
+    status = get_warmup_status()
+    if status["ready"] is False:
+        return FastJSONResponse(status_code=503, content={"status": "not ready", **status})
+    return {"status": "ready", **status}
@@ -0,0 +1,61 @@
+import asyncio
+import os
+
+import orjson
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from util import redis_util
+from util.notify_util import result_notifier
+from util.redis_util import make_key
+from util.util import getNoteId
+
+# 接続を維持するためのコメントを送る間隔（秒）
+sse_keepalive_seconds = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))
+
+# ==================================================================================================
+# 結果の格納の通知処理（Server-Sent Events）
+# ==================================================================================================
+
+
+def _event(key: str, page_id: str, fields: list) -> str:
+    data = orjson.dumps({"key": key, "pageId": page_id, "fields": fields}).decode("utf-8")
+    return f"event: result\ndata: {data}\n\n"
+
+
+def subscribe_results(note_link: str, page_id: str, fields: str | None = None) -> StreamingResponse:
+    """ノートのページに結果が格納されるたびに、Server-Sent Eventsで通知する
+
+    NOTE: 接続した時点で格納済みのフィールドがあれば、最初にまとめて通知する。
+          通知を受け取ったクライアントは、/rest/detected_boxesなどの取得のエンドポイントで結果を取得する
+
+    Args:
+        note_link (str): eYACHO/GEMBA Noteの対象ノート固有のURL
+        page_id (str): eYACHO/GEMBA Noteの対象ページ固有のID番号
+        fields (str | None): 通知するフィールド（boxes,text,tableのようにカンマ区切り）。Noneの場合はすべて
+
+    Returns:
+        StreamingResponse: text/event-streamのレスポンス
+    """
+    key = make_key(getNoteId(note_link), page_id)
+    wanted = set(fields.split(",")) if fields else None
+
+    async def stream():
+        async with result_notifier.subscribe(key) as queue:
+            # イベントループを止めないよう、REDISへの問い合わせはスレッドプールで実行する
+            stored = [field.decode("utf-8") for field in await run_in_threadpool(redis_util.r_client.hkeys, key)]
+            stored = [field for field in stored if wanted is None or field in wanted]
+            if stored:
+                yield _event(key, page_id, stored)
+            while True:
+                try:
+                    written = await asyncio.wait_for(queue.get(), sse_keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                written = [field for field in written if wanted is None or field in wanted]
+                if written:
+                    yield _event(key, page_id, written)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
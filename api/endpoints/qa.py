@@ -0,0 +1,51 @@
+from util.qa_util import answer_question, build_qa_index, parse_formatted_pages, qa_max_top_k
+from util.redis_util import make_key, redis_qa_index_get, redis_text_get
+from util.util import getNoteId, is_reload_enabled, parse_clamped_int
+
+# ==================================================================================================
+# 質問応答処理
+# ==================================================================================================
+
+
+def ask(json_data: dict) -> dict:
+    """抽出したテキストに対する質問に、テキスト中の該当箇所を回答として返す
+
+    NOTE: テキストの抽出時に作った索引で関連するチャンクを絞り込み、上位のチャンクだけをQAモデルで推論する
+
+    Args:
+        json_data (dict): {'_NOTE_LINK': <ノートのURL>, '_PAGE_ID': <ページID>, 'question': <質問>,
+                           'topK': <QAモデルに入力するチャンクの数（省略時はQA_TOP_K、上限はQA_MAX_TOP_K）>,
+                           'answers': <返す回答の数（省略時は1、上限はQA_MAX_TOP_K）>}
+
+    Raises:
+        InvalidRequestError: topK・answersが整数でない場合（ステータスコード400を返す）
+
+    Returns:
+        dict: {'keys': ['answer', 'score', 'page', 'context'], 'records': [...], 'message': ...}
+    """
+    if is_reload_enabled():
+        print("[JSON for ask]", json_data)
+
+    results = {"keys": ["answer", "score", "page", "context"], "records": []}
+    question = (json_data.get("question") or "").strip()
+    if not question:
+        results["message"] = "質問が設定されていません"
+        return results
+    top_k = parse_clamped_int(json_data.get("topK"), None, 1, qa_max_top_k, "topK")
+    answers = parse_clamped_int(json_data.get("answers"), 1, 1, qa_max_top_k, "answers")
+
+    # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
+    note_id = getNoteId(json_data["_NOTE_LINK"])
+    key = make_key(note_id, json_data["_PAGE_ID"])
+    index = redis_qa_index_get(key)
+    if index is None:
+        # 索引を作る前に抽出したテキストは、格納済みのテキストから索引を作る
+        text = redis_text_get(key)
+        if "records" not in text:
+            results["message"] = "テキストはありません"
+            return results
+        index = build_qa_index(parse_formatted_pages(text["records"][0]["outputText"]))
+
+    results["records"] = answer_question(index, question, top_k, answers)
+    results["message"] = "回答が見つかりました" if results["records"] else "回答が見つかりませんでした"
+    return results
@@ -0,0 +1,70 @@
+import base64
+
+from fastapi.responses import StreamingResponse
+
+from util.redis_util import redis_note_pages, redis_page_fields_get
+from util.report_util import render_report, stream_report
+from util.result_util import unpack_result, unpack_table
+from util.util import getNoteId, is_reload_enabled
+
+# 報告書に含める結果のフィールド
+REPORT_FIELDS = ["image", "boxes", "text", "table"]
+
+# ==================================================================================================
+# 報告書（PDF）生成処理
+# ==================================================================================================
+
+
+def _decode_image(value: bytes) -> bytes:
+    """格納された検出画像（data:image/jpeg;base64,...）をJPEGのバイナリに戻す"""
+    return base64.b64decode(value.split(b",", 1)[1])
+
+
+def _load_section(page_id: str, key: str) -> dict:
+    """1ページ分の結果をREDISから読み込み、章にする"""
+    image, boxes, text, table = (redis_page_fields_get(key, REPORT_FIELDS)[field] for field in REPORT_FIELDS)
+    return {
+        "pageId": page_id,
+        "image": _decode_image(image) if image else None,
+        "boxes": unpack_result(boxes) if boxes else None,
+        "text": text.decode("utf-8") if text else None,
+        "table": unpack_table(table).to_dict() if table else None,
+    }
+
+
+def create_report(json_data: dict):
+    """ノートのページごとの物体検出結果・抽出したテキスト・表をPDFの報告書にする
+
+    NOTE: 結果はページごとに読み込み（ノート全体をまとめて読み込まない）、章の描画はプロセスプールで並列に行う。
+          組み立てた報告書は一時ファイルに保存してからクライアントに送る
+
+    Args:
+        json_data (dict): {'_NOTE_LINK': <ノートのURL>, '_PAGE_IDS': <ページIDのリスト、またはワイルドカード（省略時は"*"）>}
+
+    Returns:
+        _type_: 報告書（application/pdf）。結果がなければメッセージ（JSON形式）
+    """
+    if is_reload_enabled():
+        print("[JSON for report]", json_data)
+
+    note_id = getNoteId(json_data["_NOTE_LINK"])
+    page_ids = json_data.get("_PAGE_IDS", "*")
+    # いずれかの結果があるページを探す（値はまだ読み込まない）
+    pages = redis_note_pages(note_id, page_ids, REPORT_FIELDS)
+
+    # 指定したページの順（ワイルドカードの場合はページIDの順）に章にする
+    if not isinstance(page_ids, str):
+        pages.sort(key=lambda page: page_ids.index(page[0]) if page[0] in page_ids else len(page_ids))
+    else:
+        pages.sort()
+    if not pages:
+        return {"message": "報告書にする結果がありません"}
+
+    # 章は描画に投入するときに1ページずつ読み込む
+    output = render_report(_load_section(page_id, key) for page_id, key in pages)
+    filename = f"report-{note_id}.pdf"
+    return StreamingResponse(
+        stream_report(output),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
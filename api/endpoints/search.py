@@ -0,0 +1,43 @@
+from util.search_util import fts_enabled, search_documents
+from util.util import getNoteId, is_reload_enabled, parse_clamped_int
+
+# 1回の検索で返すページの数の既定値と上限
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# ==================================================================================================
+# 全文検索処理
+# ==================================================================================================
+
+
+def search_text(json_data: dict) -> dict:
+    """抽出したテキストを全文検索し、一致したノート・ページとスニペットを返す
+
+    Args:
+        json_data (dict): {'query': <検索する文字列>, '_NOTE_LINK': <指定した場合はこのノートだけを検索する>,
+                           'limit': <返すページの数（省略時は20、1〜100に収める）>}
+
+    Raises:
+        InvalidRequestError: limitが整数でない場合（ステータスコード400を返す）
+
+    Returns:
+        dict: {'keys': ['noteId', 'pageId', 'page', 'snippet', 'score'], 'records': [...], 'message': ...}
+    """
+    if is_reload_enabled():
+        print("[JSON for search]", json_data)
+
+    results = {"keys": ["noteId", "pageId", "page", "snippet", "score"], "records": []}
+    if not fts_enabled:
+        results["message"] = "全文検索は有効になっていません（FTS_ENABLED）"
+        return results
+
+    query = (json_data.get("query") or "").strip()
+    if not query:
+        results["message"] = "検索する文字列が設定されていません"
+        return results
+    limit = parse_clamped_int(json_data.get("limit"), SEARCH_DEFAULT_LIMIT, 1, SEARCH_MAX_LIMIT, "limit")
+
+    note_id = getNoteId(json_data["_NOTE_LINK"]) if json_data.get("_NOTE_LINK") else None
+    results["records"] = search_documents(query, note_id, limit)
+    results["message"] = f"{len(results['records'])}件見つかりました"
+    return results
@@ -5,10 +5,25 @@ import time
 
 import aiofiles
 from dotenv import load_dotenv
-
-from util.redis_util import redis_table_get, redis_table_put, redis_text_get, redis_text_put
-from util.text_table_util import extract_table, run_ocr
-from util.util import getNoteId, is_reload_enabled
+from starlette.concurrency import run_in_threadpool
+
+from util.ocr_util import ocr_enabled, ocr_max_dpi, ocr_min_dpi
+from util.pdf_cache_util import page_fingerprints
+from util.qa_util import build_qa_index
+from util.redis_util import (
+    make_key,
+    redis_bulk_get,
+    redis_pages_get,
+    redis_table_get,
+    redis_table_put,
+    redis_table_query,
+    redis_text_get,
+    redis_text_put,
+)
+from util.result_util import TABLE_FILTER_OPS, TableQueryError, merge_page_results, unpack_table
+from util.search_util import fts_enabled, index_document
+from util.text_table_util import TABLE_PAGE_INDEX, extract_table, extract_texts, extraction_settings, format_pages
+from util.util import getNoteId, is_reload_enabled, parse_clamped_int, parse_flag
 
 load_dotenv()
 
@@ -29,6 +44,9 @@ async def extract_text(json_data: dict):
     Args:
         json_data (dict): クライアント（eYACHO/GEMBA Note）からのPDF情報
 
+    Raises:
+        InvalidRequestError: ocrDpiが整数でない場合（ステータスコード400を返す）
+
     Returns:
         _type_: 物体が検出された領域（JSON形式）
     """
@@ -39,6 +57,11 @@ async def extract_text(json_data: dict):
         results["message"] = "入力PDFが設定されていません"
         return results
 
+    # OCRの指定（省略時は環境変数の設定）。解像度は設定した範囲に収める
+    # （大きすぎる値でページの画像がメモリを使い切らないようにする）
+    ocr = parse_flag(json_data.get("ocr"), ocr_enabled)
+    dpi = parse_clamped_int(json_data.get("ocrDpi"), None, ocr_min_dpi, ocr_max_dpi, "ocrDpi")
+
     # Base64文字列をバイナリファイルに保存
     split_string = json_data["inputPDF"].split(",")  # data:application/pdf;base64, <エンコード文字列>に分割
     pdf_binary = base64.b64decode(split_string[1])  # PDFファイルのバイナリデータ(つまり、ファイルの中身)
@@ -65,24 +88,72 @@ async def extract_text(json_data: dict):
     if is_reload_enabled():
         print("[SAVED]", file_path)
 
-    # PDFファイルからテキストを抽出する
-    extracted_text = run_ocr(file_path)
+    # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
+    key = make_key(note_id, json_data["_pageId"])
+
+    # PDFファイルからテキストを抽出する（engine・ocr・ocrDpiの指定がなければ環境変数の設定を使う）
+    # NOTE: 抽出・OCRは時間がかかるため、イベントループを止めないようスレッドプールで実行する
+    texts, pages, reused = await run_in_threadpool(
+        _extract_texts_incrementally, key, file_path, json_data.get("engine"), ocr, dpi
+    )
+    extracted_text = format_pages(texts)
+
+    # 質問応答（/rest/ask）で使うチャンクとBM25の索引を、抽出時に1回だけ作る
+    qa_index = await run_in_threadpool(build_qa_index, texts)
 
     if is_reload_enabled():
         print(f"{extracted_text=}")
+        print(f"[REUSED PAGES] {reused}/{len(texts)}")
 
-    # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
-    key = note_id + "-" + json_data["_pageId"]
     os.remove(file_path)
 
-    # REDISにテキストを格納
-    status = redis_text_put(key, extracted_text)
+    # REDISにテキストとページごとのフィンガープリントを格納
+    status = redis_text_put(key, extracted_text, pages, (note_id, json_data["_pageId"]), qa_index)
 
     if status is False:
         results["message"] = "テキストが抽出されませんでした"
         return results
 
-    return {"message": "テキストが抽出されました"}
+    # 全文検索（/rest/search）の索引のこのページの分を更新する
+    if fts_enabled:
+        await run_in_threadpool(index_document, note_id, json_data["_pageId"], texts)
+
+    return {"message": "テキストが抽出されました", "reusedPages": reused}
+
+
+def _extract_texts_incrementally(key, file_path, engine, ocr, dpi):
+    """前回の抽出結果とフィンガープリントが一致するページを再利用し、変更されたページだけ抽出する
+
+    NOTE: 前回と抽出の設定（エンジン・OCR・解像度）が異なる場合は再利用しない
+          （OCRせずに空になったページを、OCRを指定した抽出で再利用しないようにする）
+
+    Args:
+        key (_type_): REDISに格納するときのキー
+        file_path (_type_): PDFファイルのパス
+        engine (_type_): テキスト抽出エンジン
+        ocr (_type_): テキストレイヤーのないページをOCRするか
+        dpi (_type_): OCRでラスタライズする解像度
+
+    Returns:
+        _type_: (ページごとのテキスト, REDISに格納するフィンガープリントと抽出の設定, 再利用したページ数)
+    """
+    settings = extraction_settings(engine, ocr, dpi)
+    try:
+        fingerprints = page_fingerprints(file_path)
+    except Exception as e:
+        print("フィンガープリントを求められないため、全ページを抽出します:", e)
+        fingerprints = None
+
+    reuse = {}
+    previous = redis_pages_get(key, "text_pages")
+    if fingerprints is not None and previous is not None and previous.get("settings") == settings:
+        # ページの挿入・削除にも対応できるよう、ページ番号ではなくフィンガープリントで対応付ける
+        previous_texts = dict(zip(previous["fingerprints"], previous["texts"], strict=True))
+        reuse = {i: previous_texts[fp] for i, fp in enumerate(fingerprints) if fp in previous_texts}
+
+    texts = extract_texts(file_path, engine, ocr, dpi, reuse)
+    pages = None if fingerprints is None else {"fingerprints": fingerprints, "texts": texts, "settings": settings}
+    return texts, pages, len(reuse)
 
 # ==================================================================================================
 # テキスト返却処理
@@ -102,12 +173,28 @@ def get_text(json_data: dict) -> dict:
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
     note_id = getNoteId(json_data["_NOTE_LINK"])
-    key = note_id + "-" + json_data["_PAGE_ID"]
+    key = make_key(note_id, json_data["_PAGE_ID"])
     results = redis_text_get(key)
     print(f"{results=}")
 
     return results
 
+
+def get_text_bulk(json_data: dict) -> dict:
+    """ノートの複数ページの抽出したテキストを1回でまとめて取得する
+
+    Args:
+        json_data (dict): {'_NOTE_LINK': <ノートのURL>, '_PAGE_IDS': <ページIDのリスト、またはワイルドカード（省略時は"*"）>}
+
+    Returns:
+        dict: {'keys': ['pageId', 'outputText'], 'records': [{'pageId':..., 'outputText':...}, ...], ...}
+    """
+    note_id = getNoteId(json_data["_NOTE_LINK"])
+    pages = redis_bulk_get(note_id, json_data.get("_PAGE_IDS", "*"), "text")
+    return merge_page_results(
+        [(page_id, {"keys": ["outputText"], "records": [{"outputText": text.decode("utf-8")}]}) for page_id, text in pages]
+    )
+
 # ==================================================================================================
 # テーブル抽出処理
 # ==================================================================================================
@@ -152,33 +239,64 @@ async def extract_tables(json_data: dict):
     if is_reload_enabled():
         print("[SAVED]", file_path)
 
-    # PDFファイルから表を抽出する
-    extracted_table = extract_table(file_path)
-
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
-    key = note_id + "-" + json_data["_pageId"]
+    key = make_key(note_id, json_data["_pageId"])
+
+    # 表のページが前回と同じフィンガープリントなら、格納済みの表を再利用する
+    extracted_table, table_pages, reused = await run_in_threadpool(_extract_table_incrementally, key, file_path)
     os.remove(file_path)
 
-    status = redis_table_put(key, extracted_table)
+    status = redis_table_put(key, extracted_table, table_pages, (note_id, json_data["_pageId"]))
 
     if status is False:
         results["message"] = "テキストが抽出されませんでした"
         return results
 
-    return {"message": "テキストが抽出されました"}
+    return {"message": "テキストが抽出されました", "reusedPages": reused}
+
+
+def _extract_table_incrementally(key, file_path):
+    """表のページのフィンガープリントが前回と一致すれば格納済みの表を再利用し、変更されていれば抽出する
+
+    Args:
+        key (_type_): REDISに格納するときのキー
+        file_path (_type_): PDFファイルのパス
+
+    Returns:
+        _type_: (表データ, 表のページのフィンガープリント, 再利用したページ数)
+    """
+    try:
+        fingerprints = page_fingerprints(file_path)
+        table_pages = {"page": TABLE_PAGE_INDEX, "fingerprint": fingerprints[TABLE_PAGE_INDEX]}
+    except Exception as e:
+        print("フィンガープリントを求められないため、表を抽出します:", e)
+        table_pages = None
+
+    if table_pages is not None and redis_pages_get(key, "table_pages") == table_pages:
+        stored = redis_table_get(key)
+        if "keys" in stored:
+            stored.pop("message", None)
+            return stored, table_pages, 1
+
+    return extract_table(file_path), table_pages, 0
 
 # ==================================================================================================
 # テーブル返却処理
 # ==================================================================================================
 
 def get_table(json_data: dict):
-    """抽出したテーブルを取得する
+    """抽出したテーブルを取得する（条件に一致する行の指定した範囲・列だけを返せる）
 
     Args:
-        json_data (dict): _description_
+        json_data (dict): {'_NOTE_LINK', '_PAGE_ID', 'offset': <返す最初の行（省略時は0）>, 'limit': <返す行数（省略時はすべて）>,
+                           'columns': <返す列のリスト（省略時はすべて）>,
+                           'filters': <[{'key': 列, 'op': eq/ne/contains, 'value': 値}, ...]（省略時は絞り込まない）>}
 
     Returns:
-        _type_: _description_
+        _type_: {'keys': [...], 'records': [...], 'total': 絞り込んだ行数, 'offset': ..., 'limit': ..., 'message': ...}
+
+    Raises:
+        TableQueryError: 取得条件が正しくない場合（ステータスコード400を返す）
     """
     # if is_reload_enabled():
     # print("[JSON for detected_results]", json_data)
@@ -187,8 +305,43 @@ def get_table(json_data: dict):
 
     # 格納するキーはeYACHO/GEMBA NoteのノートIDとページIDから生成する
     note_id = getNoteId(json_data["_NOTE_LINK"])
-    key = note_id + "-" + json_data["_PAGE_ID"]
-    results = redis_table_get(key)
-    print(f"{results=}")
+    key = make_key(note_id, json_data["_PAGE_ID"])
+    try:
+        offset = int(json_data.get("offset", 0))
+        limit = json_data.get("limit")
+        limit = None if limit is None else int(limit)
+    except (TypeError, ValueError):
+        raise TableQueryError("offsetとlimitは整数で指定してください") from None
+
+    # 列と絞り込みの形式を確かめる（表を読み込む前に、形式の誤りを400で返す）
+    columns = json_data.get("columns")
+    if columns is not None and (not isinstance(columns, list) or not all(isinstance(column, str) for column in columns)):
+        raise TableQueryError("columnsは列名（文字列）のリストで指定してください")
+    filters = json_data.get("filters")
+    if filters is not None and (not isinstance(filters, list) or not all(isinstance(condition, dict) for condition in filters)):
+        raise TableQueryError("filtersは{'key', 'op', 'value'}のリストで指定してください")
+    for condition in filters or []:
+        if condition.get("op", "eq") not in TABLE_FILTER_OPS:
+            raise TableQueryError(f"対応していない演算子です: {condition.get('op')}")
+        if not isinstance(condition.get("key"), str):
+            raise TableQueryError(f"絞り込む列（key）を文字列で指定してください: {condition}")
+
+    results = redis_table_query(key, offset, limit, columns, filters)
+    if is_reload_enabled():
+        print(f"{results=}")
 
     return results
+
+
+def get_table_bulk(json_data: dict) -> dict:
+    """ノートの複数ページの抽出した表を1回でまとめて取得する
+
+    Args:
+        json_data (dict): {'_NOTE_LINK': <ノートのURL>, '_PAGE_IDS': <ページIDのリスト、またはワイルドカード（省略時は"*"）>}
+
+    Returns:
+        dict: 全ページの表（JSON形式, keysは各ページの列の和集合, 各レコードにpageIdを含む）
+    """
+    note_id = getNoteId(json_data["_NOTE_LINK"])
+    pages = redis_bulk_get(note_id, json_data.get("_PAGE_IDS", "*"), "table")
+    return merge_page_results([(page_id, unpack_table(packed).to_dict()) for page_id, packed in pages])
@@ -1,59 +1,183 @@
 # api/routers/routers.py  # noqa: INP001
 
 from fastapi import APIRouter
-
-from api.endpoints.detect import detect_objects, get_detected_boxes, get_detected_image, get_segmented_image, segment_anything
-from api.endpoints.text import extract_tables, extract_text, get_table, get_text
+from starlette.concurrency import run_in_threadpool
+
+from api.endpoints.admin import get_cpu_settings, get_metrics, get_redis_memory
+from api.endpoints.detect import (
+    detect_objects,
+    get_detected_boxes,
+    get_detected_boxes_bulk,
+    get_detected_image,
+    get_segmented_image,
+    get_segments,
+    segment_anything,
+)
+from api.endpoints.health import get_liveness, get_readiness
+from api.endpoints.notify import subscribe_results
+from api.endpoints.qa import ask
+from api.endpoints.report import create_report
+from api.endpoints.search import search_text
+from api.endpoints.text import extract_tables, extract_text, get_table, get_table_bulk, get_text, get_text_bulk
+from util.admission_util import admission
+from util.notify_util import wait_for_result
 
 text_router = APIRouter()  # prefix="/text", tags=["text"])
 object_detection_router = APIRouter()  # prefix="/detect", tags=["detect"])
+admin_router = APIRouter()  # prefix="/admin", tags=["admin"])
+health_router = APIRouter()  # prefix="/health", tags=["health"])
+notify_router = APIRouter()  # prefix="/notify", tags=["notify"])
+report_router = APIRouter()  # prefix="/report", tags=["report"])
 
 
 # テキスト抽出のエンドポイント
 @text_router.post("/rest/extract_text")
 async def post_extract_text(json_data: dict):
-    return await extract_text(json_data)
+    async with admission("bulk"):
+        return await extract_text(json_data)
 
 
 # テキスト取得のエンドポイント
 @text_router.post("/rest/get_text")
 async def post_get_text(json_data: dict):
-    return get_text(json_data)
+    await wait_for_result(json_data, "text")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        return get_text(json_data)
+
+
+# テキスト一括取得のエンドポイント（ノートの複数ページ）
+@text_router.post("/rest/get_text_bulk")
+async def post_get_text_bulk(json_data: dict):
+    async with admission("interactive"):
+        return get_text_bulk(json_data)
+
+
+# 抽出したテキストへの質問応答のエンドポイント
+@text_router.post("/rest/ask")
+async def post_ask(json_data: dict):
+    await wait_for_result(json_data, "text")  # waitを指定した場合は、テキストが格納されるまで待つ
+    async with admission("inference"):
+        return await run_in_threadpool(ask, json_data)
+
+
+# 抽出したテキストの全文検索のエンドポイント（ノート・ページをまたいで検索する）
+@text_router.post("/rest/search")
+async def post_search(json_data: dict):
+    async with admission("interactive"):
+        return await run_in_threadpool(search_text, json_data)
 
 
 # 表データ抽出のエンドポイント
 @text_router.post("/rest/extract_table")
 async def post_extract_table(json_data: dict):
-    return await extract_tables(json_data)
+    async with admission("bulk"):
+        return await extract_tables(json_data)
 
 # 表データ取得のエンドポイント
 @text_router.post("/rest/get_table")
 async def post_get_table(json_data: dict):
-    return get_table(json_data)
+    await wait_for_result(json_data, "table")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        return get_table(json_data)
+
+# 表データ一括取得のエンドポイント（ノートの複数ページ）
+@text_router.post("/rest/get_table_bulk")
+async def post_get_table_bulk(json_data: dict):
+    async with admission("interactive"):
+        return get_table_bulk(json_data)
 
 
 # 物体検出のエンドポイント
 @object_detection_router.post("/rest/detect_objects")
 async def post_detect_objects(json_data: dict):
-    return detect_objects(json_data)
+    # PDFの全ページの検出はbulk、1枚の画像の検出はinferenceとして実行枠を待つ
+    async with admission("bulk" if "inputPDF" in json_data else "inference"):
+        return await run_in_threadpool(detect_objects, json_data)
 
 
 # 物体検出領域結果取得のエンドポイント
 @object_detection_router.post("/rest/detected_boxes")
 async def post_get_detected_boxes(json_data: dict):
-    return get_detected_boxes(json_data)
+    await wait_for_result(json_data, "boxes")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        return get_detected_boxes(json_data)
+
+# 物体検出領域結果一括取得のエンドポイント（ノートの複数ページ）
+@object_detection_router.post("/rest/detected_boxes_bulk")
+async def post_get_detected_boxes_bulk(json_data: dict):
+    async with admission("interactive"):
+        return get_detected_boxes_bulk(json_data)
 
 # 物体検出画像取得のエンドポイント
 @object_detection_router.post("/rest/detected_image")
 async def post_get_detected_image(json_data: dict):
-    return get_detected_image(json_data)
+    await wait_for_result(json_data, "image")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        return get_detected_image(json_data)
 
 # 物体セグメンテーション(SAM)実行のエンドポイント
 @object_detection_router.post("/rest/segment_anything")
 async def post_segment_anything(json_data: dict):
-    return await segment_anything(json_data)
+    async with admission("inference"):
+        return await run_in_threadpool(segment_anything, json_data)
 
 # 物体セグメンテーション結果取得のエンドポイント
 @object_detection_router.post("/rest/get_segmented_image")
 async def post_get_segmented_image(json_data: dict):
-    return get_segmented_image(json_data)
+    await wait_for_result(json_data, "masks")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        # マスクの展開と重ね合わせの描画はCPUを使うため、イベントループを止めないようスレッドプールで実行する
+        return await run_in_threadpool(get_segmented_image, json_data)
+
+# 物体セグメンテーション結果（マスク）取得のエンドポイント
+@object_detection_router.post("/rest/get_segments")
+async def post_get_segments(json_data: dict):
+    await wait_for_result(json_data, "masks")  # waitを指定した場合は、格納されるまで待つ
+    async with admission("interactive"):
+        return get_segments(json_data)
+
+
+# REDISメモリ使用状況取得のエンドポイント（管理者向け）
+@admin_router.post("/rest/admin/redis_memory")
+async def post_get_redis_memory(json_data: dict):
+    # キーを走査して時間がかかるため、bulkの実行枠でイベントループを止めないようスレッドプールで実行する
+    async with admission("bulk"):
+        return await run_in_threadpool(get_redis_memory, json_data)
+
+
+# CPU設定取得のエンドポイント（管理者向け）
+@admin_router.post("/rest/admin/cpu")
+async def post_get_cpu_settings():
+    return get_cpu_settings()
+
+
+# メトリクス取得のエンドポイント（管理者向け）
+@admin_router.post("/rest/admin/metrics")
+async def post_get_metrics(json_data: dict):
+    return get_metrics(json_data)
+
+
+# 死活監視のエンドポイント
+@health_router.get("/health/live")
+async def get_health_live():
+    return get_liveness()
+
+
+# 準備完了（モデルのウォームアップ完了）確認のエンドポイント
+@health_router.get("/health/ready")
+async def get_health_ready():
+    return get_readiness()
+
+
+# 結果の格納を通知するエンドポイント（Server-Sent Events）
+@notify_router.get("/rest/subscribe")
+async def get_subscribe(_NOTE_LINK: str, _PAGE_ID: str, fields: str | None = None):
+    return subscribe_results(_NOTE_LINK, _PAGE_ID, fields)
+
+
+# 報告書（PDF）生成のエンドポイント
+@report_router.post("/rest/report")
+async def post_report(json_data: dict):
+    # 報告書を組み立てて一時ファイルに保存し終えるまで実行枠を使い、PDFの送信は実行枠を返してから行う
+    async with admission("bulk"):
+        return await run_in_threadpool(create_report, json_data)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_cpu_sweep.py
+#
+# [DESCRIPTION]
+#  ワーカー数と推論のスレッド数の組み合わせを変えて、ホスト全体の物体検出のスループットを計測し、
+#  最もスループットの高い設定（WEB_CONCURRENCYとTORCH_INTRA_OP_THREADS）を推奨する
+#
+# [USAGE]
+#    python -m benchmark.bench_cpu_sweep --workers 1 2 4 --threads 1 2 4 --seconds 20
+#
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def _run_worker(worker_index: int, workers: int, threads: int, seconds: float, image_size: int, queue):
+    """1ワーカー分の推論を一定時間繰り返し、推論回数を返す（spawnしたプロセスで実行する）"""
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    os.environ["TORCH_INTRA_OP_THREADS"] = str(threads)
+    os.environ["YOLO_NUM_THREADS"] = str(threads)
+
+    # 環境変数を設定してから読み込む（スレッド数・ワーカー数はモジュールの読み込み時に決まる）
+    from util.cpu_util import configure_cpu  # noqa: PLC0415
+    from util.yolo_util import yolo_detect_batch  # noqa: PLC0415
+
+    configure_cpu(worker_index)
+    model_file = os.environ.get("YOLO_MODEL_FILE")
+    image = np.random.default_rng(worker_index).integers(0, 255, (image_size, image_size, 3), dtype=np.uint8)
+    yolo_detect_batch([image], model_file)  # 初回のモデル読み込みを計測から除外する
+
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        yolo_detect_batch([image], model_file)
+        count += 1
+    queue.put(count)
+
+
+def measure(workers: int, threads: int, seconds: float, image_size: int) -> float:
+    """指定した組み合わせでワーカーを同時に動かし、ホスト全体のスループット（画像/秒）を求める"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    processes = [
+        context.Process(target=_run_worker, args=(i, workers, threads, seconds, image_size, queue)) for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    total = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total / seconds
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ワーカー数と推論スレッド数の組み合わせのスループット計測")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--image-size", type=int, default=640)
+    parser.add_argument("--affinity", default="auto", help="計測時のCPU_AFFINITY（空文字列で設定しない）")
+    args = parser.parse_args(argv)
+
+    os.environ["CPU_AFFINITY"] = args.affinity
+    cpus = os.cpu_count() or 1
+    results = []
+    for workers in args.workers:
+        for threads in args.threads:
+            if workers * threads > cpus:
+                continue  # コア数を超える組み合わせはオーバーサブスクリプションになるため計測しない
+            throughput = measure(workers, threads, args.seconds, args.image_size)
+            results.append((throughput, workers, threads))
+            print(f"[SWEEP] workers={workers} threads={threads} throughput={throughput:.2f} images/s")
+
+    if not results:
+        print("計測できる組み合わせがありません")
+        return 1
+
+    throughput, workers, threads = max(results)
+    print(f"[RECOMMENDED] WEB_CONCURRENCY={workers} TORCH_INTRA_OP_THREADS={threads} ({throughput:.2f} images/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
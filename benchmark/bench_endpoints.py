@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_endpoints.py
+#
+# [DESCRIPTION]
+#  RESTエンドポイントのレイテンシ・スループット・ピークRSSを計測する
+#
+# [USAGE]
+#  アプリをプロセス内で起動し、fakeredisを使って計測する:
+#    python -m benchmark.bench_endpoints --mode inprocess --redis fake
+#  起動済みのサーバーへHTTPで計測する:
+#    python -m benchmark.bench_endpoints --mode http --base-url http://127.0.0.1:8000 --server-pid <PID>
+#  ベースラインを保存する / ベースラインと比較する:
+#    python -m benchmark.bench_endpoints --save-baseline local
+#    python -m benchmark.bench_endpoints --compare local
+#
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import httpx
+
+from benchmark.fixtures import IMAGE_SIZES, PDF_PAGES, make_image, make_pdf, to_data_url
+
+# ベースラインを保存するフォルダー
+BASELINE_FOLDER = os.path.join(os.path.dirname(__file__), "baselines")
+
+NOTE_LINK = "https://mps-beta.metamoji.com/link/bench-note.mmjloc"
+
+# エンドポイント名: (URL, 入力の種類, 事前に実行が必要なエンドポイント)
+ENDPOINTS = {
+    "detect_objects": ("/rest/detect_objects", "image", None),
+    "segment_anything": ("/rest/segment_anything", "image", None),
+    "extract_text": ("/rest/extract_text", "pdf", None),
+    "extract_table": ("/rest/extract_table", "pdf", None),
+    "detected_boxes": ("/rest/detected_boxes", "get", "detect_objects"),
+    "detected_image": ("/rest/detected_image", "get", "detect_objects"),
+    "get_segmented_image": ("/rest/get_segmented_image", "get", "segment_anything"),
+    "get_text": ("/rest/get_text", "get", "extract_text"),
+    "get_table": ("/rest/get_table", "get", "extract_table"),
+}
+
+
+def percentile(values: list, p: float) -> float:
+    """パーセンタイル値を求める（線形補間）
+
+    Args:
+        values (list): 計測値のリスト
+        p (float): パーセンタイル（0〜100）
+
+    Returns:
+        float: パーセンタイル値
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * p / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+def peak_rss_mb(server_pid: int | None) -> float:
+    """ピークRSS（MB）を取得する
+
+    Args:
+        server_pid (int | None): HTTP計測時のサーバープロセスID（Noneの場合は自プロセス）
+
+    Returns:
+        float: ピークRSS（MB）。取得できない場合は0
+    """
+    if server_pid is None:
+        # Linuxではキロバイト、macOSではバイト単位
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024 * 1024) if platform.system() == "Darwin" else maxrss / 1024
+
+    try:
+        with open(f"/proc/{server_pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError as e:
+        print(e)
+    return 0.0
+
+
+def make_payload(kind: str, size: str, page_id: str) -> dict:
+    """エンドポイントに送信するJSONを作成する
+
+    Args:
+        kind (str): 入力の種類（image、pdf、get）
+        size (str): フィクスチャのサイズ名
+        page_id (str): ページID
+
+    Returns:
+        dict: リクエストボディ
+    """
+    if kind == "image":
+        return {"_noteLink": NOTE_LINK, "_pageId": page_id, "inputImage": to_data_url(make_image(size), "image/jpeg")}
+    if kind == "pdf":
+        return {"_noteLink": NOTE_LINK, "_pageId": page_id, "inputPDF": to_data_url(make_pdf(size), "application/pdf")}
+    return {"_NOTE_LINK": NOTE_LINK, "_PAGE_ID": page_id}
+
+
+def make_client(args) -> httpx.AsyncClient:
+    """計測モードに応じたHTTPクライアントを作成する
+
+    Args:
+        args (_type_): コマンドライン引数
+
+    Returns:
+        httpx.AsyncClient: HTTPクライアント
+    """
+    timeout = httpx.Timeout(args.timeout)
+    if args.mode == "http":
+        return httpx.AsyncClient(base_url=args.base_url, timeout=timeout)
+
+    # プロセス内で計測する場合は、main.pyと同じcreate_appでアプリを構成する（圧縮ミドルウェアや例外ハンドラーも含めて計測する）
+    # NOTE: main.pyはRedisのDockerコンテナを起動するため読み込まない。HTTPで計測する場合はアプリ（とモデル）を読み込まないよう、
+    #       アプリとRedisのモジュールはここで読み込む
+    import util.redis_util as redis_util  # noqa: PLC0415
+
+    if args.redis == "fake":
+        import fakeredis  # noqa: PLC0415
+
+        redis_util.r_client = redis_util.r_read_client = fakeredis.FakeRedis()
+
+    from api.app import create_app  # noqa: PLC0415
+
+    app = create_app()
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=timeout)
+
+
+async def run_level(client: httpx.AsyncClient, url: str, payload: dict, concurrency: int, total: int) -> dict:
+    """指定した同時実行数でリクエストを送信し、結果を集計する
+
+    Args:
+        client (httpx.AsyncClient): HTTPクライアント
+        url (str): エンドポイントのURL
+        payload (dict): リクエストボディ
+        concurrency (int): 同時実行数
+        total (int): 総リクエスト数
+
+    Returns:
+        dict: p50/p95/p99（ミリ秒）、スループット（req/s）、エラー数
+    """
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError as e:
+                print(e)
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "p50": round(percentile(latencies, 50), 2),
+        "p95": round(percentile(latencies, 95), 2),
+        "p99": round(percentile(latencies, 99), 2),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "errors": errors,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    """全エンドポイント・全サイズ・全同時実行数の組み合わせを計測する
+
+    Args:
+        args (_type_): コマンドライン引数
+
+    Returns:
+        dict: 計測結果（"<エンドポイント>/<サイズ>/c<同時実行数>"をキーとする）
+    """
+    results = {}
+    async with make_client(args) as client:
+        for name in args.endpoints:
+            url, kind, prerequisite = ENDPOINTS[name]
+            sizes = args.image_sizes if kind == "image" else args.pdf_sizes
+            if kind == "get":
+                prerequisite_kind = ENDPOINTS[prerequisite][1]
+                sizes = args.image_sizes if prerequisite_kind == "image" else args.pdf_sizes
+
+            for size in sizes:
+                page_id = f"bench-{size}"
+                if kind == "get":
+                    # 取得系エンドポイントは事前に結果をRedisへ格納しておく
+                    prerequisite_url = ENDPOINTS[prerequisite][0]
+                    await client.post(prerequisite_url, json=make_payload(prerequisite_kind, size, page_id))
+                payload = make_payload(kind, size, page_id)
+
+                # ウォームアップ（初回のモデル読み込みなどを計測から除外する）
+                for _ in range(args.warmup):
+                    await client.post(url, json=payload)
+
+                for concurrency in args.concurrency:
+                    stats = await run_level(client, url, payload, concurrency, args.requests)
+                    stats["peak_rss_mb"] = round(peak_rss_mb(args.server_pid), 1)
+                    label = f"{name}/{size}/c{concurrency}"
+                    results[label] = stats
+                    print(f"[BENCH] {label}: {stats}")
+
+    return results
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """ベースラインと比較し、劣化した項目を返す
+
+    Args:
+        results (dict): 今回の計測結果
+        baseline (dict): 保存済みのベースライン
+        tolerance (float): 許容する劣化率（0.2なら20%）
+
+    Returns:
+        list: 劣化した項目の説明のリスト
+    """
+    regressions = []
+    for label, stats in results.items():
+        if label not in baseline:
+            continue
+        base = baseline[label]
+        regressions.extend(
+            f"{label} {metric}: {base[metric]} -> {stats[metric]}"
+            for metric in ["p50", "p95", "p99", "peak_rss_mb"]
+            if base.get(metric) and stats[metric] > base[metric] * (1 + tolerance)
+        )
+        if base.get("throughput") and stats["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{label} throughput: {base['throughput']} -> {stats['throughput']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="RESTエンドポイントのベンチマーク")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--server-pid", type=int, default=None, help="HTTP計測時にピークRSSを取得するサーバーのPID")
+    parser.add_argument("--redis", choices=["fake", "local"], default="fake", help="プロセス内計測で使うRedis")
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--image-sizes", nargs="+", choices=list(IMAGE_SIZES), default=list(IMAGE_SIZES))
+    parser.add_argument("--pdf-sizes", nargs="+", choices=list(PDF_PAGES), default=list(PDF_PAGES))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=20, help="同時実行数ごとの総リクエスト数")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--save-baseline", metavar="NAME", default=None)
+    parser.add_argument("--compare", metavar="NAME", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmark(args))
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        path = os.path.join(BASELINE_FOLDER, f"{args.save_baseline}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print("[BASELINE SAVED]", path)
+
+    if args.compare:
+        path = os.path.join(BASELINE_FOLDER, f"{args.compare}.json")
+        with open(path) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("[REGRESSION]", regression)
+        if regressions:
+            return 1
+        print("[BASELINE OK]", path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_serialization.py
+#
+# [DESCRIPTION]
+#  REDIS格納時のエンコード/デコードのコストとサイズを、移行前のjson.dumps(indent=2)と比較する
+#
+# [USAGE]
+#    python -m benchmark.bench_serialization
+#
+import json
+import timeit
+
+import orjson
+
+from util.result_util import DetectedBox, DetectionResult, TableResult, pack_result, unpack_result
+
+
+def sample_detection(count: int) -> dict:
+    records = [DetectedBox(f"object-{i % 10}", 50.0 + i % 50, i, i * 2, i + 100, i * 2 + 80) for i in range(count)]
+    return DetectionResult(records, "送信終了").to_dict()
+
+
+def sample_table(rows: int, cols: int) -> dict:
+    table = [[f"項目{c}" for c in range(cols)]] + [[f"値{r}-{c}" for c in range(cols)] for r in range(rows)]
+    return TableResult.from_rows(table).to_dict()
+
+
+def measure(name: str, data: dict, number: int):
+    """各方式のエンコード/デコード時間（マイクロ秒）とサイズ（バイト）を表示する"""
+    codecs = {
+        "json(indent=2)": (
+            lambda d: json.dumps(d, ensure_ascii=False, indent=2).encode("utf-8"),
+            json.loads,
+        ),
+        "orjson": (orjson.dumps, orjson.loads),
+        "msgpack": (pack_result, unpack_result),
+    }
+    print(f"[{name}]")
+    for codec, (encode, decode) in codecs.items():
+        encoded = encode(data)
+        encode_us = timeit.timeit(lambda encode=encode: encode(data), number=number) / number * 1e6
+        decode_us = timeit.timeit(lambda decode=decode, encoded=encoded: decode(encoded), number=number) / number * 1e6
+        print(f"  {codec:<16} size={len(encoded):>9} B  encode={encode_us:>9.1f} us  decode={decode_us:>9.1f} us")
+
+
+if __name__ == "__main__":
+    measure("detection 20 boxes", sample_detection(20), 2000)
+    measure("detection 500 boxes", sample_detection(500), 200)
+    measure("table 100x8", sample_table(100, 8), 200)
+    measure("table 5000x12", sample_table(5000, 12), 10)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_text_engine.py
+#
+# [DESCRIPTION]
+#  テキスト抽出エンジン（pdfium / pdfplumber）の抽出結果の一致度と処理時間を比較する
+#
+# [USAGE]
+#  フィクスチャのPDF（5/20/200ページ）で比較する:
+#    python -m benchmark.bench_text_engine
+#  任意のPDFで比較する:
+#    python -m benchmark.bench_text_engine --pdf PDFs/sample.pdf
+#
+import argparse
+import difflib
+import sys
+import time
+
+from benchmark.fixtures import PDF_PAGES, make_pdf
+from util.pdf_cache_util import pdf_page_cache
+from util.text_table_util import TEXT_ENGINES, extract_page_texts
+
+
+def normalize(text: str) -> str:
+    """空白と改行を除いて比較できるようにする"""
+    return "".join(text.split())
+
+
+def compare(pdf_path: str, min_ratio: float) -> bool:
+    """各エンジンの抽出時間を計測し、ページごとの一致度がmin_ratio以上か判定する
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+        min_ratio (float): 許容する一致度の下限（0〜1）
+
+    Returns:
+        bool: True - 全ページが一致度の下限以上、False - 下限未満のページがある
+    """
+    texts = {}
+    for engine in TEXT_ENGINES:
+        # キャッシュの影響を除くため、エンジンごとにキャッシュを空にする
+        pdf_page_cache.documents.clear()
+        pdf_page_cache.total_bytes = 0
+        start = time.perf_counter()
+        texts[engine] = extract_page_texts(pdf_path, engine)
+        elapsed = time.perf_counter() - start
+        print(f"[{pdf_path}] {engine:<10} pages={len(texts[engine]):>4}  time={elapsed:8.3f} s")
+
+    base, other = texts["pdfplumber"], texts["pdfium"]
+    if len(base) != len(other):
+        print(f"[MISMATCH] ページ数が異なります: pdfplumber={len(base)} pdfium={len(other)}")
+        return False
+
+    ok = True
+    for i, (a, b) in enumerate(zip(base, other, strict=True)):
+        ratio = difflib.SequenceMatcher(None, normalize(a), normalize(b)).ratio() if a or b else 1.0
+        if ratio < min_ratio:
+            print(f"[MISMATCH] page {i + 1}: ratio={ratio:.3f}")
+            ok = False
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="テキスト抽出エンジンの一致度と処理時間の比較")
+    parser.add_argument("--pdf", nargs="+", default=None, help="比較するPDF（省略時はフィクスチャ）")
+    parser.add_argument("--min-ratio", type=float, default=0.98)
+    args = parser.parse_args(argv)
+
+    pdf_paths = args.pdf or [make_pdf(name) for name in PDF_PAGES]
+    results = [compare(pdf_path, args.min_ratio) for pdf_path in pdf_paths]
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_vision.py
+#
+# [DESCRIPTION]
+#  Cloud Vision APIのOCRクライアントを、スタブサーバーに対してバッチサイズ・同時実行数を変えて計測する
+#
+# [USAGE]
+#  先にスタブサーバーを起動しておく:
+#    uvicorn benchmark.vision_stub_server:app --port 8090
+#    python -m benchmark.bench_vision --endpoint http://127.0.0.1:8090 --images 200
+#
+import argparse
+import sys
+import time
+
+from util.vision_util import RestVisionTransport, VisionOcrClient
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Vision OCRクライアントのベンチマーク")
+    parser.add_argument("--endpoint", default="http://127.0.0.1:8090")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 8])
+    args = parser.parse_args(argv)
+
+    images = [b"\x89PNG stub image %d" % i for i in range(args.images)]
+    for batch_size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            client = VisionOcrClient(lambda: RestVisionTransport(args.endpoint, None), batch_size, concurrency)
+            start = time.perf_counter()
+            texts = client.ocr_images(images)
+            elapsed = time.perf_counter() - start
+            client.loop.call_soon_threadsafe(client.loop.stop)
+            print(
+                f"[BENCH] batch={batch_size:>2} concurrency={concurrency:>2} "
+                f"images={len(texts)} time={elapsed:7.2f} s throughput={len(texts) / elapsed:8.1f} images/s"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# [FILE] bench_worker_rss.py
+#
+# [DESCRIPTION]
+#  gunicornのマスタープロセスとワーカーのメモリ使用量（RSS・PSS・共有・専有）を表示する
+#  PSSは共有ページをプロセス数で按分した値で、合計がホスト上の実際のメモリ使用量になる
+#
+# [USAGE]
+#    python -m benchmark.bench_worker_rss <マスタープロセスのPID>
+#
+import sys
+
+
+def read_rollup(pid: int) -> dict:
+    """/proc/<PID>/smaps_rollupからメモリ使用量（MB）を取得する"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss": values.get("Rss", 0.0),
+        "pss": values.get("Pss", 0.0),
+        "shared": values.get("Shared_Clean", 0.0) + values.get("Shared_Dirty", 0.0),
+        "private": values.get("Private_Clean", 0.0) + values.get("Private_Dirty", 0.0),
+    }
+
+
+def children(pid: int) -> list:
+    """子プロセス（ワーカー）のPIDを取得する"""
+    pids = []
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("使い方: python -m benchmark.bench_worker_rss <マスタープロセスのPID>")
+        return 1
+
+    master = int(argv[0])
+    print(f"{'process':<16}{'RSS(MB)':>10}{'PSS(MB)':>10}{'shared':>10}{'private':>10}")
+    total_pss = 0.0
+    for label, pid in [("master", master)] + [(f"worker {pid}", pid) for pid in children(master)]:
+        usage = read_rollup(pid)
+        total_pss += usage["pss"]
+        print(f"{label:<16}{usage['rss']:>10.1f}{usage['pss']:>10.1f}{usage['shared']:>10.1f}{usage['private']:>10.1f}")
+    print(f"{'total PSS':<16}{total_pss:>20.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
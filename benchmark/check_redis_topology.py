@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# [FILE] check_redis_topology.py
+#
+# [DESCRIPTION]
+#  環境変数で指定したREDISの構成（1台・Redis Cluster・Sentinel）で、結果の格納・取得・一括取得・通知が動作するか確認する
+#  ローカルで複数ノードのRedisを起動するには benchmark/redis_topologies/docker-compose.yml を使う
+#
+# [USAGE]
+#    REDIS_MODE=cluster REDIS_NODES=127.0.0.1:7000,127.0.0.1:7001 python -m benchmark.check_redis_topology
+#    REDIS_MODE=sentinel REDIS_NODES=127.0.0.1:26379 REDIS_READ_FROM_REPLICAS=1 python -m benchmark.check_redis_topology
+#
+import asyncio
+import sys
+import uuid
+
+from util import redis_util
+from util.notify_util import wait_for_field
+from util.redis_util import make_key, note_index_key, redis_box_get, redis_box_put, redis_bulk_get, redis_text_get, redis_text_put
+
+
+def check(name: str, ok: bool) -> bool:
+    print(f"[{'OK' if ok else 'NG'}] {name}")
+    return ok
+
+
+async def check_notification(key: str) -> bool:
+    waiter = asyncio.create_task(wait_for_field(key, "text", 5.0))
+    await asyncio.sleep(0.5)
+    await asyncio.to_thread(redis_text_put, key, "notified")
+    return await waiter
+
+
+def main() -> int:
+    note_id = "check-" + uuid.uuid4().hex[:8]
+    page_ids = [f"page-{i}" for i in range(5)]
+    boxes = {"keys": ["objName"], "records": [{"objName": "person"}], "message": None}
+    results = []
+
+    for page_id in page_ids:
+        redis_box_put(make_key(note_id, page_id), boxes, (note_id, page_id))
+        redis_text_put(make_key(note_id, page_id), "text of " + page_id, None, (note_id, page_id))
+
+    results.append(check("格納した検出結果を取得できる", redis_box_get(make_key(note_id, page_ids[0])) == boxes))
+    results.append(check("格納したテキストを取得できる", "records" in redis_text_get(make_key(note_id, page_ids[0]))))
+    results.append(check("ページIDのリストで一括取得できる", len(redis_bulk_get(note_id, page_ids[:3], "text")) == 3))
+    results.append(check("ワイルドカードで一括取得できる", len(redis_bulk_get(note_id, "*", "boxes")) == len(page_ids)))
+
+    if redis_util.redis_mode == "cluster":
+        slots = {redis_util.r_client.keyslot(make_key(note_id, page_id)) for page_id in page_ids}
+        slots.add(redis_util.r_client.keyslot(note_index_key(note_id)))
+        results.append(check("同じノートのキーと索引が同じスロットに入る", len(slots) == 1))
+
+    key = make_key(note_id, "page-notify")
+    results.append(check("格納の通知を受け取れる", asyncio.run(check_notification(key))))
+
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
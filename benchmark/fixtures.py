@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# [FILE] fixtures.py
+#
+# [DESCRIPTION]
+#  ベンチマーク用の画像・PDFフィクスチャを生成する
+#
+import base64
+import os
+
+import cv2
+import numpy as np
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfgen import canvas
+
+# フィクスチャを保存するフォルダー（生成物はgitで管理しない）
+FIXTURE_FOLDER = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# 画像サイズ（名称: (幅, 高さ)）
+IMAGE_SIZES = {
+    "small": (640, 480),
+    "medium": (1920, 1080),
+    "large": (4032, 3024),  # タブレットのカメラ画像相当
+}
+
+# PDFのページ数（名称: ページ数）
+PDF_PAGES = {
+    "small": 5,  # 表抽出は5ページ目を対象とするため最低5ページ
+    "medium": 20,
+    "large": 200,
+}
+
+
+def make_image(name: str) -> str:
+    """ベンチマーク用のJPEG画像を生成する（既に存在する場合は再利用する）
+
+    Args:
+        name (str): IMAGE_SIZESのキー
+
+    Returns:
+        str: 生成した画像ファイルのパス
+    """
+    os.makedirs(FIXTURE_FOLDER, exist_ok=True)
+    path = os.path.join(FIXTURE_FOLDER, f"image-{name}.jpg")
+    if os.path.exists(path):
+        return path
+
+    width, height = IMAGE_SIZES[name]
+    # 乱数を固定して毎回同じ画像を生成する
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (0, 0), 8)
+    # 検出対象になりそうな矩形を描画しておく
+    for i in range(5):
+        x = int(width * (0.1 + 0.15 * i))
+        y = int(height * 0.3)
+        cv2.rectangle(image, (x, y), (x + width // 10, y + height // 3), (40 * i, 80, 200), -1)
+    cv2.imwrite(path, image)
+
+    return path
+
+
+def make_pdf(name: str) -> str:
+    """ベンチマーク用のPDF（テキストと表を含む）を生成する（既に存在する場合は再利用する）
+
+    Args:
+        name (str): PDF_PAGESのキー
+
+    Returns:
+        str: 生成したPDFファイルのパス
+    """
+    os.makedirs(FIXTURE_FOLDER, exist_ok=True)
+    path = os.path.join(FIXTURE_FOLDER, f"pdf-{name}.pdf")
+    if os.path.exists(path):
+        return path
+
+    pages = PDF_PAGES[name]
+    c = canvas.Canvas(path, pagesize=A4)
+    height = A4[1]
+    for page in range(pages):
+        c.setFont("Helvetica", 12)
+        c.drawString(20 * mm, height - 20 * mm, f"Inspection sheet page {page + 1}")
+        for line in range(30):
+            c.drawString(20 * mm, height - (30 + line * 5) * mm, f"Line {line + 1}: item-{page}-{line} value={line * page}")
+
+        # 表（罫線付き）を描画する
+        top = 100 * mm
+        for row in range(6):
+            y = top - row * 8 * mm
+            c.line(20 * mm, y, 180 * mm, y)
+            for col in range(4):
+                c.drawString((22 + col * 40) * mm, y - 6 * mm, f"r{row}c{col}" if row else f"head{col}")
+        for col in range(5):
+            x = (20 + col * 40) * mm
+            c.line(x, top, x, top - 5 * 8 * mm)
+        c.showPage()
+    c.save()
+
+    return path
+
+
+def to_data_url(path: str, mime_type: str) -> str:
+    """ファイルをeYACHO/GEMBA Noteが送信する形式のBase64文字列に変換する
+
+    Args:
+        path (str): ファイルのパス
+        mime_type (str): MIMEタイプ（例：image/jpeg、application/pdf）
+
+    Returns:
+        str: data:<MIMEタイプ>;base64,<エンコード文字列>
+    """
+    with open(path, "rb") as f:
+        data = base64.b64encode(f.read()).decode("utf-8")
+    return f"data:{mime_type};base64,{data}"
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# [FILE] vision_stub_server.py
+#
+# [DESCRIPTION]
+#  Cloud Vision APIのREST API（images:annotate、files:asyncBatchAnnotate、operations）を模したスタブサーバー
+#  オフラインでOCRの経路をテスト・ベンチマークするために使う
+#
+# [USAGE]
+#    VISION_STUB_LATENCY=0.2 VISION_STUB_FAILURE_RATE=0.1 uvicorn benchmark.vision_stub_server:app --port 8090
+#  サーバー側は次の設定で接続する:
+#    VISION_BACKEND=rest VISION_ENDPOINT=http://127.0.0.1:8090
+#
+import asyncio
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+# 1リクエストあたりの応答時間（秒）と、1画像あたりの追加の応答時間（秒）
+STUB_LATENCY = float(os.environ.get("VISION_STUB_LATENCY", "0.2"))
+STUB_LATENCY_PER_IMAGE = float(os.environ.get("VISION_STUB_LATENCY_PER_IMAGE", "0.02"))
+
+# 503を返す割合（クライアントの再試行を確認するため）
+STUB_FAILURE_RATE = float(os.environ.get("VISION_STUB_FAILURE_RATE", "0.0"))
+
+# ファイルOCRのオペレーションが完了するまでの時間（秒）
+STUB_OPERATION_SECONDS = float(os.environ.get("VISION_STUB_OPERATION_SECONDS", "2.0"))
+
+app = FastAPI()
+operations = {}  # {オペレーション名: 完了時刻}
+stats = {"requests": 0, "images": 0, "files": 0, "failures": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+def _maybe_fail():
+    if random.random() < STUB_FAILURE_RATE:
+        stats["failures"] += 1
+        return JSONResponse(status_code=503, content={"error": {"code": 503, "message": "stub unavailable"}})
+    return None
+
+
+@app.post("/v1/images:annotate")
+async def annotate_images(body: dict):
+    failure = _maybe_fail()
+    if failure is not None:
+        return failure
+
+    requests = body.get("requests", [])
+    stats["requests"] += 1
+    stats["images"] += len(requests)
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(STUB_LATENCY + STUB_LATENCY_PER_IMAGE * len(requests))
+    finally:
+        stats["in_flight"] -= 1
+
+    responses = []
+    for request in requests:
+        size = len(request.get("image", {}).get("content", ""))
+        responses.append({"fullTextAnnotation": {"text": f"スタブOCRテキスト({size}文字のBase64)\n"}})
+    return {"responses": responses}
+
+
+@app.post("/v1/files:asyncBatchAnnotate")
+async def annotate_files(body: dict):
+    failure = _maybe_fail()
+    if failure is not None:
+        return failure
+
+    stats["files"] += len(body.get("requests", []))
+    name = f"operations/{uuid.uuid4().hex}"
+    operations[name] = time.time() + STUB_OPERATION_SECONDS
+    return {"name": name}
+
+
+@app.get("/v1/operations/{operation_id}")
+async def get_operation(operation_id: str):
+    name = f"operations/{operation_id}"
+    if name not in operations:
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": "not found"}})
+    done = time.time() >= operations[name]
+    result = {"name": name, "done": done}
+    if done:
+        result["response"] = {"responses": [{"outputConfig": {}}]}
+    return result
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
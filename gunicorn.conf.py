@@ -0,0 +1,52 @@
+#
+# [FILE] gunicorn.conf.py
+#
+# [DESCRIPTION]
+#  複数ワーカーで起動するためのgunicornの設定
+#  マスタープロセスでアプリ（とモデル）を読み込んでからforkし、モデルの重みをワーカー間で共有する
+#
+# [USAGE]
+#    MODEL_PRELOAD=1 gunicorn main:app -c gunicorn.conf.py
+#
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# ワーカー数（既定は2）
+# NOTE: 推論のスレッド数・OCRのプロセス数・CPUアフィニティもワーカー数でCPUを等分するため、アプリを読み込む前に
+#       WEB_CONCURRENCYに書き出して同じ値を使わせる（ワーカー数は-wではなくWEB_CONCURRENCYで指定する）
+os.environ.setdefault("WEB_CONCURRENCY", "2")
+workers = int(os.environ["WEB_CONCURRENCY"])
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# fork前にmain.pyを読み込む（MODEL_PRELOAD=1ならモデルも読み込まれる）
+preload_app = True
+
+# PDFの抽出・物体検出は時間がかかるため、ワーカーのタイムアウトを長めにする
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "600"))
+
+
+# 使用中のワーカー番号（マスタープロセスで管理する）
+# NOTE: ワーカーの起動順（age）から求めると、再起動したワーカーが生きているワーカーと同じ番号になることがあるため、
+#       終了したワーカーの番号を空けて、次に起動するワーカーに割り当てる
+_used_worker_indexes = set()
+
+
+def pre_fork(server, worker):
+    """ワーカーをforkする前に（マスタープロセスで）、空いている最小のワーカー番号を割り当てる"""
+    worker.worker_index = min(set(range(len(_used_worker_indexes) + 1)) - _used_worker_indexes)
+    _used_worker_indexes.add(worker.worker_index)
+
+
+def child_exit(server, worker):
+    """ワーカーが終了したら（マスタープロセスで）、そのワーカー番号を空ける"""
+    _used_worker_indexes.discard(getattr(worker, "worker_index", None))
+
+
+def post_fork(server, worker):
+    """ワーカーの起動時に、ワーカー番号に応じたスレッド数とCPUアフィニティを設定する"""
+    from util.cpu_util import configure_cpu  # noqa: PLC0415 - 設定ファイルの読み込み時にtorchを読み込まないよう、ここで読み込む
+
+    worker_index = worker.worker_index
+    os.environ["WORKER_INDEX"] = str(worker_index)
+    configure_cpu(worker_index)
@@ -5,12 +5,9 @@ import sys
 import time
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 
-import api.routers.routers as routers
+from api.app import create_app
+from util.model_util import model_preload, preload_models
 from util.redis_util import redis_box_get, redis_image_get, redis_image_put, redis_text_get, redis_text_put
 from util.text_table_util import run_ocr
 from util.util import getNoteId
@@ -41,23 +38,13 @@ if yolo_model_file is None:
 else:
     print("[MODEL FILE]", yolo_model_file)
 
-app = FastAPI()
-app.include_router(routers.text_router)
-app.include_router(routers.object_detection_router)
-app.mount(path="/static", app=StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+app = create_app()
 start_redis_with_docker()
 
+# NOTE: 推論のスレッド数はここでは設定しない。preload_appのマスタープロセスでtorchのスレッドプールを作ると、
+#       fork後のワーカーに引き継がれて設定が効かなかったり推論が止まったりするため、ワーカーの起動時に設定する
+#       （gunicornの場合はpost_fork、uvicornを単体で起動した場合はapi/app.pyのstartup）
 
-@app.get("/", response_class=HTMLResponse)
-async def top_page(request: Request):
-    """トップページを開く
-
-    Args:
-        request (Request): リクエスト
-
-    Returns:
-        _type_: テンプレートレスポンスを返す
-    """
-
-    return templates.TemplateResponse("top.html", {"request": request, "title": "YOLO REST Server"})
+# gunicornのpreload_appで起動した場合は、fork前にモデルを読み込んでワーカー間で共有する
+if model_preload:
+    preload_models()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# [FILE] test_compression.py
+#
+# [DESCRIPTION]
+#  圧縮されたリクエストボディの展開（サイズの上限・途中で切れたデータ）と、ミドルウェアでの圧縮・展開を確かめる
+#
+import gzip
+import zlib
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from util import compression_util
+from util.compression_util import CompressionMiddleware, PayloadTooLarge, decompress_body
+
+zstandard = pytest.importorskip("zstandard")
+brotli = pytest.importorskip("brotli")
+
+BODY = b'{"text": "' + "点検記録 inspection record ".encode() * 20000 + b'"}'
+
+ENCODERS = {
+    "gzip": gzip.compress,
+    "deflate": zlib.compress,
+    "br": brotli.compress,
+    "zstd": lambda data: zstandard.ZstdCompressor().compress(data),
+}
+
+
+@pytest.mark.parametrize("encoding", ENCODERS)
+def test_round_trip(encoding):
+    assert decompress_body(ENCODERS[encoding](BODY), encoding, len(BODY)) == BODY
+
+
+@pytest.mark.parametrize("encoding", ENCODERS)
+def test_limit_stops_decompression(encoding):
+    with pytest.raises(PayloadTooLarge):
+        decompress_body(ENCODERS[encoding](BODY), encoding, len(BODY) - 1)
+
+
+@pytest.mark.parametrize("encoding", ENCODERS)
+def test_truncated_body_is_rejected(encoding):
+    data = ENCODERS[encoding](BODY)
+    for size in (len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError, match=r"途中で終わっています|展開できません"):
+            decompress_body(data[:size], encoding, len(BODY))
+
+
+def test_zstd_stream_without_content_size():
+    # ストリーミングで圧縮したフレーム（ヘッダーにサイズがなく、チェックサム付き）も展開できる
+    compressor = zstandard.ZstdCompressor(write_checksum=True).compressobj()
+    data = compressor.compress(BODY) + compressor.flush()
+    assert decompress_body(data, "zstd", len(BODY)) == BODY
+    with pytest.raises(ValueError, match="途中で終わっています"):
+        decompress_body(data[:-2], "zstd", len(BODY))
+
+
+def test_zstd_bomb_is_stopped_at_limit():
+    bomb = zstandard.ZstdCompressor(level=19).compress(b"\0" * (64 * 1024 * 1024))
+    with pytest.raises(PayloadTooLarge):
+        decompress_body(bomb, "zstd", 1024 * 1024)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """ボディを返すだけのアプリ（スレッドで圧縮・展開するサイズを小さくして、両方の経路を通す）"""
+    monkeypatch.setattr(compression_util, "compression_thread_min_bytes", 64 * 1024)
+    app = FastAPI()
+
+    @app.post("/rest/echo")
+    async def echo(json_data: dict):
+        return json_data
+
+    app.add_middleware(CompressionMiddleware)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("encoding", ENCODERS)
+@pytest.mark.parametrize("size", [100, 200000])
+def test_middleware_decompresses_and_compresses(client, encoding, size):
+    body = b'{"text": "' + b"x" * size + b'"}'
+    response = client.post(
+        "/rest/echo",
+        content=ENCODERS[encoding](body),
+        headers={"Content-Type": "application/json", "Content-Encoding": encoding, "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"text": "x" * size}
+
+
+def test_middleware_rejects_oversized_body(client, monkeypatch):
+    monkeypatch.setattr(compression_util, "request_max_decompressed_bytes", 256 * 1024)
+    response = client.post(
+        "/rest/echo",
+        content=ENCODERS["zstd"](BODY),
+        headers={"Content-Type": "application/json", "Content-Encoding": "zstd"},
+    )
+    assert response.status_code == 413
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# [FILE] test_redis_topology.py
+#
+# [DESCRIPTION]
+#  複数ノードのREDIS（Redis Cluster・Sentinel）で、格納直後の取得・スロットをまたぐ一括取得・
+#  通知によるL1キャッシュの削除を確かめる
+#  - benchmark/redis_topologies/docker-compose.ymlで起動した構成に対して、REDIS_MODE・REDIS_NODESを指定して実行する
+#  - REDIS_MODEがclusterかsentinelでない場合や、REDISに接続できない場合はスキップする
+#
+# [USAGE]
+#    REDIS_MODE=cluster REDIS_NODES=127.0.0.1:7000,127.0.0.1:7001,127.0.0.1:7002 python -m pytest tests/test_redis_topology.py
+#    REDIS_MODE=sentinel REDIS_NODES=127.0.0.1:26379 REDIS_READ_FROM_REPLICAS=1 python -m pytest tests/test_redis_topology.py
+#
+import os
+import time
+import uuid
+
+import pytest
+import redis
+
+if os.environ.get("REDIS_MODE") not in ("cluster", "sentinel"):
+    pytest.skip("REDIS_MODEにclusterかsentinelを指定した場合だけ実行する", allow_module_level=True)
+
+try:
+    from util import redis_util
+
+    redis_util.r_client.ping()
+    redis_util.r_read_client.ping()
+except redis.RedisError as e:
+    pytest.skip(f"REDISに接続できません: {e}", allow_module_level=True)
+
+from util.notify_util import result_notifier
+from util.redis_util import (
+    RESULT_CHANNEL_PREFIX,
+    make_key,
+    note_index_key,
+    redis_box_get,
+    redis_box_put,
+    redis_bulk_get,
+    redis_page_fields_get,
+    redis_text_get,
+    redis_text_put,
+)
+from util.result_util import pack_result
+
+# 通知が届くまで待つ時間の上限（秒）
+NOTIFY_TIMEOUT = 5.0
+
+BOXES = {"keys": ["objName"], "records": [{"objName": "person"}], "message": None}
+
+
+def _note_id() -> str:
+    return "test-" + uuid.uuid4().hex[:8]
+
+
+def test_read_after_write(monkeypatch):
+    # L1キャッシュを通さず、取得用のクライアント（レプリカ）から読み込む
+    monkeypatch.setattr(redis_util, "l1_cache_enabled", False)
+    note_id = _note_id()
+
+    for i in range(20):
+        key = make_key(note_id, f"page-{i}")
+        redis_box_put(key, BOXES, (note_id, f"page-{i}"))
+        redis_text_put(key, f"text of page-{i}", None, (note_id, f"page-{i}"))
+        # 格納した直後に、レプリカに反映される前でも取得できる
+        assert redis_box_get(key) == BOXES
+        assert redis_text_get(key)["records"]
+        assert redis_page_fields_get(key, ["boxes"])["boxes"] is not None
+        assert [page_id for page_id, _ in redis_bulk_get(note_id, [f"page-{i}"], "boxes")] == [f"page-{i}"]
+
+
+def test_bulk_get_across_slots():
+    note_ids = [_note_id() for _ in range(8)]
+    for note_id in note_ids:
+        for i in range(3):
+            redis_text_put(make_key(note_id, f"page-{i}"), f"{note_id} page-{i}", None, (note_id, f"page-{i}"))
+
+    if redis_util.redis_mode == "cluster":
+        # 同じノートのキーと索引は同じスロットに入り、ノートが違えばスロットも分かれる
+        for note_id in note_ids:
+            slots = {redis_util.r_client.keyslot(make_key(note_id, f"page-{i}")) for i in range(3)}
+            slots.add(redis_util.r_client.keyslot(note_index_key(note_id)))
+            assert len(slots) == 1
+        assert len({redis_util.r_client.keyslot(note_index_key(note_id)) for note_id in note_ids}) > 1
+
+    for note_id in note_ids:
+        assert [page_id for page_id, _ in redis_bulk_get(note_id, "*", "text")] == ["page-0", "page-1", "page-2"]
+
+    # 索引に別のノート（別のスロット）のキーが登録されていても、1つのパイプラインで取得できる
+    note_id = note_ids[0]
+    redis_util.r_client.hset(note_index_key(note_id), "other", make_key(note_ids[1], "page-0"))
+    pages = dict(redis_bulk_get(note_id, "*", "text"))
+    assert pages["other"] == f"{note_ids[1]} page-0".encode()
+    assert len(pages) == 4
+
+
+def _wait_until(condition) -> bool:
+    deadline = time.monotonic() + NOTIFY_TIMEOUT
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+@pytest.fixture
+def notified(monkeypatch) -> set:
+    """L1キャッシュを有効にし、受信スレッドが通知を受け取れるようになるまで待つ
+
+    NOTE: 受信スレッドは購読を始めたときにキャッシュをすべて破棄するため、購読が始まってからキャッシュに読み込む
+
+    Returns:
+        set: 受信スレッドが通知を受け取ったキー
+    """
+    monkeypatch.setattr(redis_util, "l1_cache_enabled", True)
+    redis_util._subscribe_l1_invalidation()
+
+    received = set()
+    monkeypatch.setattr(result_notifier, "callbacks", [*result_notifier.callbacks, lambda key, _fields: received.add(key)])
+    probe = "probe-" + uuid.uuid4().hex[:8]
+    deadline = time.monotonic() + NOTIFY_TIMEOUT
+    while probe not in received and time.monotonic() < deadline:
+        redis_util.r_client.publish(RESULT_CHANNEL_PREFIX + probe, "boxes")
+        time.sleep(0.1)
+    assert probe in received, "通知を受信できません"
+    return received
+
+
+def test_notification_invalidates_l1_cache(notified):
+    note_id = _note_id()
+    key = make_key(note_id, "page-0")
+    redis_box_put(key, BOXES, (note_id, "page-0"))
+    # 格納の通知（自分の書き込みの分）が届いてからキャッシュに読み込む
+    assert _wait_until(lambda: key in notified)
+    assert redis_box_get(key) == BOXES
+    assert redis_util.l1_cache.get(key, "boxes") is not None
+
+    # 他のワーカーが書き換えたときと同じく、このワーカーのL1キャッシュを直接は削除せずに格納して通知する
+    updated = {"keys": ["objName"], "records": [{"objName": "car"}], "message": None}
+    redis_util.r_client.hset(key, "boxes", redis_util._encode_field("boxes", pack_result(updated)))
+    redis_util.r_client.publish(RESULT_CHANNEL_PREFIX + key, "boxes")
+
+    assert _wait_until(lambda: redis_util.l1_cache.get(key, "boxes") is None)
+    assert redis_box_get(key) == updated
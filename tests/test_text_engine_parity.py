@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# [FILE] test_text_engine_parity.py
+#
+# [DESCRIPTION]
+#  テキスト抽出エンジン（pdfium / pdfplumber）が同じテキスト・表を返すことを確かめる
+#  - 処理時間の比較はbenchmark/bench_text_engine.pyで行う
+#
+import pytest
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfgen import canvas
+
+import util.pdf_cache_util as pdf_cache_util
+from util.text_table_util import TABLE_PAGE_INDEX, TEXT_ENGINES, extract_page_texts, extract_table, extract_texts, run_ocr
+
+pytest.importorskip("pypdfium2")
+
+# 日本語のページに使うフォント（reportlab内蔵のCIDフォント）
+JAPANESE_FONT = "HeiseiKakuGo-W5"
+JAPANESE_LINES = ["点検記録表", "配管の外観に異常はありません。", "ボルトの締付けトルク：４５N・m"]
+
+# 表のページの行数・列数（1行目はヘッダー）
+TABLE_ROWS = 6
+TABLE_COLUMNS = 4
+
+
+def _draw_table(c: canvas.Canvas):
+    """罫線付きの表を描画する"""
+    c.setFont("Helvetica", 10)
+    top = 100 * mm
+    for row in range(TABLE_ROWS + 1):
+        c.line(20 * mm, top - row * 8 * mm, 180 * mm, top - row * 8 * mm)
+    for col in range(TABLE_COLUMNS + 1):
+        c.line((20 + col * 40) * mm, top, (20 + col * 40) * mm, top - TABLE_ROWS * 8 * mm)
+    for row in range(TABLE_ROWS):
+        for col in range(TABLE_COLUMNS):
+            c.drawString((22 + col * 40) * mm, top - row * 8 * mm - 6 * mm, f"r{row}c{col}" if row else f"head{col}")
+
+
+@pytest.fixture(scope="module")
+def sample_pdf(tmp_path_factory) -> str:
+    """英数字・日本語・空白ページ・段組み・表のページを含むPDF（表は抽出対象のTABLE_PAGE_INDEXのページに置く）"""
+    path = str(tmp_path_factory.mktemp("pdf") / "sample.pdf")
+    pdfmetrics.registerFont(UnicodeCIDFont(JAPANESE_FONT))
+    _, height = A4
+    c = canvas.Canvas(path, pagesize=A4)
+
+    c.setFont("Helvetica", 12)
+    for line in range(30):
+        c.drawString(20 * mm, height - (20 + line * 6) * mm, f"Line {line + 1}: item-{line} value={line * 3.5}")
+    c.showPage()
+
+    c.setFont(JAPANESE_FONT, 12)
+    for line, text in enumerate(JAPANESE_LINES):
+        c.drawString(20 * mm, height - (20 + line * 8) * mm, text)
+    c.showPage()
+
+    # テキストレイヤーのないページ
+    c.showPage()
+
+    c.setFont("Helvetica", 10)
+    c.drawString(20 * mm, height - 20 * mm, "Left column text")
+    c.drawString(110 * mm, height - 20 * mm, "Right column text")
+    c.showPage()
+
+    _draw_table(c)
+    c.showPage()
+    c.save()
+    return path
+
+
+@pytest.fixture(autouse=True)
+def empty_page_cache(monkeypatch):
+    """テストごとにレイアウト解析済みページのキャッシュを空にする（エンジン間で解析結果を共有させない）"""
+    cache = pdf_cache_util.PdfPageCache(pdf_cache_util.pdf_cache_max_bytes, pdf_cache_util.pdf_cache_max_documents)
+    monkeypatch.setattr(pdf_cache_util, "pdf_page_cache", cache)
+
+
+def _normalize(text: str) -> str:
+    """改行コード（pdfiumはCRLF）と空白の違いを除く"""
+    return "".join(text.split())
+
+
+def test_page_texts_match(sample_pdf):
+    texts = {engine: extract_page_texts(sample_pdf, engine) for engine in TEXT_ENGINES}
+
+    assert len(texts["pdfium"]) == len(texts["pdfplumber"]) == TABLE_PAGE_INDEX + 1
+    for page, (a, b) in enumerate(zip(texts["pdfium"], texts["pdfplumber"], strict=True)):
+        assert _normalize(a) == _normalize(b), f"page {page + 1}"
+    assert _normalize(texts["pdfium"][1]) == "".join(JAPANESE_LINES)
+    assert texts["pdfium"][2] == texts["pdfplumber"][2] == ""
+
+
+@pytest.mark.parametrize("engine", TEXT_ENGINES)
+def test_page_indexes_select_pages(sample_pdf, engine):
+    all_pages = extract_page_texts(sample_pdf, engine)
+    assert extract_page_texts(sample_pdf, engine, [4, 1]) == [all_pages[4], all_pages[1]]
+
+
+def test_formatted_text_matches(sample_pdf):
+    formatted = {engine: run_ocr(sample_pdf, engine, ocr=False) for engine in TEXT_ENGINES}
+
+    assert formatted["pdfium"] == formatted["pdfplumber"]
+    # 空白ページは[Page N]の番号を進めない
+    assert formatted["pdfium"].count("[Page ") == TABLE_PAGE_INDEX
+
+
+@pytest.mark.parametrize("engine", TEXT_ENGINES)
+def test_table_does_not_depend_on_engine(sample_pdf, engine):
+    # 先にテキストを抽出したエンジンによらず、表の抽出結果は同じになる
+    extract_texts(sample_pdf, engine, ocr=False)
+    table = extract_table(sample_pdf)
+
+    assert table["keys"] == [f"head{col}" for col in range(TABLE_COLUMNS)]
+    assert table["records"] == [{f"head{col}": f"r{row}c{col}" for col in range(TABLE_COLUMNS)} for row in range(1, TABLE_ROWS)]
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# [FILE] test_vision_retry.py
+#
+# [DESCRIPTION]
+#  Cloud Vision APIのOCRクライアント（VISION_BACKEND=rest）の再試行・指数バックオフ・タイムアウトを、
+#  スタブサーバー（benchmark/vision_stub_server.py）に接続して確かめる
+#  - スタブサーバーはポートを開かず、httpxのASGIトランスポートでクライアントのイベントループ上で動かす
+#
+import random
+import time
+
+import httpx
+import pytest
+
+from benchmark import vision_stub_server as stub
+from util import vision_util
+from util.vision_util import RestVisionTransport, RetryableVisionError, VisionError, VisionOcrClient
+
+STUB_ENDPOINT = "http://vision-stub"
+
+# 再試行の初回の待ち時間（秒）
+RETRY_DELAY = 0.1
+
+
+def _stub_transport() -> RestVisionTransport:
+    """スタブサーバーに接続するトランスポート（クライアントのイベントループ上で生成する）"""
+    transport = RestVisionTransport(STUB_ENDPOINT, None)
+    transport.client = httpx.AsyncClient(base_url=STUB_ENDPOINT, transport=httpx.ASGITransport(app=stub.app))
+    return transport
+
+
+@pytest.fixture(autouse=True)
+def stub_settings(monkeypatch):
+    """スタブサーバーの応答時間を短くし、統計を空にする。再試行の待ち時間のジッターをなくす"""
+    monkeypatch.setattr(stub, "STUB_LATENCY", 0.01)
+    monkeypatch.setattr(stub, "STUB_LATENCY_PER_IMAGE", 0.0)
+    monkeypatch.setattr(stub, "STUB_FAILURE_RATE", 0.0)
+    monkeypatch.setattr(stub, "stats", dict.fromkeys(stub.stats, 0))
+    monkeypatch.setattr(vision_util, "vision_retry_delay", RETRY_DELAY)
+    monkeypatch.setattr(vision_util, "vision_max_retries", 3)
+    monkeypatch.setattr(random, "random", lambda: 0.5)
+
+
+@pytest.fixture
+def client():
+    """スタブサーバーに接続するOCRクライアント（テストが終わったらイベントループを止める）"""
+    client = VisionOcrClient(_stub_transport, batch_size=4, max_concurrency=2)
+    yield client
+    client.loop.call_soon_threadsafe(client.loop.stop)
+    client.thread.join(timeout=5)
+
+
+def _fail_first(monkeypatch, count: int) -> list:
+    """最初のcount回のリクエストに503を返す
+
+    Returns:
+        list: リクエストを受け付けた時刻（time.monotonic）
+    """
+    arrivals = []
+    unavailable = stub.JSONResponse(status_code=503, content={"error": {"code": 503, "message": "stub unavailable"}})
+
+    def maybe_fail():
+        arrivals.append(time.monotonic())
+        return unavailable if len(arrivals) <= count else None
+
+    monkeypatch.setattr(stub, "_maybe_fail", maybe_fail)
+    return arrivals
+
+
+def test_images_are_batched_with_bounded_concurrency(client, monkeypatch):
+    monkeypatch.setattr(stub, "STUB_LATENCY", 0.05)
+    texts = client.ocr_images([b"x" * i for i in range(1, 19)])
+
+    assert len(texts) == 18
+    assert stub.stats["requests"] == 5
+    assert stub.stats["max_in_flight"] <= 2
+
+
+def test_retries_transient_errors_with_exponential_backoff(client, monkeypatch):
+    arrivals = _fail_first(monkeypatch, 2)
+
+    assert client.ocr_images([b"image"]) == ["スタブOCRテキスト(8文字のBase64)\n"]
+    assert len(arrivals) == 3
+    # ジッターをなくしているため、待ち時間はRETRY_DELAY、その2倍になる
+    first, second = arrivals[1] - arrivals[0], arrivals[2] - arrivals[1]
+    assert first >= RETRY_DELAY * 0.9
+    assert second >= RETRY_DELAY * 2 * 0.9
+    assert second > first * 1.5
+
+
+def test_gives_up_after_max_retries(client, monkeypatch):
+    arrivals = _fail_first(monkeypatch, 100)
+
+    with pytest.raises(RetryableVisionError):
+        client.ocr_images([b"image"])
+    assert len(arrivals) == vision_util.vision_max_retries + 1
+
+
+def test_file_operation_completes(client, monkeypatch):
+    monkeypatch.setattr(stub, "STUB_OPERATION_SECONDS", 0.2)
+
+    assert client.detect_document("gs://bucket/in.pdf", "gs://bucket/out/") is None
+
+
+def test_file_operation_times_out(client, monkeypatch):
+    monkeypatch.setattr(stub, "STUB_OPERATION_SECONDS", 60.0)
+    monkeypatch.setattr(vision_util, "vision_timeout", 0.3)
+
+    start = time.monotonic()
+    with pytest.raises(VisionError, match="タイムアウト"):
+        client.detect_document("gs://bucket/in.pdf", "gs://bucket/out/")
+    # タイムアウトは再試行しない
+    assert time.monotonic() - start < 5
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# [FILE] admission_util.py
+#
+# [DESCRIPTION]
+#  リクエストを優先度のクラスに分け、クラスごとの同時実行数を制限する（アドミッション制御）
+#  - interactive: 格納済みの結果の取得（軽い処理。推論の実行枠は使わない）
+#  - inference: 1枚の画像の物体検出・セグメンテーション
+#  - bulk: PDFのテキスト・表の抽出、PDFの全ページの物体検出
+#  inferenceとbulkは推論の実行枠（ADMISSION_INFERENCE_SLOTS）を共有し、空いた枠はinferenceの待ちに先に割り当てる
+#  待ち行列が上限を超えた場合や、待ち時間の上限を過ぎた場合は実行せずに503を返す（ロードシェディング）
+#
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+from util.metrics_util import increment, observe
+
+load_dotenv()
+
+# 優先度の高い順のクラス
+PRIORITY_CLASSES = ["interactive", "inference", "bulk"]
+
+# 推論の実行枠を使うクラス
+INFERENCE_CLASSES = {"inference", "bulk"}
+
+
+def _parse_class_values(value: str, default: dict, cast) -> dict:
+    """クラスごとの値の指定（例：interactive:64,inference:2,bulk:1）を辞書に変換する"""
+    values = dict(default)
+    for part in value.split(","):
+        if ":" in part:
+            name, number = part.split(":")
+            values[name.strip()] = cast(number)
+    return values
+
+
+# アドミッション制御をするか（1: する, 0: しない）
+admission_enabled = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+
+# クラスごとの同時実行数の上限
+admission_limits = _parse_class_values(
+    os.environ.get("ADMISSION_LIMITS", ""), {"interactive": 64, "inference": 2, "bulk": 1}, int
+)
+
+# inferenceとbulkで共有する推論の実行枠（ワーカーごと）
+admission_inference_slots = int(os.environ.get("ADMISSION_INFERENCE_SLOTS", "2"))
+
+# クラスごとの待ち行列の長さの上限（超えたリクエストはすぐに503を返す）
+admission_max_queue = _parse_class_values(
+    os.environ.get("ADMISSION_MAX_QUEUE", ""), {"interactive": 256, "inference": 16, "bulk": 4}, int
+)
+
+# クラスごとの待ち時間の上限（秒）。過ぎたリクエストは503を返す
+admission_queue_timeouts = _parse_class_values(
+    os.environ.get("ADMISSION_QUEUE_TIMEOUTS", ""), {"interactive": 5.0, "inference": 30.0, "bulk": 120.0}, float
+)
+
+# 503で返すRetry-After（秒）
+admission_retry_after = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+
+
+class AdmissionRejected(Exception):
+    """待ち行列がいっぱい、または待ち時間の上限を過ぎたため、リクエストを実行しない"""
+
+    def __init__(self, priority: str, reason: str):
+        super().__init__(f"{priority}: {reason}")
+        self.priority = priority
+        self.reason = reason
+
+
+class AdmissionController:
+    """クラスごとの同時実行数と、推論の実行枠を優先度の順に割り当てる
+
+    NOTE: ワーカーのイベントループ上でだけ使う（ロックは不要）
+    """
+
+    def __init__(self, limits: dict, inference_slots: int, max_queue: dict, queue_timeouts: dict):
+        self.limits = limits
+        self.inference_slots = inference_slots
+        self.max_queue = max_queue
+        self.queue_timeouts = queue_timeouts
+        self.running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.inference_running = 0
+        self.queues = {priority: deque() for priority in PRIORITY_CLASSES}  # {クラス: 実行枠を待つFutureの待ち行列}
+
+    def _can_run(self, priority: str) -> bool:
+        if self.running[priority] >= self.limits[priority]:
+            return False
+        return priority not in INFERENCE_CLASSES or self.inference_running < self.inference_slots
+
+    def _grant(self, priority: str):
+        self.running[priority] += 1
+        if priority in INFERENCE_CLASSES:
+            self.inference_running += 1
+
+    def _release(self, priority: str):
+        self.running[priority] -= 1
+        if priority in INFERENCE_CLASSES:
+            self.inference_running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """空いた実行枠を、優先度の高いクラスの待ち行列の先頭から割り当てる"""
+        for priority in PRIORITY_CLASSES:
+            queue = self.queues[priority]
+            while queue and self._can_run(priority):
+                waiter = queue.popleft()
+                if not waiter.done():
+                    self._grant(priority)
+                    waiter.set_result(None)
+
+    async def _acquire(self, priority: str):
+        queue = self.queues[priority]
+        if not queue and self._can_run(priority):
+            self._grant(priority)
+            return
+
+        if len(queue) >= self.max_queue[priority]:
+            raise AdmissionRejected(priority, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeouts[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # 実行枠を割り当てられた直後に待ちを打ち切った場合は、枠を返す
+                self._release(priority)
+            else:
+                waiter.cancel()
+                if waiter in queue:
+                    queue.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected(priority, "queue_timeout") from None
+            raise
+
+    @asynccontextmanager
+    async def admit(self, priority: str):
+        """実行枠を取得してから処理を実行する
+
+        NOTE: 待ち時間（admission.<クラス>.queue_seconds）と実行時間（admission.<クラス>.exec_seconds）を別々に記録する
+
+        Args:
+            priority (str): interactive / inference / bulk
+
+        Raises:
+            AdmissionRejected: 待ち行列がいっぱい、または待ち時間の上限を過ぎた場合
+        """
+        start = time.perf_counter()
+        try:
+            await self._acquire(priority)
+        except AdmissionRejected as e:
+            increment(f"admission.{priority}.rejected.{e.reason}")
+            raise
+        started = time.perf_counter()
+        observe(f"admission.{priority}.queue_seconds", started - start)
+        increment(f"admission.{priority}.admitted")
+        try:
+            yield
+        finally:
+            observe(f"admission.{priority}.exec_seconds", time.perf_counter() - started)
+            self._release(priority)
+
+    def report(self) -> dict:
+        """クラスごとの実行中・待ち中のリクエスト数と上限を取得する"""
+        return {
+            priority: {
+                "running": self.running[priority],
+                "queued": len(self.queues[priority]),
+                "limit": self.limits[priority],
+                "maxQueue": self.max_queue[priority],
+                "queueTimeout": self.queue_timeouts[priority],
+            }
+            for priority in PRIORITY_CLASSES
+        } | {"inferenceSlots": {"running": self.inference_running, "limit": self.inference_slots}}
+
+
+# ワーカーごとのアドミッション制御
+admission_controller = AdmissionController(
+    admission_limits, admission_inference_slots, admission_max_queue, admission_queue_timeouts
+)
+
+
+@asynccontextmanager
+async def admission(priority: str):
+    """優先度のクラスの実行枠を取得してから処理を実行する（ADMISSION_ENABLED=0の場合は制限しない）
+
+    Args:
+        priority (str): interactive / inference / bulk
+
+    Raises:
+        AdmissionRejected: 待ち行列がいっぱい、または待ち時間の上限を過ぎた場合
+    """
+    if not admission_enabled:
+        yield
+        return
+    async with admission_controller.admit(priority):
+        yield
+
+
+def admission_report() -> dict:
+    """アドミッション制御の状態を取得する（/rest/admin/metricsで返す）"""
+    return {"enabled": admission_enabled, **admission_controller.report()}
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+#
+# [FILE] compression_util.py
+#
+# [DESCRIPTION]
+#  レスポンスの圧縮と、圧縮されたリクエストボディの展開を行うASGIミドルウェア
+#  - レスポンスはAccept-Encodingに応じてzstd・br・gzipのいずれかで圧縮する（一定サイズ未満や圧縮済みの形式は圧縮しない）
+#  - StreamingResponse（報告書のPDFなど）は、チャンクごとに圧縮してフラッシュしながら送る
+#  - /rest/*のリクエストボディはContent-Encodingに応じて展開し、展開後のサイズの上限を超えたら413を返す（圧縮爆弾対策）
+#  - 大きなボディの圧縮・展開はスレッドで行い、イベントループを止めない
+#  - エンドポイントごとに、圧縮・展開の前後のバイト数とCPU時間をメトリクスに記録する
+#
+import io
+import os
+import time
+import zlib
+
+import anyio
+from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders
+
+from util.metrics_util import increment, observe
+from util.response_util import FastJSONResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 出力の上限を指定して展開できるか（Decompressor.can_accept_more_data・process(output_buffer_limit=...)はbrotli 1.2以降）
+brotli_bounded = brotli is not None and hasattr(brotli.Decompressor, "can_accept_more_data")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+# レスポンスを圧縮するか（1: する, 0: しない）と、圧縮するレスポンスの最小サイズ（バイト）
+compression_enabled = os.environ.get("COMPRESSION_ENABLED", "1") == "1"
+compression_min_bytes = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+
+# 使う圧縮方式（クライアントの優先度が同じ場合は、先に書いたものを使う）
+compression_encodings = [
+    encoding.strip() for encoding in os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if encoding.strip()
+]
+
+# 圧縮レベル
+compression_gzip_level = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+compression_brotli_quality = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "5"))
+compression_zstd_level = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+
+# 展開後のリクエストボディのサイズの上限（バイト、既定は256MB）
+request_max_decompressed_bytes = int(os.environ.get("REQUEST_MAX_DECOMPRESSED_BYTES", "268435456"))
+
+# このサイズ（バイト）以上のボディの圧縮・展開は、イベントループを止めないようスレッドで行う
+# （展開は、展開後のサイズがこれを超えた時点でスレッドでやり直す）
+compression_thread_min_bytes = int(os.environ.get("COMPRESSION_THREAD_MIN_BYTES", "262144"))
+
+# 圧縮するレスポンスの種類（画像は圧縮済み。SSEは通知をすぐに届けるため圧縮しない）
+COMPRESSIBLE_TYPES = ("application/json", "application/pdf", "text/html", "text/plain", "text/css", "application/javascript")
+
+# 展開するときに一度に取り出す最大のサイズ（バイト）
+DECOMPRESS_CHUNK_BYTES = 64 * 1024
+
+# zstdを展開するときに一度に読み込む入力のサイズ（バイト）
+# NOTE: stream_readerは1回の出力をreadに渡したサイズ（DECOMPRESS_CHUNK_BYTES）までに抑えるため、入力は大きく読み込める
+ZSTD_INPUT_CHUNK_BYTES = 128 * 1024
+
+
+def _available_encodings() -> list:
+    """インストールされているライブラリで使える圧縮方式"""
+    available = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+    return [encoding for encoding in compression_encodings if available.get(encoding)]
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Accept-Encodingから圧縮方式を選ぶ
+
+    Args:
+        accept_encoding (str): Accept-Encodingヘッダー（例：gzip, br;q=0.9）
+
+    Returns:
+        str | None: 選んだ圧縮方式（使える方式がなければNone）
+    """
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        if params.strip().startswith("q="):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip()] = weight
+
+    candidates = [
+        (weights.get(encoding, weights.get("*", 0.0)), -order, encoding) for order, encoding in enumerate(_available_encodings())
+    ]
+    candidates = [candidate for candidate in candidates if candidate[0] > 0]
+    return max(candidates)[2] if candidates else None
+
+
+# ==================================================================================================
+# 圧縮・展開
+# ==================================================================================================
+
+
+class _Compressor:
+    """圧縮方式ごとの差を吸収する（compress: 圧縮, flush: ここまでを送れるようにする, finish: 終了）"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(compression_gzip_level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self.compressor = brotli.Compressor(quality=compression_brotli_quality)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=compression_zstd_level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "gzip":
+            return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self.compressor.flush()
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class PayloadTooLarge(Exception):
+    """展開後のリクエストボディがサイズの上限を超えた"""
+
+
+def _check_size(total: int, limit: int):
+    if total > limit:
+        raise PayloadTooLarge(f"展開後のサイズが上限({limit}バイト)を超えました")
+
+
+def _zstd_frame_complete(data: bytes) -> bool:
+    """zstdのフレームが最後のブロック（とチェックサム）まで揃っているか、ブロックのヘッダーだけをたどって確かめる
+
+    NOTE: stream_readerは途中で切れたフレームでもエラーにならないため、展開した後に確かめる
+    """
+    try:
+        position = zstandard.frame_header_size(data)
+        has_checksum = zstandard.get_frame_parameters(data).has_checksum
+    except zstandard.ZstdError:
+        return False
+    while position + 3 <= len(data):
+        # ブロックのヘッダー（3バイト）: 最後のブロックか（1ビット）、種類（2ビット）、サイズ（21ビット）
+        header = int.from_bytes(data[position : position + 3], "little")
+        block_type, block_size = (header >> 1) & 3, header >> 3
+        # RLEブロック（種類1）の本体は1バイトで、サイズは展開後のバイト数
+        position += 3 + (1 if block_type == 1 else block_size)
+        if header & 1:
+            return position + (4 if has_checksum else 0) <= len(data)
+    return False
+
+
+def decompress_body(data: bytes, encoding: str, limit: int) -> bytes:
+    """リクエストボディを展開する（少しずつ取り出し、上限を超えた時点で中止する）
+
+    Args:
+        data (bytes): 圧縮されたボディ
+        encoding (str): gzip・deflate・br・zstd のいずれか
+        limit (int): 展開後のサイズの上限（バイト）
+
+    Returns:
+        bytes: 展開したボディ
+
+    Raises:
+        PayloadTooLarge: 展開後のサイズが上限を超えた場合
+        ValueError: 対応していない圧縮方式の場合、または壊れたデータの場合
+    """
+    chunks, total = [], 0
+
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        # 出力の最大サイズを指定して展開し、残りの入力はunconsumed_tailから続ける
+        decompressor = zlib.decompressobj(31 if encoding != "deflate" else 15)
+        pending = data
+        try:
+            while not decompressor.eof:
+                chunk = decompressor.decompress(pending, DECOMPRESS_CHUNK_BYTES)
+                pending = decompressor.unconsumed_tail
+                if not chunk and not pending:
+                    raise ValueError("圧縮データが途中で終わっています")
+                total += len(chunk)
+                _check_size(total, limit)
+                chunks.append(chunk)
+        except zlib.error as e:
+            raise ValueError(f"圧縮データを展開できません: {e}") from None
+        return b"".join(chunks)
+
+    if encoding == "br" and brotli is not None:
+        if not brotli_bounded:
+            raise ValueError("対応していない圧縮方式です: br（展開にはbrotli 1.2以降が必要です）")
+        # 出力バッファの上限を指定して展開する（brotli 1.2以降）
+        decompressor = brotli.Decompressor()
+        position = 0
+        try:
+            while not decompressor.is_finished():
+                piece = b""
+                if decompressor.can_accept_more_data():
+                    piece = data[position : position + DECOMPRESS_CHUNK_BYTES]
+                    position += len(piece)
+                chunk = decompressor.process(piece, output_buffer_limit=DECOMPRESS_CHUNK_BYTES)
+                if not chunk and not piece and decompressor.can_accept_more_data():
+                    raise ValueError("圧縮データが途中で終わっています")
+                total += len(chunk)
+                _check_size(total, limit)
+                chunks.append(chunk)
+        except brotli.error as e:
+            raise ValueError(f"圧縮データを展開できません: {e}") from None
+        return b"".join(chunks)
+
+    if encoding == "zstd" and zstandard is not None:
+        # フレームのヘッダーに書かれたサイズは信用せず、取り出した量で上限を確かめる
+        # 最初のフレームだけを展開し、最後にフレームが揃っているかを確かめ、途中で切れたデータは受け付けない
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_size=ZSTD_INPUT_CHUNK_BYTES, read_across_frames=False
+        )
+        try:
+            while chunk := reader.read(DECOMPRESS_CHUNK_BYTES):
+                total += len(chunk)
+                _check_size(total, limit)
+                chunks.append(chunk)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"圧縮データを展開できません: {e}") from None
+        if not _zstd_frame_complete(data):
+            raise ValueError("圧縮データが途中で終わっています")
+        return b"".join(chunks)
+
+    raise ValueError(f"対応していない圧縮方式です: {encoding}")
+
+
+# ==================================================================================================
+# ミドルウェア
+# ==================================================================================================
+
+
+def _decompress_timed(data: bytes, encoding: str, limit: int) -> tuple:
+    """decompress_bodyで展開し、展開したボディと展開にかかったCPU時間（秒）を返す"""
+    start = time.thread_time()
+    body = decompress_body(data, encoding, limit)
+    return body, time.thread_time() - start
+
+
+def _record(direction: str, path: str, in_bytes: int, out_bytes: int, cpu_seconds: float):
+    """圧縮・展開の前後のバイト数とCPU時間を記録する（/rest/admin/metricsで確認する）"""
+    prefix = f"compression.{direction}.{path}"
+    increment(prefix + ".in_bytes", in_bytes)
+    increment(prefix + ".out_bytes", out_bytes)
+    observe(prefix + ".cpu_seconds", cpu_seconds)
+
+
+class _CompressingSender:
+    """アプリが送るレスポンスを圧縮してから送る"""
+
+    def __init__(self, send, encoding: str, path: str):
+        self.send = send
+        self.encoding = encoding
+        self.path = path
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+        self.in_bytes = 0
+        self.out_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def _compress(self, body: bytes, more_body: bool) -> bytes:
+        start = time.thread_time()
+        data = self.compressor.compress(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+        self.cpu_seconds += time.thread_time() - start
+        self.in_bytes += len(body)
+        self.out_bytes += len(data)
+        if not more_body:
+            _record("response", self.path, self.in_bytes, self.out_bytes, self.cpu_seconds)
+        return data
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            # 最初のボディを見てから圧縮するか決めるため、ヘッダーの送信を遅らせる
+            self.start = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            headers = MutableHeaders(raw=self.start["headers"])
+            content_type = headers.get("content-type", "")
+            if (
+                "content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+                or (not more_body and len(body) < compression_min_bytes)
+            ):
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+
+            self.compressor = _Compressor(self.encoding)
+            data = await self._compress_async(body, more_body)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                # ストリーミングでは全体のサイズが分からないため、チャンク転送にする
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(data))
+            await self.send(self.start)
+            self.start = None
+            await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+            return
+
+        data = await self._compress_async(body, more_body)
+        await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    async def _compress_async(self, body: bytes, more_body: bool) -> bytes:
+        """大きなボディは、イベントループを止めないようスレッドで圧縮する"""
+        if len(body) >= compression_thread_min_bytes:
+            return await anyio.to_thread.run_sync(self._compress, body, more_body)
+        return self._compress(body, more_body)
+
+
+class CompressionMiddleware:
+    """レスポンスの圧縮とリクエストボディの展開を行う"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if path.startswith("/rest/") and content_encoding != "identity":
+            decoded = await self._decompress_request(scope, receive, send, content_encoding)
+            if decoded is None:
+                return
+            scope, receive = decoded
+
+        encoding = negotiate_encoding(headers.get("accept-encoding", "")) if compression_enabled else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSender(send, encoding, path))
+
+    async def _decompress_request(self, scope, receive, send, encoding: str):
+        """圧縮されたリクエストボディを読み込んで展開し、展開したボディを渡すscopeとreceiveを返す
+
+        NOTE: 圧縮されたボディ自体もサイズの上限まで読み込む。上限を超えた場合・展開できない場合はエラーを返してNoneを返す
+        """
+        received, total = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body = message.get("body", b"")
+            total += len(body)
+            if total > request_max_decompressed_bytes:
+                await self._error(scope, receive, send, 413, "リクエストボディが大きすぎます")
+                return None
+            received.append(body)
+            if not message.get("more_body", False):
+                break
+        raw = b"".join(received)
+
+        try:
+            body, cpu_seconds = await self._decompress(raw, encoding)
+        except PayloadTooLarge as e:
+            await self._error(scope, receive, send, 413, str(e))
+            return None
+        except ValueError as e:
+            status = 415 if "対応していない" in str(e) else 400
+            await self._error(scope, receive, send, status, str(e))
+            return None
+        _record("request", scope["path"], len(raw), len(body), cpu_seconds)
+
+        headers = MutableHeaders(scope={"type": "http", "headers": list(scope["headers"])})
+        del headers["Content-Encoding"]
+        headers["Content-Length"] = str(len(body))
+        scope = {**scope, "headers": headers.raw}
+
+        delivered = False
+
+        async def receive_decompressed():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return scope, receive_decompressed
+
+    @staticmethod
+    async def _decompress(raw: bytes, encoding: str) -> tuple:
+        """リクエストボディを展開する（大きなボディはスレッドで展開する）
+
+        NOTE: 圧縮されたボディが小さくても展開後は大きくなり得るため、イベントループでは展開後の
+              COMPRESSION_THREAD_MIN_BYTESまでだけ展開し、超えた場合はスレッドで最初から展開し直す
+
+        Returns:
+            tuple: (展開したボディ, 展開にかかったCPU時間（秒）)
+        """
+        limit = request_max_decompressed_bytes
+        if len(raw) < compression_thread_min_bytes < limit:
+            try:
+                return _decompress_timed(raw, encoding, compression_thread_min_bytes)
+            except PayloadTooLarge:
+                pass
+        return await anyio.to_thread.run_sync(_decompress_timed, raw, encoding, limit)
+
+    @staticmethod
+    async def _error(scope, receive, send, status: int, message: str) -> None:
+        print(f"[COMPRESSION] {scope['path']}: {message}")
+        await FastJSONResponse(status_code=status, content={"message": message})(scope, receive, send)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# [FILE] cpu_util.py
+#
+# [DESCRIPTION]
+#  推論エンジン（YOLO・SAM）が使うCPUスレッド数と、ワーカーごとのCPUアフィニティを設定する
+#  複数のワーカーがそれぞれ全コアを使おうとしてCPUを奪い合わないようにする
+#
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import torch
+from dotenv import load_dotenv
+
+from util.util import web_concurrency
+
+load_dotenv()
+
+# ワーカー数（gunicornのWEB_CONCURRENCY）
+worker_count = web_concurrency()
+
+
+def _available_cpus() -> list:
+    """このプロセスが使えるCPUの番号を取得する"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpus(value: str) -> list:
+    """CPUの番号の指定（例：0-3,8,10-11）をリストに変換する"""
+    cpus = []
+    for part in value.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+# 起動時に使えるCPU（アフィニティを設定する前の状態）
+initial_cpus = _available_cpus()
+
+# 推論のスレッド数（未設定の場合は、使えるCPUをワーカー数で等分する）
+intra_op_threads = int(os.environ.get("TORCH_INTRA_OP_THREADS", max(1, len(initial_cpus) // worker_count)))
+inter_op_threads = int(os.environ.get("TORCH_INTER_OP_THREADS", "1"))
+
+# エンジンごとの推論のスレッド数（未設定の場合はTORCH_INTRA_OP_THREADS）
+ENGINE_THREADS = {
+    "yolo": int(os.environ.get("YOLO_NUM_THREADS", intra_op_threads)),
+    "sam": int(os.environ.get("SAM_NUM_THREADS", intra_op_threads)),
+    "qa": int(os.environ.get("QA_NUM_THREADS", intra_op_threads)),
+}
+
+# CPUアフィニティ（空: 設定しない / auto: ワーカー番号に応じてCPUを等分して割り当てる / 0-3,8: 指定したCPUに固定する）
+cpu_affinity = os.environ.get("CPU_AFFINITY", "")
+
+# エンジンごとにスレッド数を切り替えるか（どれかのエンジンのスレッド数がTORCH_INTRA_OP_THREADSと異なる場合）
+engine_threads_override = any(threads != intra_op_threads for threads in ENGINE_THREADS.values())
+
+# スレッド数の切り替えはプロセス全体に影響するため、切り替える場合は推論を1つずつ実行する
+# NOTE: 各エンジンのロック（detector_lock・sam_lock・qa_lock）の内側で取るため、ロックの順序は常に同じになる
+_engine_lock = threading.RLock()
+
+
+def configure_cpu(worker_index: int | None = None) -> dict:
+    """推論のスレッド数とCPUアフィニティを設定する（ワーカーの起動時に1回呼び出す）
+
+    Args:
+        worker_index (int | None): ワーカー番号（0始まり）。CPU_AFFINITY=autoの場合に使う
+
+    Returns:
+        dict: 設定後の状態（cpu_reportの結果）
+    """
+    if cpu_affinity and hasattr(os, "sched_setaffinity"):
+        cpus = None
+        if cpu_affinity != "auto":
+            cpus = _parse_cpus(cpu_affinity)
+        elif worker_index is not None:
+            # ワーカー番号に応じて、起動時に使えたCPUを連続したブロックに等分して割り当てる
+            # （マスタープロセスはワーカー番号がないため設定しない）
+            per_worker = max(1, len(initial_cpus) // worker_count)
+            start = (worker_index % worker_count) * per_worker
+            cpus = initial_cpus[start : start + per_worker] or initial_cpus
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError as e:
+        # 並列処理を一度でも実行した後は変更できない
+        print("[CPU] inter-opスレッド数を変更できません:", e)
+    cv2.setNumThreads(intra_op_threads)
+
+    report = cpu_report(worker_index)
+    print("[CPU]", report)
+    return report
+
+
+@contextmanager
+def engine_threads(engine: str):
+    """エンジンごとに設定したスレッド数で推論する
+
+    NOTE: torch.set_num_threadsはプロセス全体に効くため、エンジンごとに切り替えると、別のロックで同時に動く
+          他のエンジンのスレッド数まで変わってしまう。そのため、すべてのエンジンのスレッド数が同じ場合は
+          起動時の設定のまま推論し、異なる場合だけ、すべての推論を1つずつ実行してスレッド数を切り替える
+
+    Args:
+        engine (str): yolo・sam・qa のいずれか
+    """
+    if not engine_threads_override:
+        yield
+        return
+
+    with _engine_lock:
+        previous = torch.get_num_threads()
+        torch.set_num_threads(ENGINE_THREADS[engine])
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
+
+
+def cpu_report(worker_index: int | None = None) -> dict:
+    """実際に有効になっているCPUの設定を取得する（起動時のセルフチェックに使う）
+
+    Args:
+        worker_index (int | None): ワーカー番号
+
+    Returns:
+        dict: CPUの設定
+    """
+    return {
+        "pid": os.getpid(),
+        "workerIndex": worker_index,
+        "workers": worker_count,
+        "cpuCount": os.cpu_count(),
+        "affinity": _available_cpus(),
+        "torchIntraOpThreads": torch.get_num_threads(),
+        "torchInterOpThreads": torch.get_num_interop_threads(),
+        "engineThreads": dict(ENGINE_THREADS),
+        "opencvThreads": cv2.getNumThreads(),
+        "ompNumThreads": os.environ.get("OMP_NUM_THREADS"),
+    }
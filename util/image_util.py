@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# [FILE] image_util.py
+#
+# [DESCRIPTION]
+#  アップロードされた画像を推論用に前処理する（物体検出とセグメンテーションで共通）
+#  - JPEGはドラフトモードで縮小しながらデコードし、カメラの解像度のまま展開しない
+#  - EXIFの向き（タブレットで撮影した写真の回転）を反映する
+#  - アスペクト比を保って縮小し、正方形の再利用するバッファに余白を付けて配置する（レターボックス）
+#
+import io
+import os
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+load_dotenv()
+
+# 前処理後の画像の一辺（ピクセル）。これより大きい画像は縮小する
+image_preprocess_size = int(os.environ.get("IMAGE_PREPROCESS_SIZE", "1024"))
+
+# EXIFの向きのタグと、90度回転している（幅と高さが入れ替わる）向きの値
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+# レターボックスの余白の色（BGR）
+LETTERBOX_COLOR = (114, 114, 114)
+
+# スレッドごとに再利用するバッファ
+_buffers = threading.local()
+
+
+@dataclass
+class PreprocessedImage:
+    """前処理した画像と、元の画像の座標に戻すための情報"""
+
+    array: np.ndarray  # レターボックスした画像（size×size×3, BGR）
+    width: int  # 元の画像（EXIFの向きを反映した後）の幅
+    height: int  # 元の画像（EXIFの向きを反映した後）の高さ
+    content_width: int  # レターボックス内の画像の幅
+    content_height: int  # レターボックス内の画像の高さ
+    pad_x: int  # 左の余白
+    pad_y: int  # 上の余白
+
+    @property
+    def scale(self) -> float:
+        """元の画像からの縮小率"""
+        return self.content_width / self.width
+
+    def crop(self, image: np.ndarray) -> np.ndarray:
+        """前処理後の画像と同じ座標系の画像（検出結果を描画した画像など）から余白を取り除く"""
+        return image[self.pad_y : self.pad_y + self.content_height, self.pad_x : self.pad_x + self.content_width]
+
+    def to_original(self, detected: dict) -> dict:
+        """検出結果の座標を元の画像の座標に変換する
+
+        Args:
+            detected (dict): 物体検出結果（JSON形式）。recordsのtopX, topY, bottomX, bottomYを書き換える
+
+        Returns:
+            dict: 変換した検出結果
+        """
+        for record in detected.get("records", []):
+            for key, pad, limit in (
+                ("topX", self.pad_x, self.width),
+                ("bottomX", self.pad_x, self.width),
+                ("topY", self.pad_y, self.height),
+                ("bottomY", self.pad_y, self.height),
+            ):
+                record[key] = min(max(round((record[key] - pad) / self.scale), 0), limit)
+        return detected
+
+
+def _get_buffer(size: int) -> np.ndarray:
+    """スレッドごとのレターボックス用のバッファを取得する（サイズが変わらない限り再利用する）"""
+    buffer = getattr(_buffers, "letterbox", None)
+    if buffer is None or buffer.shape[0] != size:
+        buffer = np.empty((size, size, 3), dtype=np.uint8)
+        _buffers.letterbox = buffer
+    return buffer
+
+
+def decode_image(binary: bytes, size: int) -> tuple:
+    """画像をデコードし、EXIFの向きを反映する
+
+    NOTE: JPEGはデコード前にドラフトモードを指定し、長辺がsize以上になる範囲で1/2・1/4・1/8に縮小して展開する
+
+    Args:
+        binary (bytes): 画像ファイルのバイナリ
+        size (int): 必要な長辺のサイズ（ピクセル）
+
+    Returns:
+        tuple: (デコードした画像（RGB）, EXIFの向きを反映した元の画像の(幅, 高さ))
+    """
+    image = Image.open(io.BytesIO(binary))
+    width, height = image.size
+    if image.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+        width, height = height, width
+
+    if image.format == "JPEG":
+        scale = size / max(image.size)
+        if scale < 1:
+            image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+    image = ImageOps.exif_transpose(image)
+    return image.convert("RGB"), (width, height)
+
+
+def letterbox(image: np.ndarray, size: int) -> tuple:
+    """画像（RGB）をアスペクト比を保って縮小し、正方形のバッファ（BGR）の中央に配置する
+
+    NOTE: 返す配列はスレッドごとに再利用するバッファのため、同じスレッドで次に前処理するまでに使い終えること
+
+    Args:
+        image (np.ndarray): 画像（高さ×幅×3, RGB）
+        size (int): 正方形の一辺（ピクセル）
+
+    Returns:
+        tuple: (レターボックスした画像, 縮小後の幅, 縮小後の高さ, 左の余白, 上の余白)
+    """
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height, 1.0)
+    content_width, content_height = round(width * scale), round(height * scale)
+    if scale < 1:
+        image = cv2.resize(image, (content_width, content_height), interpolation=cv2.INTER_AREA)
+
+    pad_x = (size - content_width) // 2
+    pad_y = (size - content_height) // 2
+    buffer = _get_buffer(size)
+    buffer[:pad_y] = LETTERBOX_COLOR
+    buffer[pad_y + content_height :] = LETTERBOX_COLOR
+    buffer[pad_y : pad_y + content_height, :pad_x] = LETTERBOX_COLOR
+    buffer[pad_y : pad_y + content_height, pad_x + content_width :] = LETTERBOX_COLOR
+    buffer[pad_y : pad_y + content_height, pad_x : pad_x + content_width] = image[:, :, ::-1]  # RGB→BGR
+    return buffer, content_width, content_height, pad_x, pad_y
+
+
+def preprocess_image(binary: bytes, size: int | None = None) -> PreprocessedImage:
+    """アップロードされた画像を推論用に前処理する
+
+    Args:
+        binary (bytes): 画像ファイルのバイナリ
+        size (int | None): 前処理後の画像の一辺（ピクセル）。Noneの場合は環境変数IMAGE_PREPROCESS_SIZE
+
+    Returns:
+        PreprocessedImage: 前処理した画像
+
+    Raises:
+        OSError: 画像として読み込めない場合（PIL.UnidentifiedImageErrorを含む）
+    """
+    size = size or image_preprocess_size
+    image, (width, height) = decode_image(binary, size)
+    array, content_width, content_height, pad_x, pad_y = letterbox(np.asarray(image), size)
+    # 座標は、ドラフトモードで縮小してデコードする前の画像を基準に戻す
+    return PreprocessedImage(array, width, height, content_width, content_height, pad_x, pad_y)
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 90) -> bytes:
+    """画像（BGR）をJPEGに変換する"""
+    _, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes()
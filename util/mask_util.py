@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# [FILE] mask_util.py
+#
+# [DESCRIPTION]
+#  セグメンテーション（SAM）のマスクを、ランレングス符号（RLE）・多角形・面積・外接矩形に変換する
+#  マスクを描画した画像は格納せず、取得時にRLEから描画する
+#
+import cv2
+import numpy as np
+
+# マスクを描画する色（BGR）
+MASK_COLORS = [
+    (56, 56, 255),
+    (151, 157, 255),
+    (31, 112, 255),
+    (29, 178, 255),
+    (49, 210, 207),
+    (10, 249, 72),
+    (23, 204, 146),
+    (134, 219, 61),
+    (52, 147, 26),
+    (187, 212, 0),
+    (168, 153, 44),
+    (255, 194, 0),
+    (147, 69, 52),
+    (255, 115, 100),
+    (236, 24, 0),
+    (255, 56, 132),
+]
+
+
+def encode_rle(mask: np.ndarray) -> dict:
+    """マスクをランレングス符号に変換する
+
+    NOTE: COCO形式と同じく、列優先で走査し、0（背景）の連続数から始めて0と1の連続数を交互に並べる
+
+    Args:
+        mask (np.ndarray): マスク（高さ×幅, bool）
+
+    Returns:
+        dict: {'size': [高さ, 幅], 'counts': [0の連続数, 1の連続数, ...]}
+    """
+    height, width = mask.shape
+    flat = mask.ravel(order="F").astype(np.int8)
+    if flat.size == 0:
+        return {"size": [height, width], "counts": []}
+    boundaries = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": [height, width], "counts": counts.tolist()}
+
+
+def decode_rle(rle: dict) -> np.ndarray:
+    """ランレングス符号をマスクに戻す
+
+    Args:
+        rle (dict): {'size': [高さ, 幅], 'counts': [...]}
+
+    Returns:
+        np.ndarray: マスク（高さ×幅, bool）
+    """
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape((height, width), order="F")
+
+
+def mask_polygons(mask: np.ndarray, tolerance: float, scale: float = 1.0) -> list:
+    """マスクの輪郭を単純化した多角形に変換する
+
+    Args:
+        mask (np.ndarray): マスク（高さ×幅, bool）
+        tolerance (float): 単純化で許容する誤差（ピクセル）。0の場合は単純化しない
+        scale (float): マスクの縮小率（座標をscaleで割って元の画像の座標にする）
+
+    Returns:
+        list: 多角形のリスト。多角形は[x1, y1, x2, y2, ...]
+    """
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in contours:
+        if tolerance > 0:
+            contour = cv2.approxPolyDP(contour, tolerance, True)
+        if len(contour) < 3:
+            continue
+        polygons.append(np.round(contour.reshape(-1) / scale).astype(int).tolist())
+    return polygons
+
+
+def mask_bbox(mask: np.ndarray) -> tuple:
+    """マスクの外接矩形を求める
+
+    Returns:
+        tuple: (左上のX, 左上のY, 右下のX, 右下のY)。マスクが空の場合は(0, 0, 0, 0)
+    """
+    columns = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    if columns.size == 0:
+        return 0, 0, 0, 0
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def render_overlay(rles: list, background: np.ndarray | None = None, alpha: float = 0.5) -> np.ndarray:
+    """マスクを色分けして描画する
+
+    Args:
+        rles (list): マスクのランレングス符号のリスト
+        background (np.ndarray | None): 背景の画像（BGR）。マスクと大きさが異なる場合は、マスクを背景の大きさに合わせる。
+            Noneの場合は透明な背景（BGRA）に描画する
+        alpha (float): マスクの不透明度
+
+    Returns:
+        np.ndarray: 描画した画像（背景がある場合はBGR、ない場合はBGRA）
+    """
+    if not rles:
+        return background
+    height, width = rles[0]["size"]
+    if background is None:
+        canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    else:
+        canvas = background.copy()
+        height, width = canvas.shape[:2]
+
+    for i, rle in enumerate(rles):
+        mask = decode_rle(rle)
+        if mask.shape != (height, width):
+            mask = cv2.resize(mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST).astype(bool)
+        color = np.array(MASK_COLORS[i % len(MASK_COLORS)], dtype=np.float32)
+        if background is None:
+            canvas[mask, :3] = color.astype(np.uint8)
+            canvas[mask, 3] = int(255 * alpha)
+        else:
+            canvas[mask] = (canvas[mask] * (1 - alpha) + color * alpha).astype(np.uint8)
+        contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        outline = (*MASK_COLORS[i % len(MASK_COLORS)], 255) if background is None else MASK_COLORS[i % len(MASK_COLORS)]
+        cv2.drawContours(canvas, contours, -1, outline, 2)
+    return canvas
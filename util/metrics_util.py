@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# [FILE] metrics_util.py
+#
+# [DESCRIPTION]
+#  処理件数や所要時間などのメトリクスをプロセス内で集計する
+#  （gunicornで複数ワーカーを起動した場合は、ワーカーごとに集計する）
+#
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name: str, value: float = 1):
+    """カウンターを加算する
+
+    Args:
+        name (str): メトリクス名（例：detect.cascade.escalated）
+        value (float): 加算する値
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, seconds: float):
+    """所要時間を記録する（件数・合計・最大を集計する）
+
+    Args:
+        name (str): メトリクス名（例：detect.cascade.fast_seconds）
+        seconds (float): 所要時間（秒）
+    """
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["sum"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+
+def metrics_snapshot() -> dict:
+    """集計したメトリクスを取得する
+
+    Returns:
+        dict: {'counters': {メトリクス名: 値}, 'timings': {メトリクス名: {'count', 'sum', 'max', 'avg'}}}
+    """
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: {**timing, "avg": timing["sum"] / timing["count"] if timing["count"] else 0.0}
+            for name, timing in _timings.items()
+        }
+    return {"counters": counters, "timings": timings}
+
+
+def reset_metrics():
+    """集計したメトリクスを消去する"""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
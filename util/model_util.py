@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# [FILE] model_util.py
+#
+# [DESCRIPTION]
+#  物体検出（YOLO）とセグメンテーション（SAM）のモデルの読み込みを定義する
+#  gunicornのpreload_appと組み合わせると、fork前に読み込んだ重みをワーカー間でコピーオンライトで共有できる
+#
+import gc
+import os
+import threading
+import time
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from ultralytics import SAM
+
+from util.qa_util import get_qa_pipeline, qa_model
+from util.yolo_util import get_detector, yolo_cascade, yolo_fast_model_file, yolo_fast_model_type
+
+load_dotenv()
+
+yolo_model_file = os.environ.get("YOLO_MODEL_FILE")
+sam_model_file = os.environ.get("SAM_MODEL_FILE")
+
+# fork前（アプリの読み込み時）にモデルを読み込むか（1: 読み込む, 0: 最初のリクエストで読み込む）
+model_preload = os.environ.get("MODEL_PRELOAD", "0") == "1"
+
+# 質問応答（/rest/ask）のモデルも起動時に読み込むか（1: 読み込む, 0: 最初の質問で読み込む）
+qa_preload = os.environ.get("QA_PRELOAD", "0") == "1"
+
+# SAMはスレッドセーフではないため、推論は1つずつ実行する
+sam_lock = threading.Lock()
+
+
+@lru_cache(maxsize=2)
+def get_sam_model(model_file) -> SAM:
+    """SAMモデルを取得する（モデルファイルごとに1回だけ読み込む）
+
+    Args:
+        model_file (_type_): SAMモデルファイル
+
+    Returns:
+        SAM: SAMモデル
+    """
+    return SAM(model_file)
+
+
+def preload_models():
+    """YOLOとSAM（QA_PRELOAD=1の場合は質問応答も）のモデルを読み込み、fork後に共有できるようにする
+
+    NOTE: 読み込み後にgc.freeze()で既存のオブジェクトをGCの対象外にする。
+          fork後にGCが参照カウントやGCヘッダーを書き換えて、共有ページがコピーされるのを防ぐ。
+          推論はfork後のワーカーで行うこと（fork前にOpenMPのスレッドを起動すると、ワーカーで推論が止まることがある）
+    """
+    start = time.perf_counter()
+    if yolo_model_file:
+        get_detector(yolo_model_file)
+    if yolo_cascade and yolo_fast_model_file:
+        # 軽量モデルはカスケード検出を既定にした場合だけ読み込む（リクエストで指定された場合は最初の検出で読み込む）
+        get_detector(yolo_fast_model_file, yolo_fast_model_type)
+    if sam_model_file:
+        get_sam_model(sam_model_file)
+    if qa_preload:
+        get_qa_pipeline(qa_model)
+    gc.collect()
+    gc.freeze()
+    print(f"[MODEL PRELOADED] {time.perf_counter() - start:.1f}秒")
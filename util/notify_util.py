@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# [FILE] notify_util.py
+#
+# [DESCRIPTION]
+#  結果の格納をREDISのPub/Subで受け取り、結果を待っているリクエスト（SSE・ロングポーリング）に通知する
+#  プロセスごとに1つのPub/Sub接続を専用スレッドで受信し、キーごとの待ち行列に振り分ける
+#
+import asyncio
+import math
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+
+import redis
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+
+from util import redis_util
+from util.redis_util import RESULT_CHANNEL_PREFIX, make_key
+from util.util import InvalidRequestError, getNoteId
+
+load_dotenv()
+
+# ロングポーリングで待つ時間の上限（秒）
+long_poll_max_seconds = float(os.environ.get("LONG_POLL_MAX_SECONDS", "30"))
+
+
+class ResultNotifier:
+    """結果の格納の通知を受信し、キーごとの購読者に振り分ける"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}  # {キー: {(イベントループ, 待ち行列), ...}}
+        # すべての通知で呼び出す関数 callback(キー, フィールド名のリスト)。購読し直したときはcallback(None, None)
+        self.callbacks = []
+        self.thread = None
+
+    def start(self):
+        """受信スレッドを開始する（初回の購読時に呼び出す）"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="result-notifier", daemon=True)
+                self.thread.start()
+
+    def add_callback(self, callback):
+        """すべての通知で呼び出す関数を登録する"""
+        self.callbacks.append(callback)
+        self.start()
+
+    def _run(self):
+        while True:
+            pubsub = redis_util.r_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(RESULT_CHANNEL_PREFIX + "*")
+                # 購読していなかった間の書き換えは分からないため、キャッシュなどをすべて破棄させる
+                for callback in self.callbacks:
+                    callback(None, None)
+                for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    key = message["channel"].decode("utf-8")[len(RESULT_CHANNEL_PREFIX) :]
+                    fields = message["data"].decode("utf-8").split(",")
+                    self._dispatch(key, fields)
+            except redis.RedisError as e:
+                print("[NOTIFY] REDISとの接続が切れたため、再接続します:", e)
+                time.sleep(1)
+            except Exception as e:
+                # 受信スレッドが止まると通知もキャッシュの削除も届かなくなるため、どのエラーでも購読し直す
+                print("[NOTIFY] 通知の受信中にエラーが発生したため、購読し直します:", e)
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def _dispatch(self, key: str, fields: list):
+        for callback in self.callbacks:
+            callback(key, fields)
+        with self.lock:
+            waiters = list(self.waiters.get(key, ()))
+        for loop, queue in waiters:
+            loop.call_soon_threadsafe(queue.put_nowait, fields)
+
+    @asynccontextmanager
+    async def subscribe(self, key: str):
+        """キーへの格納の通知を受け取る待ち行列を取得する
+
+        Args:
+            key (str): REDISに格納するときのキー
+
+        Yields:
+            asyncio.Queue: 格納されるたびに、格納したフィールド名のリストが入る
+        """
+        self.start()
+        waiter = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            self.waiters.setdefault(key, set()).add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            with self.lock:
+                self.waiters[key].discard(waiter)
+                if not self.waiters[key]:
+                    del self.waiters[key]
+
+
+# プロセス内で共有する通知の受信
+result_notifier = ResultNotifier()
+
+
+async def wait_for_field(key: str, field: str, timeout: float) -> bool:
+    """フィールドが格納されるまで待つ
+
+    Args:
+        key (str): REDISに格納するときのキー
+        field (str): 待つフィールド（boxes, text, tableなど）
+        timeout (float): 待つ時間の上限（秒）
+
+    Returns:
+        bool: True - 格納された, False - 時間内に格納されなかった
+    """
+    async with result_notifier.subscribe(key) as queue:
+        # 購読を始める前に格納されていた場合に備えて、購読後に確認する（REDISへの問い合わせはスレッドプールで実行する）
+        if await run_in_threadpool(redis_util.r_client.hexists, key, field):
+            return True
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                fields = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return False
+            if field in fields:
+                return True
+    return False
+
+
+async def wait_for_result(json_data: dict, field: str):
+    """リクエストにwait（秒）が指定されていれば、結果が格納されるまで待つ（ロングポーリング）
+
+    Args:
+        json_data (dict): {'_NOTE_LINK':..., '_PAGE_ID':..., 'wait': <待つ時間の上限（秒、0〜LONG_POLL_MAX_SECONDSに収める）>}
+        field (str): 待つフィールド
+
+    Raises:
+        InvalidRequestError: waitが数値でない場合（ステータスコード400を返す）
+    """
+    try:
+        wait = float(json_data.get("wait") or 0)
+    except (TypeError, ValueError) as e:
+        raise InvalidRequestError(f"waitが正しくありません: {json_data.get('wait')!r}") from e
+    if math.isnan(wait):
+        raise InvalidRequestError("waitが正しくありません: NaN")
+    wait = min(max(wait, 0.0), long_poll_max_seconds)
+    if wait == 0 or "_NOTE_LINK" not in json_data or "_PAGE_ID" not in json_data:
+        return
+    key = make_key(getNoteId(json_data["_NOTE_LINK"]), json_data["_PAGE_ID"])
+    if await run_in_threadpool(redis_util.r_client.hexists, key, field):
+        return
+    await wait_for_field(key, field, wait)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# [FILE] ocr_util.py
+#
+# [DESCRIPTION]
+#  テキストレイヤーのないページ（スキャンしたPDFなど）をラスタライズし、
+#  OCRエンジン（ローカルのTesseractまたはCloud Vision API）で文字を認識する
+#
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+from util.pdf_render_util import render_page
+from util.util import web_concurrency
+from util.vision_util import get_vision_client
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+load_dotenv()
+
+# テキストレイヤーのないページをOCRするか
+ocr_enabled = os.environ.get("OCR_ENABLED", "1") == "1"
+
+# ラスタライズする解像度（dpi）。高くすると精度が上がるが遅くなる
+ocr_dpi = int(os.environ.get("OCR_DPI", "200"))
+
+# リクエストボディのocrDpiで指定できる解像度の下限と上限（範囲外の値はこの範囲に収める）
+ocr_min_dpi = int(os.environ.get("OCR_MIN_DPI", "72"))
+ocr_max_dpi = int(os.environ.get("OCR_MAX_DPI", "400"))
+
+# OCRを並列に実行するプロセス数（未設定の場合は、CPUコア数をワーカー数（WEB_CONCURRENCY）で等分する）
+# NOTE: プロセスプールはワーカーごとに作られるため、CPUコア数のままだとワーカー数倍のプロセスが起動する
+ocr_workers = int(os.environ.get("OCR_WORKERS", str(max(1, (os.cpu_count() or 1) // web_concurrency()))))
+
+# OCRエンジン（tesseract: ローカルのTesseract / vision: Cloud Vision API）
+ocr_engine = os.environ.get("OCR_ENGINE", "tesseract")
+
+# Tesseractの言語モデル
+ocr_lang = os.environ.get("OCR_LANG", "jpn+eng")
+
+
+@lru_cache(maxsize=1)
+def _get_pool() -> ProcessPoolExecutor:
+    """OCR用のプロセスプールを取得する（初回利用時に生成する）
+
+    NOTE: サーバーのスレッドを引き継がないよう、ワーカーはspawnで起動する
+    """
+    return ProcessPoolExecutor(max_workers=ocr_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _ocr_page(pdf_path: str, page_index: int, dpi: int, lang: str) -> str:
+    """1ページをラスタライズしてOCRする（プロセスプールのワーカーで実行する）"""
+    image = render_page(pdf_path, page_index, dpi)
+    return pytesseract.image_to_string(image, lang=lang)
+
+
+def _render_png(pdf_path: str, page_index: int, dpi: int) -> bytes:
+    """1ページをラスタライズしてPNGに変換する（プロセスプールのワーカーで実行する）"""
+    buffer = io.BytesIO()
+    render_page(pdf_path, page_index, dpi).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def ocr_pages(pdf_path: str, page_indexes: list, dpi: int | None = None) -> dict:
+    """指定したページをプロセスプールで並列にOCRする
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_indexes (list): OCRするページ番号（0始まり）のリスト
+        dpi (int | None): ラスタライズする解像度（dpi）。Noneの場合は環境変数OCR_DPI
+
+    Returns:
+        dict: {ページ番号: 認識したテキスト}
+    """
+    dpi = dpi or ocr_dpi
+    pool = _get_pool()
+
+    if ocr_engine == "vision":
+        # ラスタライズだけを並列に行い、まとめてCloud Vision APIに送信する
+        images = list(pool.map(_render_png, [pdf_path] * len(page_indexes), page_indexes, [dpi] * len(page_indexes)))
+        try:
+            texts = get_vision_client().ocr_images(images)
+        except Exception as e:
+            print("[OCR] Cloud Vision APIでのOCRに失敗しました:", e)
+            return {}
+        return dict(zip(page_indexes, texts, strict=True))
+
+    if pytesseract is None:
+        print("pytesseractがインストールされていないため、OCRできません")
+        return {}
+
+    futures = {i: pool.submit(_ocr_page, pdf_path, i, dpi, ocr_lang) for i in page_indexes}
+
+    results = {}
+    for i, future in futures.items():
+        # 失敗したページは除いて、他のページの結果を返す
+        error = future.exception()
+        if error is not None:
+            print(f"[OCR] {i + 1}ページ目のOCRに失敗しました:", error)
+            continue
+        results[i] = future.result()
+    return results
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# [FILE] pdf_cache_util.py
+#
+# [DESCRIPTION]
+#  レイアウト解析済みのPDFページをPDFのハッシュ値をキーにキャッシュする
+#  （テキスト抽出と表抽出で同じPDFを2回解析しないようにする）
+#
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pdfplumber
+from dotenv import load_dotenv
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import PDFObjRef, PDFStream, resolve1
+from pdfplumber import utils
+from pdfplumber.container import Container
+from pdfplumber.table import TableFinder, TableSettings
+
+load_dotenv()
+
+# キャッシュするメモリ量の上限（バイト、既定は256MB）とPDFの数の上限
+pdf_cache_max_bytes = int(os.environ.get("PDF_CACHE_MAX_BYTES", "268435456"))
+pdf_cache_max_documents = int(os.environ.get("PDF_CACHE_MAX_DOCUMENTS", "16"))
+
+# キャッシュするオブジェクトの種類（文字と、表の罫線になる線・矩形・曲線）
+CACHED_OBJECT_TYPES = ["char", "line", "rect", "curve"]
+
+
+class CachedPage(Container):
+    """レイアウト解析済みのページ
+
+    pdfplumberのPageと同じく文字・罫線を持ち、テキスト抽出と表抽出に使える
+    """
+
+    def __init__(self, page_number: int, bbox: tuple, objects: dict):
+        self.page_number = page_number
+        self.bbox = bbox
+        self.width = bbox[2] - bbox[0]
+        self.height = bbox[3] - bbox[1]
+        self._page_objects = objects
+        self.words = utils.extract_words(self.chars)
+        self.size = _estimate_size(objects) + _estimate_size({"word": self.words})
+
+    @property
+    def objects(self) -> dict:
+        return self._page_objects
+
+    def extract_text(self, **kwargs) -> str:
+        return utils.extract_text(self.chars, **kwargs)
+
+    def extract_words(self, **kwargs) -> list:
+        if not kwargs:
+            return self.words
+        return utils.extract_words(self.chars, **kwargs)
+
+    def extract_tables(self, table_settings: dict | None = None) -> list:
+        tset = TableSettings.resolve(table_settings)
+        tables = TableFinder(self, tset).tables
+        return [table.extract(**(tset.text_settings or {})) for table in tables]
+
+
+def _estimate_size(objects: dict) -> int:
+    """ページのオブジェクトが使うメモリ量（バイト）を概算する"""
+    size = 0
+    for items in objects.values():
+        for item in items:
+            size += sys.getsizeof(item) + sum(sys.getsizeof(value) for value in item.values())
+    return size
+
+
+def _parse_page(page) -> CachedPage:
+    """pdfplumberのページをレイアウト解析し、キャッシュ用のページに変換する"""
+    objects = {name: list(page.objects.get(name, [])) for name in CACHED_OBJECT_TYPES}
+    return CachedPage(page.page_number, page.bbox, objects)
+
+
+class PdfPageCache:
+    """PDFのハッシュ値をキーに、ページ単位のレイアウト解析結果を保持するLRUキャッシュ"""
+
+    def __init__(self, max_bytes: int, max_documents: int):
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.documents = OrderedDict()  # {ハッシュ値: [CachedPage or None, ...]}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def load_pages(self, pdf_path: str, page_indexes: list | None = None) -> list:
+        """PDFのページを取得する（未解析のページだけを解析する）
+
+        Args:
+            pdf_path (str): PDFファイルのパス
+            page_indexes (list | None): 取得するページ番号（0始まり）のリスト。Noneの場合は全ページ
+
+        Returns:
+            list: CachedPageのリスト
+        """
+        with open(pdf_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        with self.lock:
+            pages = self.documents.get(digest)
+            if pages is not None:
+                self.documents.move_to_end(digest)
+
+        if pages is None or any(pages[i] is None for i in _indexes(pages, page_indexes)):
+            with pdfplumber.open(pdf_path) as pdf:
+                # 格納済みのリストは書き換えず、コピーに追加で解析したページを格納する
+                pages = [None] * len(pdf.pages) if pages is None else list(pages)
+                for i in _indexes(pages, page_indexes):
+                    if pages[i] is None:
+                        pages[i] = _parse_page(pdf.pages[i])
+                        pdf.pages[i].close()  # pdfplumberが保持する解析結果を解放する
+            self._store(digest, pages)
+
+        return [pages[i] for i in _indexes(pages, page_indexes)]
+
+    def _store(self, digest: str, pages: list):
+        """解析結果を格納し、上限を超えた分を古いものから削除する"""
+        with self.lock:
+            if digest in self.documents:
+                self.total_bytes -= _document_size(self.documents[digest])
+            self.documents[digest] = pages
+            self.documents.move_to_end(digest)
+            self.total_bytes += _document_size(pages)
+
+            while len(self.documents) > 1 and (self.total_bytes > self.max_bytes or len(self.documents) > self.max_documents):
+                _, evicted = self.documents.popitem(last=False)
+                self.total_bytes -= _document_size(evicted)
+
+
+def _indexes(pages: list, page_indexes: list | None):
+    return range(len(pages)) if page_indexes is None else page_indexes
+
+
+def _document_size(pages: list) -> int:
+    return sum(page.size for page in pages if page is not None)
+
+
+# プロセス内で共有するキャッシュ
+pdf_page_cache = PdfPageCache(pdf_cache_max_bytes, pdf_cache_max_documents)
+
+
+def load_pages(pdf_path: str, page_indexes: list | None = None) -> list:
+    """共有キャッシュからPDFのページを取得する
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_indexes (list | None): 取得するページ番号（0始まり）のリスト。Noneの場合は全ページ
+
+    Returns:
+        list: CachedPageのリスト
+    """
+    return pdf_page_cache.load_pages(pdf_path, page_indexes)
+
+
+def _update_digest(digest, obj, seen: set):
+    """PDFのオブジェクトの内容をハッシュ値に加える（参照先をたどり、ストリームは属性とバイナリを加える）
+
+    NOTE: オブジェクト番号は保存し直すと変わるため加えない。たどった参照は2回目以降は印だけを加える（循環参照対策）
+    """
+    if isinstance(obj, PDFObjRef):
+        if obj.objid in seen:
+            digest.update(b"&")
+            return
+        seen.add(obj.objid)
+        obj = resolve1(obj)
+
+    if isinstance(obj, PDFStream):
+        _update_digest(digest, obj.attrs, seen)
+        digest.update(obj.get_rawdata() or b"")
+    elif isinstance(obj, dict):
+        for name in sorted(obj, key=str):
+            digest.update(str(name).encode("utf-8"))
+            _update_digest(digest, obj[name], seen)
+    elif isinstance(obj, list | tuple):
+        for item in obj:
+            _update_digest(digest, item, seen)
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+
+
+def page_fingerprints(pdf_path: str) -> list:
+    """ページごとの内容のハッシュ値（フィンガープリント）を求める
+
+    NOTE: レイアウト解析はせず、ページのサイズ・コンテンツストリームと、リソースのフォント・XObject（画像やフォーム。
+          フォームが参照するフォントやXObjectもたどる）の内容からハッシュ値を求める
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+
+    Returns:
+        list: ページごとのフィンガープリント（16進文字列）
+    """
+    fingerprints = []
+    with open(pdf_path, "rb") as f:
+        for page in PDFPage.get_pages(f):
+            digest = hashlib.sha256(repr(page.mediabox).encode("utf-8"))
+            for stream in page.contents:
+                stream = resolve1(stream)
+                if stream is not None:
+                    digest.update(stream.get_rawdata() or b"")
+
+            # フォントが変わると同じコンテンツストリームでも抽出されるテキストが変わる
+            resources = resolve1(page.resources) or {}
+            for category in ("Font", "XObject"):
+                digest.update(category.encode("utf-8"))
+                _update_digest(digest, resources.get(category), set())
+            fingerprints.append(digest.hexdigest())
+    return fingerprints
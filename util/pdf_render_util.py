@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# [FILE] pdf_render_util.py
+#
+# [DESCRIPTION]
+#  PDFのページを画像にラスタライズする
+#
+import threading
+
+import numpy as np
+import pypdfium2 as pdfium
+
+# PDFの座標系の解像度（1インチ = 72ポイント）
+PDF_POINTS_PER_INCH = 72
+
+# PDFiumはスレッドセーフではない（別の文書を開いていても同時に呼び出せない）ため、
+# プロセス内でpypdfium2を使う処理（テキスト抽出・ページ数の取得・報告書の組み立てなど）はこのロックで1つずつ実行する
+pdfium_lock = threading.Lock()
+
+
+def render_page(pdf_path: str, page_index: int, dpi: int):
+    """PDFの1ページを指定した解像度で画像に変換する
+
+    NOTE: プロセスプールのワーカーから呼び出すため、ページごとにPDFを開く
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_index (int): ページ番号（0始まり）
+        dpi (int): 解像度（dpi）
+
+    Returns:
+        PIL.Image.Image: ページの画像（RGB）
+    """
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            page = pdf[page_index]
+            bitmap = page.render(scale=dpi / PDF_POINTS_PER_INCH)
+            image = bitmap.to_pil().convert("RGB")
+            bitmap.close()
+            page.close()
+        finally:
+            pdf.close()
+    return image
+
+
+def render_page_bgr(pdf_path: str, page_index: int, dpi: int) -> np.ndarray:
+    """PDFの1ページを指定した解像度でOpenCV形式（BGR）の配列に変換する（プロセスプールのワーカーで実行する）
+
+    Args:
+        pdf_path (str): PDFファイルのパス
+        page_index (int): ページ番号（0始まり）
+        dpi (int): 解像度（dpi）
+
+    Returns:
+        np.ndarray: ページの画像（高さ×幅×3, BGR）
+    """
+    image = np.asarray(render_page(pdf_path, page_index, dpi))
+    return np.ascontiguousarray(image[:, :, ::-1])
+
+
+def page_count(pdf_path: str) -> int:
+    """PDFのページ数を取得する"""
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# [FILE] qa_util.py
+#
+# [DESCRIPTION]
+#  抽出したテキストに対する質問応答（抽出型QA）
+#  - テキストの抽出時に、ページごとのテキストをチャンクに分割し、BM25の転置索引（文字bigram）を作ってREDISに格納しておく
+#  - 質問を受けたら索引でチャンクを絞り込み、上位のチャンクだけをまとめて（バッチで）QAモデルに入力する
+#  - QAモデルはプロセスごとに1回だけ読み込み、以降のリクエストで使い回す
+#
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+from util.cpu_util import engine_threads
+from util.metrics_util import observe
+
+try:
+    from transformers import pipeline
+except ImportError:
+    pipeline = None
+
+load_dotenv()
+
+# 質問応答のモデル（HuggingFaceのquestion-answeringのモデル）
+# NOTE: 既定は日本語を含む多言語の文書に使える抽出型のモデル。英語だけの文書では英語のモデルの方が軽く高精度
+qa_model = os.environ.get("QA_MODEL", "deepset/xlm-roberta-base-squad2")
+
+# チャンクの長さ（文字）と、前のチャンクと重ねる長さ（文字）
+qa_chunk_chars = int(os.environ.get("QA_CHUNK_CHARS", "400"))
+qa_chunk_overlap = int(os.environ.get("QA_CHUNK_OVERLAP", "80"))
+
+# QAモデルに入力するチャンクの数（索引のスコアの上位）と、まとめて推論するチャンクの数
+qa_top_k = int(os.environ.get("QA_TOP_K", "8"))
+
+# リクエストで指定できるQAモデルに入力するチャンクの数の上限（推論は1つずつ実行するため、大きな値で他の質問を待たせない）
+qa_max_top_k = int(os.environ.get("QA_MAX_TOP_K", "32"))
+qa_batch_size = int(os.environ.get("QA_BATCH_SIZE", "8"))
+
+# 回答の長さの上限（トークン）
+qa_max_answer_len = int(os.environ.get("QA_MAX_ANSWER_LEN", "64"))
+
+# BM25のパラメーター
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 英数字の単語と、それ以外（日本語など）の連続した文字（記号は索引に含めない）
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[^\s0-9a-z\W]+")
+
+# QAモデルはスレッドセーフではないため、推論は1つずつ実行する
+qa_lock = threading.Lock()
+
+
+def tokenize(text: str) -> list:
+    """テキストを索引の語に分割する
+
+    NOTE: 英数字は単語単位、日本語などは分かち書きの代わりに文字bigram（1文字だけの場合はその文字）にする
+
+    Args:
+        text (str): テキスト
+
+    Returns:
+        list: 語のリスト
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token.isascii() or len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i : i + 2] for i in range(len(token) - 1))
+    return terms
+
+
+def split_chunks(texts: list) -> list:
+    """ページごとのテキストを、ページをまたがないチャンクに分割する
+
+    NOTE: ページ番号は、抽出したテキスト（format_pages）の[Page N]と同じく、テキストのないページを数えない。
+          格納済みのテキストから索引を作る場合（parse_formatted_pages）も、同じページ番号になる
+
+    Args:
+        texts (list): ページごとのテキスト
+
+    Returns:
+        list: [{'page': ページ番号（[Page N]の番号）, 'text': チャンクのテキスト}, ...]
+    """
+    step = max(1, qa_chunk_chars - qa_chunk_overlap)
+    chunks = []
+    for page, text in enumerate((text for text in texts if text), start=1):
+        text = text.replace("\r", "").replace("\n", "")
+        for start in range(0, max(1, len(text) - qa_chunk_overlap), step):
+            chunk = text[start : start + qa_chunk_chars].strip()
+            if chunk:
+                chunks.append({"page": page, "text": chunk})
+    return chunks
+
+
+def build_qa_index(texts: list) -> dict:
+    """ページごとのテキストから、質問応答用のチャンクとBM25の転置索引を作る（テキストの抽出時に1回だけ実行する）
+
+    Args:
+        texts (list): ページごとのテキスト
+
+    Returns:
+        dict: {'chunks': [{'page', 'text'}, ...], 'lengths': [チャンクの語数, ...],
+               'postings': {語: [チャンク番号, 出現回数, ...]}}
+    """
+    chunks = split_chunks(texts)
+    lengths = []
+    postings = {}
+    for i, chunk in enumerate(chunks):
+        counts = Counter(tokenize(chunk["text"]))
+        lengths.append(sum(counts.values()))
+        for term, count in counts.items():
+            postings.setdefault(term, []).extend((i, count))
+    return {"chunks": chunks, "lengths": lengths, "postings": postings}
+
+
+def rank_chunks(index: dict, question: str, top_k: int) -> list:
+    """BM25で質問に関連するチャンクを絞り込む
+
+    Args:
+        index (dict): build_qa_indexで作った索引
+        question (str): 質問
+        top_k (int): 返すチャンクの数
+
+    Returns:
+        list: スコアの高い順のチャンク番号
+    """
+    lengths = index["lengths"]
+    if not lengths:
+        return []
+    avg_length = sum(lengths) / len(lengths)
+
+    scores = {}
+    for term in set(tokenize(question)):
+        posting = index["postings"].get(term)
+        if not posting:
+            continue
+        df = len(posting) // 2
+        idf = math.log(1 + (len(lengths) - df + 0.5) / (df + 0.5))
+        for i, tf in zip(posting[0::2], posting[1::2], strict=True):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / avg_length)
+            scores[i] = scores.get(i, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+
+@lru_cache(maxsize=1)
+def get_qa_pipeline(model_name: str):
+    """QAモデルを取得する（プロセスごとに1回だけ読み込む）
+
+    Args:
+        model_name (str): HuggingFaceのモデル名またはモデルのフォルダー
+
+    Returns:
+        _type_: question-answeringのパイプライン（transformersがインストールされていない場合はNone）
+    """
+    if pipeline is None:
+        print("transformersがインストールされていないため、質問応答できません")
+        return None
+    return pipeline("question-answering", model=model_name, device="cpu")
+
+
+def answer_question(index: dict, question: str, top_k: int | None = None, answers: int = 1) -> list:
+    """索引で絞り込んだチャンクをQAモデルにまとめて入力し、回答を抽出する
+
+    Args:
+        index (dict): build_qa_indexで作った索引
+        question (str): 質問
+        top_k (int | None): QAモデルに入力するチャンクの数（1〜QA_MAX_TOP_Kに収める）。Noneの場合は環境変数QA_TOP_K
+        answers (int): 返す回答の数（1〜QA_MAX_TOP_Kに収める）
+
+    Returns:
+        list: スコアの高い順の回答 [{'answer', 'score', 'page', 'context'}, ...]
+    """
+    start = time.perf_counter()
+    top_k = min(max(top_k or qa_top_k, 1), qa_max_top_k)
+    candidates = rank_chunks(index, question, top_k)
+    observe("qa.retrieve_seconds", time.perf_counter() - start)
+    qa = get_qa_pipeline(qa_model)
+    if not candidates or qa is None:
+        return []
+
+    contexts = [index["chunks"][i]["text"] for i in candidates]
+    with qa_lock, engine_threads("qa"):
+        start = time.perf_counter()
+        outputs = qa(
+            question=[question] * len(contexts),
+            context=contexts,
+            batch_size=qa_batch_size,
+            max_answer_len=qa_max_answer_len,
+        )
+        observe("qa.model_seconds", time.perf_counter() - start)
+    if isinstance(outputs, dict):
+        outputs = [outputs]
+
+    results = [
+        {
+            "answer": output["answer"],
+            "score": round(float(output["score"]), 4),
+            "page": index["chunks"][i]["page"],
+            "context": index["chunks"][i]["text"],
+        }
+        for i, output in zip(candidates, outputs, strict=True)
+        if output["answer"].strip()
+    ]
+    results.sort(key=lambda result: result["score"], reverse=True)
+    return results[: min(max(answers, 1), qa_max_top_k)]
+
+
+def parse_formatted_pages(text: str) -> list:
+    """format_pagesで連結したテキストをページごとのテキストに戻す（索引のないテキストから索引を作るときに使う）
+
+    NOTE: テキストのないページはformat_pagesで除かれているため、リストの番号は[Page N]の番号になる
+    """
+    texts = []
+    for match in re.finditer(r"\[Page (\d+)\]\n\n(.*?)\n\n(?=\[Page \d+\]|\Z)", text, re.DOTALL):
+        page = int(match.group(1))
+        texts.extend([""] * (page - len(texts)))
+        texts[page - 1] = match.group(2)
+    return texts
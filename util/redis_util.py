@@ -6,12 +6,21 @@
 #  REDISに関わるメソッドを定義する
 #
 import base64
-import json
+import fnmatch
 import os
 import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
 
 import redis
 from dotenv import load_dotenv
+from redis.cluster import ClusterNode, RedisCluster
+from redis.sentinel import Sentinel
+
+from util.metrics_util import increment
+from util.result_util import ColumnarTable, pack_result, unpack_result, unpack_table
 
 # .envファイルの内容を読み込見込む
 load_dotenv()
@@ -36,30 +45,649 @@ if redis_duration is None:
 else:
     redis_duration = int(redis_duration)
 
-# REDISに接続する
-r_client = redis.Redis(host=redis_host, port=redis_port, db=0)
-print("Connected REDIS")
+
+def _env_int(name: str, default: int) -> int:
+    """整数の環境変数を取得する（未設定の場合は既定値）"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(value)
+
+
+# フィールド種別ごとの保存ポリシー（有効期限[秒]・サイズ上限[バイト]・圧縮の有無）
+# NOTE: サイズの大きい画像は短く、小さく再計算コストの高い検出結果・テキスト・表は長く保持できるようにする
+STORAGE_POLICY = {
+    "image": {
+        "expire": _env_int("REDIS_EXPIRE_IMAGE", redis_duration),
+        "max_bytes": _env_int("REDIS_MAX_BYTES_IMAGE", 10 * 1024 * 1024),
+        "compress": False,  # JPEGのBase64文字列は圧縮しても小さくならない
+    },
+    "boxes": {
+        "expire": _env_int("REDIS_EXPIRE_BOXES", redis_duration),
+        "max_bytes": _env_int("REDIS_MAX_BYTES_BOXES", 1024 * 1024),
+        "compress": False,
+    },
+    "masks": {
+        "expire": _env_int("REDIS_EXPIRE_MASKS", redis_duration),
+        "max_bytes": _env_int("REDIS_MAX_BYTES_MASKS", 4 * 1024 * 1024),
+        "compress": True,  # RLEの連続数は圧縮すると小さくなる
+    },
+    "text": {
+        "expire": _env_int("REDIS_EXPIRE_TEXT", redis_duration),
+        "max_bytes": _env_int("REDIS_MAX_BYTES_TEXT", 16 * 1024 * 1024),
+        "compress": True,
+    },
+    "table": {
+        "expire": _env_int("REDIS_EXPIRE_TABLE", redis_duration),
+        "max_bytes": _env_int("REDIS_MAX_BYTES_TABLE", 16 * 1024 * 1024),
+        "compress": True,
+    },
+}
+# 再アップロード時に変更のないページを再利用するための、ページごとのフィンガープリントと抽出結果
+STORAGE_POLICY["text_pages"] = dict(STORAGE_POLICY["text"])
+STORAGE_POLICY["table_pages"] = dict(STORAGE_POLICY["table"])
+# 質問応答（/rest/ask）用のチャンクとBM25の索引（テキストの抽出時に作る）
+STORAGE_POLICY["qa_index"] = dict(STORAGE_POLICY["text"])
+# セグメンテーションのマスクを描画するときの背景（入力画像の縮小版, JPEG）
+STORAGE_POLICY["mask_image"] = dict(STORAGE_POLICY["image"])
+
+# このサイズ（バイト）以上のテキスト・表データを圧縮して格納する
+compress_min_bytes = _env_int("REDIS_COMPRESS_MIN_BYTES", 4096)
+
+# 圧縮データの先頭に付ける印（テキスト・JSON・msgpackの先頭にはNULL文字が現れない）
+COMPRESSED_PREFIX = b"\x00z"
+
+# 書き込んだバイト数・件数の累計を記録するか（1: する, 0: しない）
+# NOTE: 書き込むたびに加算するだけで、有効期限切れや上書きでは減らさない（現在のメモリ使用量ではない）
+redis_memory_stats = os.environ.get("REDIS_MEMORY_STATS", "1") == "1"
+
+# 累計を記録するハッシュのキーの接頭辞と、分けるハッシュの数
+# NOTE: すべての書き込みが1つのキーを更新すると、Redis Clusterではそのキーのノードに負荷が集中するため、
+#       格納するキーのハッシュ値でハッシュを分ける（キーごとにスロットが変わるよう、ハッシュタグは付けない）
+MEMORY_STATS_KEY = "redis_util:memory"
+MEMORY_STATS_SHARDS = 16
+
+# /rest/admin/redis_memoryで調べるキーの数の上限（全キーを調べると時間がかかるため）
+redis_memory_report_max_keys = _env_int("REDIS_MEMORY_REPORT_MAX_KEYS", 10000)
+
+# /rest/admin/redis_memoryでパイプラインにまとめるキーの数
+MEMORY_REPORT_BATCH = 500
+
+# 結果を格納したことを通知するチャンネルの接頭辞（チャンネル名は接頭辞+キー、メッセージは格納したフィールド名のカンマ区切り）
+RESULT_CHANNEL_PREFIX = "result:"
+
+# ノートごとに格納したページの索引（ハッシュ: ページID → キー）のキーの接頭辞
+NOTE_INDEX_PREFIX = "note_index:"
+
+# プロセス内キャッシュ（L1）の設定（1: 使う, 0: 使わない）、メモリ量の上限（バイト）、1件のサイズ上限（バイト）、有効期限（秒）
+l1_cache_enabled = os.environ.get("L1_CACHE_ENABLED", "1") == "1"
+l1_cache_max_bytes = _env_int("L1_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+l1_cache_max_entry_bytes = _env_int("L1_CACHE_MAX_ENTRY_BYTES", 8 * 1024 * 1024)
+l1_cache_ttl = float(os.environ.get("L1_CACHE_TTL", "30"))
+
+# REDISの構成（standalone: 1台 / cluster: Redis Cluster / sentinel: Sentinelで監視するマスターとレプリカ）
+redis_mode = os.environ.get("REDIS_MODE", "standalone")
+
+# クラスターのノード・Sentinelの一覧（ホスト:ポートのカンマ区切り, 未設定の場合はREDIS_HOST:REDIS_PORT）
+redis_nodes = [
+    (node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1]))
+    for node in os.environ.get("REDIS_NODES", f"{redis_host}:{redis_port}").split(",")
+    if node.strip()
+]
+
+# Sentinelで監視するマスターの名前
+redis_sentinel_master = os.environ.get("REDIS_SENTINEL_MASTER", "mymaster")
+
+# 取得（get_*）をレプリカから読み込むか（1: 読み込む, 0: マスターから読み込む）
+redis_read_from_replicas = os.environ.get("REDIS_READ_FROM_REPLICAS", "0") == "1"
+
+
+def _connect() -> tuple:
+    """REDISの構成に従って接続する
+
+    Returns:
+        tuple: (書き込み用のクライアント, 取得用のクライアント)
+    """
+    if redis_mode == "cluster":
+        client = RedisCluster(
+            startup_nodes=[ClusterNode(host, port) for host, port in redis_nodes],
+            read_from_replicas=redis_read_from_replicas,
+        )
+        return client, client
+
+    if redis_mode == "sentinel":
+        sentinel = Sentinel(redis_nodes, socket_timeout=1.0)
+        master = sentinel.master_for(redis_sentinel_master, db=0)
+        replica = sentinel.slave_for(redis_sentinel_master, db=0) if redis_read_from_replicas else master
+        return master, replica
+
+    client = redis.Redis(host=redis_host, port=redis_port, db=0)
+    return client, client
+
+
+# REDISに接続する（r_read_clientはレプリカから読み込む場合だけr_clientと異なる）
+r_client, r_read_client = _connect()
+print("Connected REDIS", redis_mode)
+
+# HEXPIRE（フィールド単位の有効期限, Redis 7.4以降）が使えるか（使えない場合はキー単位の有効期限にする）
+hexpire_enabled = True
+
+# ==================================================================================================
+# 保存ポリシーに基づくREDIS処理
+# ==================================================================================================
+
+
+class L1Cache:
+    """REDISから取得したフィールドをプロセス内に保持するLRUキャッシュ（有効期限・メモリ量の上限付き）
+
+    NOTE: 他のワーカーがキーを書き換えたときは、結果の格納の通知（Pub/Sub）を受けて削除する。
+          通知を受信できない間に古い値を返し続けないよう、有効期限を短めにする。
+          REDISから読み込んでいる間に削除の通知を受けた場合は、読み込んだ（古いかもしれない）値を格納しないよう、
+          読み込む前に世代（generation）を取得し、格納するときに変わっていないか確かめる
+    """
+
+    # 世代を数えるスロットの数（キーごとに数えるとキーの数だけメモリを使うため、キーのハッシュ値でスロットに分ける）
+    GENERATION_SLOTS = 4096
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {(キー, フィールド): (有効期限, 値)}
+        self.fields = {}  # {キー: {フィールド, ...}}（通知を受けたキーのエントリーを探すために使う）
+        self.total_bytes = 0
+        self.epoch = 0  # すべて削除するたびに増やす
+        self.generations = [0] * self.GENERATION_SLOTS  # キーのハッシュ値ごとの世代（キーを削除するたびに増やす）
+        self.lock = threading.Lock()
+        self.subscribed = False
+
+    def generation(self, key) -> tuple:
+        """キーの現在の世代を取得する（REDISから読み込む前に取得し、putに渡す）"""
+        with self.lock:
+            return self.epoch, self.generations[hash(key) % self.GENERATION_SLOTS]
+
+    def get(self, key, field):
+        """キャッシュした値を取得する（なければNone）"""
+        with self.lock:
+            entry = self.entries.get((key, field))
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove((key, field))
+                return None
+            self.entries.move_to_end((key, field))
+            return entry[1]
+
+    def put(self, key, field, value: bytes, generation: tuple | None = None):
+        """値をキャッシュし、上限を超えた分を古いものから削除する
+
+        Args:
+            generation (tuple | None): 値を読み込む前に取得した世代。その後にキーが削除されていればキャッシュしない
+        """
+        if len(value) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != (self.epoch, self.generations[hash(key) % self.GENERATION_SLOTS]):
+                return
+            self._remove((key, field))
+            self.entries[(key, field)] = (time.monotonic() + self.ttl, value)
+            self.fields.setdefault(key, set()).add(field)
+            self.total_bytes += len(value)
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+
+    def invalidate(self, key, fields=None):
+        """キーのフィールドを削除する（keyがNoneの場合はすべて削除する）"""
+        with self.lock:
+            if key is None:
+                self.epoch += 1
+                self.entries.clear()
+                self.fields.clear()
+                self.total_bytes = 0
+                return
+            self.generations[hash(key) % self.GENERATION_SLOTS] += 1
+            for field in list(self.fields.get(key, ())):
+                if fields is None or field in fields:
+                    self._remove((key, field))
+
+    def _remove(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+            key, field = entry_key
+            self.fields[key].discard(field)
+            if not self.fields[key]:
+                del self.fields[key]
+
+
+# プロセス内で共有するキャッシュ
+l1_cache = L1Cache(l1_cache_max_bytes, l1_cache_max_entry_bytes, l1_cache_ttl)
+
+
+def _subscribe_l1_invalidation():
+    """他のワーカーによる書き換えでキャッシュを削除するよう、結果の格納の通知を購読する（初回のみ）"""
+    from util.notify_util import result_notifier  # noqa: PLC0415 - notify_utilはこのモジュールを参照するため、ここで読み込む
+
+    with l1_cache.lock:
+        if l1_cache.subscribed:
+            return
+        l1_cache.subscribed = True
+    result_notifier.add_callback(l1_cache.invalidate)
+
+
+def _note_tag(note_id: str) -> str:
+    """キーに含めるノートIDを返す
+
+    NOTE: Redis Clusterでは{}で囲んだハッシュタグだけでスロットが決まるため、同じノートのページ・索引が
+          同じスロットに入り、ノート単位のパイプラインが1台のノートで完結する
+    """
+    return "{" + note_id + "}" if redis_mode == "cluster" else note_id
+
+
+def make_key(note_id: str, page_id: str) -> str:
+    """REDISに格納するキーをeYACHO/GEMBA NoteのノートIDとページIDから生成する"""
+    return _note_tag(note_id) + "-" + page_id
+
+
+def note_index_key(note_id: str) -> str:
+    """ノートごとの索引（ハッシュ: ページID → キー）のキー"""
+    return NOTE_INDEX_PREFIX + _note_tag(note_id)
+
+
+def _encode_field(field: str, value) -> bytes:
+    """保存ポリシーに従い、格納する値をバイナリに変換する（必要に応じて圧縮する）"""
+    data = value.encode("utf-8") if isinstance(value, str) else value
+    if STORAGE_POLICY[field]["compress"] and len(data) >= compress_min_bytes:
+        data = COMPRESSED_PREFIX + zlib.compress(data, 6)
+    return data
+
+
+def _decode_field(data: bytes | None) -> bytes | None:
+    """REDISから取得した値を復元する（圧縮されていれば展開する）"""
+    if data is not None and data[:2] == COMPRESSED_PREFIX:
+        return zlib.decompress(data[2:])
+    return data
+
+
+def _is_hexpire_unsupported(error: redis.RedisError) -> bool:
+    """サーバーにHEXPIREがないためのエラーか（メモリ不足・型の不一致・読み込み専用などのエラーではないか）
+
+    NOTE: 単体のサーバーは「unknown command `HEXPIRE`」のResponseErrorを、Redis Clusterのクライアントは
+          「HEXPIRE command doesn't exist in Redis commands」のRedisErrorを送出する
+    """
+    message = str(error)
+    return "HEXPIRE" in message and ("unknown command" in message.lower() or "doesn't exist" in message)
+
+
+def _memory_stats_key(key: str) -> str:
+    """格納するキーの累計を記録するハッシュのキー"""
+    return f"{MEMORY_STATS_KEY}:{zlib.crc32(key.encode('utf-8')) % MEMORY_STATS_SHARDS}"
+
+
+def _put_fields(key, fields: dict, index: tuple | None = None) -> bool:
+    """保存ポリシーに従い、ハッシュの各フィールドを有効期限付きで格納する
+
+    Args:
+        key (_type_): REDISに格納するときのキー
+        fields (dict): {フィールド名: 値}
+        index (tuple | None): (ノートID, ページID)。指定するとノートごとの索引にページを登録する
+
+    Returns:
+        bool: True - REDISへの格納が成功、False - 失敗（サイズ上限超過を含む）
+    """
+    global hexpire_enabled  # noqa: PLW0603 - HEXPIREに対応していないと分かったら、プロセス全体で使わないようにする
+
+    encoded = {}
+    for field, value in fields.items():
+        data = _encode_field(field, value)
+        if len(data) > STORAGE_POLICY[field]["max_bytes"]:
+            print(f"[REDIS] {key}:{field}のサイズ({len(data)}バイト)が上限を超えたため格納しません")
+            return False
+        encoded[field] = data
+
+    max_expire = max(policy["expire"] for policy in STORAGE_POLICY.values())
+    while True:
+        pipe = r_client.pipeline()
+        pipe.hset(key, mapping=encoded)
+        if hexpire_enabled:
+            # キーは最長の有効期限で残し、フィールドごとに有効期限を設定する
+            pipe.expire(key, max_expire)
+            for field in encoded:
+                pipe.hexpire(key, STORAGE_POLICY[field]["expire"], field)
+        else:
+            pipe.expire(key, min(STORAGE_POLICY[field]["expire"] for field in encoded))
+        if index is not None:
+            # 索引はページのキーより先に消えないよう、最長の有効期限で書き込むたびに延長する
+            note_id, page_id = index
+            pipe.hset(note_index_key(note_id), page_id, key)
+            pipe.expire(note_index_key(note_id), max_expire)
+        if redis_memory_stats:
+            for field, data in encoded.items():
+                pipe.hincrby(_memory_stats_key(key), f"{field}:bytes", len(data))
+                pipe.hincrby(_memory_stats_key(key), f"{field}:count", 1)
+        # 結果を待っているクライアント（SSE・ロングポーリング）に通知する
+        # NOTE: Redis Clusterのパイプラインではpublishを使えないため、格納した後に送る
+        channel, message = RESULT_CHANNEL_PREFIX + key, ",".join(encoded)
+        if redis_mode != "cluster":
+            pipe.publish(channel, message)
+        try:
+            pipe.execute()
+            if redis_mode == "cluster":
+                r_client.publish(channel, message)
+            # 他のワーカーには通知で伝わるが、このワーカーではすぐに古い値を削除する
+            l1_cache.invalidate(key, list(encoded))
+            return True
+        except redis.RedisError as e:
+            # HEXPIREがないとき以外のエラーで、フィールド単位の有効期限をやめないようにする
+            if hexpire_enabled is False or not _is_hexpire_unsupported(e):
+                raise
+            print("[REDIS] HEXPIREが使えないため、キー単位の有効期限を設定します:", e)
+            hexpire_enabled = False
+
+
+def _read_field(key, field) -> bytes | None:
+    """取得用のクライアント（レプリカ）からフィールドを読み込む
+
+    NOTE: 格納の直後はレプリカに反映されていないことがあるため、レプリカになければマスターから読み込む
+    """
+    value = r_read_client.hget(key, field)
+    if value is None and r_read_client is not r_client:
+        value = r_client.hget(key, field)
+    return value
+
+
+def _get_field(key, field) -> bytes | None:
+    """ハッシュのフィールドを取得する（圧縮されていれば展開する）
+
+    NOTE: 取得した値はプロセス内キャッシュ（L1）に保持し、同じフィールドの読み込みではREDISに問い合わせない
+    """
+    if not l1_cache_enabled:
+        return _decode_field(_read_field(key, field))
+
+    _subscribe_l1_invalidation()
+    value = l1_cache.get(key, field)
+    if value is not None:
+        increment("redis.l1.hits")
+        return value
+
+    increment("redis.l1.misses")
+    generation = l1_cache.generation(key)
+    value = _decode_field(_read_field(key, field))
+    if value is not None:
+        l1_cache.put(key, field, value, generation)
+    return value
+
+
+def _memory_usages(keys: list) -> list:
+    """キーごとのメモリ使用量（バイト）をパイプラインでまとめて取得する"""
+    pipe = r_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return [(size or 0, key) for size, key in zip(pipe.execute(), keys, strict=True)]
+
+
+def redis_memory_report(top_n: int = 20, max_keys: int | None = None) -> dict:
+    """REDISのメモリ使用状況とサイズの大きいキーの一覧を取得する（管理者向け）
+
+    NOTE: キーをSCANするため、通常のリクエスト処理からは呼び出さない。調べるキーはmax_keys個までにし、
+          キーごとの問い合わせはパイプラインにまとめる（サイズの大きいキーの一覧は、調べたキーの中の上位になる）
+
+    Args:
+        top_n (int): 一覧に含めるキーの数
+        max_keys (int | None): 調べるキーの数の上限。Noneの場合は環境変数REDIS_MEMORY_REPORT_MAX_KEYS
+
+    Returns:
+        dict: {'keys': ['key', 'bytes', 'ttl', 'fields'],
+               'records': [{'key':..., 'bytes':..., 'ttl':..., 'fields': {フィールド名: バイト数}}, ...],
+               'scannedKeys': 調べたキーの数, 'truncated': 上限に達して調べていないキーがあるか,
+               'usedMemory':..., 'maxMemory':...,
+               'writtenTotal': {フィールド種別: {'bytes': 書き込んだバイト数の累計, 'count': 書き込んだ件数の累計}},
+               'message': <コメント>}
+
+    NOTE: writtenTotalは書き込みの累計で、有効期限切れ・上書きで消えた分も含む（現在の使用量はrecordsとusedMemoryで確認する）
+    """
+    max_keys = redis_memory_report_max_keys if max_keys is None else max_keys
+    stats_prefix = (MEMORY_STATS_KEY + ":").encode("utf-8")
+    usages, batch, truncated = [], [], False
+    for key in r_client.scan_iter(count=1000):
+        if key.startswith(stats_prefix) or key == MEMORY_STATS_KEY.encode("utf-8"):
+            continue
+        if len(usages) + len(batch) >= max_keys:
+            truncated = True
+            break
+        batch.append(key)
+        if len(batch) >= MEMORY_REPORT_BATCH:
+            usages.extend(_memory_usages(batch))
+            batch = []
+    if batch:
+        usages.extend(_memory_usages(batch))
+    usages.sort(reverse=True)
+    top = [key for _, key in usages[:top_n]]
+
+    # 上位のキーの種類・残りの有効期限と、ハッシュのフィールドごとのサイズを取得する
+    pipe = r_client.pipeline(transaction=False)
+    for key in top:
+        pipe.type(key)
+        pipe.ttl(key)
+    types_ttls = pipe.execute()
+    types, ttls = types_ttls[0::2], types_ttls[1::2]
+
+    hashes = [key for key, key_type in zip(top, types, strict=True) if key_type == b"hash"]
+    pipe = r_client.pipeline(transaction=False)
+    for key in hashes:
+        pipe.hkeys(key)
+    names = dict(zip(hashes, pipe.execute(), strict=True))
+    pipe = r_client.pipeline(transaction=False)
+    for key in hashes:
+        for field in names[key]:
+            pipe.hstrlen(key, field)
+    lengths = iter(pipe.execute())
+    fields = {key: {field.decode("utf-8"): next(lengths) for field in names[key]} for key in hashes}
+
+    records = [
+        {"key": key.decode("utf-8"), "bytes": size, "ttl": ttl, "fields": fields.get(key, {})}
+        for (size, key), ttl in zip(usages[:top_n], ttls, strict=True)
+    ]
+
+    pipe = r_client.pipeline(transaction=False)
+    for shard in range(MEMORY_STATS_SHARDS):
+        pipe.hgetall(f"{MEMORY_STATS_KEY}:{shard}")
+    written_total = {}
+    for stats in pipe.execute():
+        for name, value in stats.items():
+            field, unit = name.decode("utf-8").split(":")
+            written_total.setdefault(field, {}).setdefault(unit, 0)
+            written_total[field][unit] += int(value)
+
+    memory = r_client.info("memory")
+    if "used_memory" not in memory:
+        # Redis Clusterではノードごとの値が返るため、合計する
+        nodes = [info for info in memory.values() if isinstance(info, dict)]
+        memory = {name: sum(info.get(name) or 0 for info in nodes) for name in ("used_memory", "maxmemory")}
+    return {
+        "keys": ["key", "bytes", "ttl", "fields"],
+        "records": records,
+        "scannedKeys": len(usages),
+        "truncated": truncated,
+        "usedMemory": memory.get("used_memory"),
+        "maxMemory": memory.get("maxmemory"),
+        "writtenTotal": written_total,
+        "message": None,
+    }
+
+
+def _page_keys(note_id: str, page_ids) -> tuple[dict, bool]:
+    """ページIDのリスト（またはワイルドカード）を、格納先のキーにする
+
+    NOTE: ワイルドカード（*, ?, [...]）を含むページIDは、SCANせずにノートごとの索引から一致するページを探す
+
+    Returns:
+        tuple[dict, bool]: ({ページID: キー}, ワイルドカードを含むか)
+    """
+    if isinstance(page_ids, str):
+        page_ids = [page_ids]
+    patterns = [page_id for page_id in page_ids if any(c in page_id for c in "*?[")]
+
+    keys = {page_id: make_key(note_id, page_id) for page_id in page_ids if page_id not in patterns}
+    if patterns:
+        index = {
+            page_id.decode("utf-8"): key.decode("utf-8")
+            for page_id, key in r_read_client.hgetall(note_index_key(note_id)).items()
+        }
+        for page_id in sorted(index):
+            if page_id not in keys and any(fnmatch.fnmatchcase(page_id, pattern) for pattern in patterns):
+                keys[page_id] = index[page_id]
+    return keys, bool(patterns)
+
+
+def redis_bulk_get(note_id: str, page_ids, field: str) -> list:
+    """ノートの複数ページのフィールドを1回の往復（パイプライン）でまとめて取得する
+
+    NOTE: ワイルドカード（*, ?, [...]）を含むページIDは、SCANせずにノートごとの索引から一致するページを探す
+
+    Args:
+        note_id (str): eYACHO/GEMBA NoteのノートID
+        page_ids (_type_): ページIDのリスト、またはワイルドカード（"*"で全ページ）
+        field (str): 取得するフィールド（boxes, text, tableなど）
+
+    Returns:
+        list: [(ページID, 値（圧縮されていれば展開したもの）), ...]。格納されていないページは含めない
+    """
+    keys, has_patterns = _page_keys(note_id, page_ids)
+
+    pipe = r_read_client.pipeline(transaction=False)
+    for key in keys.values():
+        pipe.hget(key, field)
+    values = pipe.execute()
+
+    # レプリカに反映されていないページは、マスターから読み込む
+    missing = [key for key, value in zip(keys.values(), values, strict=True) if value is None]
+    if missing and r_read_client is not r_client:
+        pipe = r_client.pipeline(transaction=False)
+        for key in missing:
+            pipe.hget(key, field)
+        found = dict(zip(missing, pipe.execute(), strict=True))
+        values = [found.get(key) if value is None else value for key, value in zip(keys.values(), values, strict=True)]
+
+    # 有効期限が切れたページを索引から削除する
+    expired = [page_id for page_id, value in zip(keys, values, strict=True) if value is None]
+    if has_patterns and expired:
+        r_client.hdel(note_index_key(note_id), *expired)
+
+    return [(page_id, _decode_field(value)) for page_id, value in zip(keys, values, strict=True) if value is not None]
+
+
+def redis_note_pages(note_id: str, page_ids, fields: list) -> list:
+    """ノートのページのうち、指定したフィールドのいずれかが格納されているページを探す（値は読み込まない）
+
+    NOTE: ページごとにフィールドの有無（HEXISTS）だけをパイプラインでまとめて問い合わせる。
+          値はページごとにredis_page_fields_getで読み込む
+
+    Args:
+        note_id (str): eYACHO/GEMBA NoteのノートID
+        page_ids (_type_): ページIDのリスト、またはワイルドカード（"*"で全ページ）
+        fields (list): 探すフィールドのリスト
+
+    Returns:
+        list: [(ページID, キー), ...]（redis_bulk_getと同じ順）
+    """
+    keys, has_patterns = _page_keys(note_id, page_ids)
+
+    def stored_keys(client, candidates: list) -> set:
+        pipe = client.pipeline(transaction=False)
+        for key in candidates:
+            for field in fields:
+                pipe.hexists(key, field)
+        exists = pipe.execute()
+        return {key for i, key in enumerate(candidates) if any(exists[i * len(fields) : (i + 1) * len(fields)])}
+
+    found = stored_keys(r_read_client, list(keys.values()))
+    # レプリカに反映されていないページは、マスターに問い合わせる
+    missing = [key for key in keys.values() if key not in found]
+    if missing and r_read_client is not r_client:
+        found |= stored_keys(r_client, missing)
+
+    # 有効期限が切れたページを索引から削除する
+    expired = [page_id for page_id, key in keys.items() if key not in found]
+    if has_patterns and expired:
+        r_client.hdel(note_index_key(note_id), *expired)
+
+    return [(page_id, key) for page_id, key in keys.items() if key in found]
+
+
+def redis_page_fields_get(key, fields: list) -> dict:
+    """1ページの複数のフィールドを1回の往復でまとめて取得する
+
+    Args:
+        key (_type_): REDISに格納されたキー
+        fields (list): 取得するフィールドのリスト
+
+    Returns:
+        dict: {フィールド: 値（圧縮されていれば展開したもの。格納されていなければNone）}
+    """
+    values = r_read_client.hmget(key, fields)
+    # レプリカに反映されていなければ、マスターから読み込む
+    if all(value is None for value in values) and r_read_client is not r_client:
+        values = r_client.hmget(key, fields)
+    return {field: _decode_field(value) for field, value in zip(fields, values, strict=True)}
+
+
+def redis_pages_get(key, field) -> dict | None:
+    """前回の抽出で格納したページごとのフィンガープリントと抽出結果を取得する
+
+    Args:
+        key (_type_): REDISに格納されたキー
+        field (_type_): text_pages または table_pages
+
+    Returns:
+        dict | None: 格納された情報（なければNone）
+    """
+    packed = _get_field(key, field)
+    if packed is None:
+        return None
+    return unpack_result(packed)
+
+
+def redis_qa_index_get(key) -> dict | None:
+    """質問応答用のチャンクとBM25の索引を取得する
+
+    Args:
+        key (_type_): REDISに格納されたキー
+
+    Returns:
+        dict | None: 索引（なければNone）
+    """
+    packed = _get_field(key, "qa_index")
+    if packed is None:
+        return None
+    return unpack_result(packed)
+
 
 # ==================================================================================================
 # 表データ系のREDIS処理
 # ==================================================================================================
 
 
-def redis_table_put(key, table) -> bool:
+def redis_table_put(key, table, pages=None, index=None) -> bool:
     """テーブルデータをREDISに格納する
 
     Args:
         key (_type_): REDISに格納するときのキー
-        table (_type_): テーブルデータ（JSON形式）
+        table (_type_): テーブルデータ（JSON形式）。列ごとに辞書符号化した形式（ColumnarTable）にして格納する
+        pages (_type_): 抽出したページのフィンガープリント（再アップロード時の再利用に使う）
+        index (_type_): (ノートID, ページID)。指定するとノートごとの索引に登録する（一括取得に使う）
 
     Returns:
         bool: True - REDISへの格納が成功、False - 失敗
     """
     Status = True
+    fields = {"table": pack_result(ColumnarTable.from_dict(table).to_packed())}
+    if pages is not None:
+        fields["table_pages"] = pack_result(pages)
     # REDISにテーブルを格納
     try:
-        r_client.hset(key, "table", json.dumps(table, ensure_ascii=False, indent=2))
-        r_client.expire(key, redis_duration)  # 有効期限を設定する
+        Status = _put_fields(key, fields, index)
     except Exception as e:
         print(e)
         Status = False
@@ -76,16 +704,41 @@ def redis_table_get(key) -> dict:
     Returns:
         dict: テーブルデータ（JSON形式）
     """
-    json_string = r_client.hget(key, "table")
-    if json_string is None:
+    packed = _get_field(key, "table")
+    if packed is None:
         return {"message": "テーブルはありません"}
 
-    table = json.loads(json_string)
+    table = unpack_table(packed).to_dict()
 
     table["message"] = "表を読み込みました"
     return table
 
 
+def redis_table_query(key, offset: int = 0, limit: int | None = None, columns=None, filters=None) -> dict:
+    """REDISからテーブルデータを取得し、条件に一致する行の指定した範囲・列だけを返す
+
+    Args:
+        key (_type_): REDISに格納されたキー
+        offset (int): 返す最初の行（絞り込んだ後の行の番号, 0始まり）
+        limit (int | None): 返す行数の上限。Noneの場合はすべて
+        columns (_type_): 返す列のリスト。Noneの場合はすべての列
+        filters (_type_): [{'key': 列, 'op': eq/ne/contains, 'value': 値}, ...]
+
+    Returns:
+        dict: {'keys': [...], 'records': [...], 'total': 絞り込んだ行数, 'offset': ..., 'limit': ..., 'message': ...}
+
+    Raises:
+        TableQueryError: offset・limitが負の場合、存在しない列や対応していない演算子を指定した場合
+    """
+    packed = _get_field(key, "table")
+    if packed is None:
+        return {"message": "テーブルはありません"}
+
+    table = unpack_table(packed).select(offset, limit, columns, filters)
+    table["message"] = "表を読み込みました"
+    return table
+
+
 # ==================================================================================================
 # 物体検出系のREDIS処理
 # ==================================================================================================
@@ -107,7 +760,7 @@ def redis_image_get(key) -> dict:
     results["message"] = "検出画像はありません"
 
     # REDISから画像を取得する
-    image_string = r_client.hget(key, "image")
+    image_string = _get_field(key, "image")
     if image_string is None:
         return results
 
@@ -144,23 +797,24 @@ def redis_box_get(key):
     init_val["message"] = "検出結果がありません"
 
     # REDISから物体検出情報を取得する
-    json_string = r_client.hget(key, "boxes")
-    if json_string is None:
+    packed = _get_field(key, "boxes")
+    if packed is None:
         return init_val
 
-    # 文字列をJSON構造に変換する
-    boxes = json.loads(json_string)
+    # 格納されたバイナリをJSON構造に変換する
+    boxes = unpack_result(packed)
     return boxes
 
 
-def redis_image_put(key, output_image_file, detected_boxes) -> bool:
+def redis_image_put(key, output_image_file, detected_boxes, index=None) -> bool:
     """検出された画像データと検出結果をREDISに格納する
 
-    NOTE: REDISへは、ハッシュとしてimageキーとboxesキーを有効期限付きで格納する
+    NOTE: REDISへは、ハッシュとしてimageキーとboxesキーを保存ポリシーの有効期限付きで格納する
 
     Args:
         key (_type_): REDISに格納するときのキー
-        output_image_file (_type_): 出力画像ファイル名
+        output_image_file (_type_): 出力画像ファイル名、またはJPEGのバイナリ
+        index (_type_): (ノートID, ページID)。指定するとノートごとの索引に登録する（一括取得に使う）
         detected_boxes (_type_): 物体が検出された領域（JSON形式）
         {'keys': ['objName', 'probability', 'topX', 'topY', 'bottomX', 'bottomY'],
             'records': [
@@ -174,17 +828,39 @@ def redis_image_put(key, output_image_file, detected_boxes) -> bool:
         _type_: True - REDISへの格納が成功、False - 失敗
     """
     Status = True
-    # Base64文字列に変換する
-    with open(output_image_file, "rb") as image_file:
-        data = base64.b64encode(image_file.read())
+    # Base64文字列に変換する（JPEGのバイナリが渡された場合はそのまま変換する）
+    if isinstance(output_image_file, bytes):
+        data = base64.b64encode(output_image_file)
+    else:
+        with open(output_image_file, "rb") as image_file:
+            data = base64.b64encode(image_file.read())
 
     img_text = "data:image/jpeg;base64," + data.decode("utf-8")
 
     # REDISにハッシュとして格納
     try:
-        r_client.hset(key, "image", img_text)
-        r_client.hset(key, "boxes", json.dumps(detected_boxes))
-        r_client.expire(key, redis_duration)  # 有効期限を設定する
+        Status = _put_fields(key, {"image": img_text, "boxes": pack_result(detected_boxes)}, index)
+    except Exception as e:
+        print(e)
+        Status = False
+
+    return Status
+
+
+def redis_box_put(key, detected_boxes, index=None) -> bool:
+    """物体検出結果だけをREDISに格納する（PDFの全ページの検出結果など、画像を伴わない場合に使う）
+
+    Args:
+        key (_type_): REDISに格納するときのキー
+        detected_boxes (_type_): 物体が検出された領域（JSON形式）
+        index (_type_): (ノートID, ページID)。指定するとノートごとの索引に登録する（一括取得に使う）
+
+    Returns:
+        bool: True - REDISへの格納が成功、False - 失敗
+    """
+    Status = True
+    try:
+        Status = _put_fields(key, {"boxes": pack_result(detected_boxes)}, index)
     except Exception as e:
         print(e)
         Status = False
@@ -192,26 +868,86 @@ def redis_image_put(key, output_image_file, detected_boxes) -> bool:
     return Status
 
 
+# ==================================================================================================
+# セグメンテーション系のREDIS処理
+# ==================================================================================================
+
+
+def redis_mask_put(key, segmentation: dict, background_jpeg: bytes | None = None, index=None) -> bool:
+    """セグメンテーション結果（マスクのRLE・多角形など）をREDISに格納する
+
+    NOTE: マスクを描画した画像は格納せず、取得時にRLEから描画する（背景に使う入力画像の縮小版だけを格納する）
+
+    Args:
+        key (_type_): REDISに格納するときのキー
+        segmentation (dict): セグメンテーション結果（SegmentationResult.to_dict()）
+        background_jpeg (bytes | None): 描画時の背景に使う入力画像の縮小版（JPEG）
+        index (_type_): (ノートID, ページID)。指定するとノートごとの索引に登録する（一括取得に使う）
+
+    Returns:
+        bool: True - REDISへの格納が成功、False - 失敗
+    """
+    Status = True
+    fields = {"masks": pack_result(segmentation)}
+    if background_jpeg is not None:
+        fields["mask_image"] = background_jpeg
+    try:
+        Status = _put_fields(key, fields, index)
+    except Exception as e:
+        print(e)
+        Status = False
+
+    return Status
+
+
+def redis_mask_get(key) -> dict | None:
+    """セグメンテーション結果を取得する
+
+    Args:
+        key (_type_): REDISに格納されたキー
+
+    Returns:
+        dict | None: セグメンテーション結果（SegmentationResult.to_dict()の形式）。格納されていない場合はNone
+    """
+    packed = _get_field(key, "masks")
+    if packed is None:
+        return None
+    return unpack_result(packed)
+
+
+def redis_mask_image_get(key) -> bytes | None:
+    """マスクを描画するときの背景（入力画像の縮小版, JPEG）を取得する"""
+    return _get_field(key, "mask_image")
+
+
 # ==================================================================================================
 # テキスト抽出系のREDIS処理
 # ==================================================================================================
 
 
-def redis_text_put(key, text) -> bool:
+def redis_text_put(key, text, pages=None, index=None, qa_index=None) -> bool:
     """抽出したテキストをREDISに格納する
 
     Args:
         key (_type_): REDISに格納するときのキー
         text (_type_): 抽出したテキスト
+        pages (_type_): ページごとのフィンガープリントとテキスト、抽出の設定（再アップロード時の再利用に使う）
+            {'fingerprints': [...], 'texts': [...], 'settings': [エンジン, OCRするか, OCRの解像度]}
+        index (_type_): (ノートID, ページID)。指定するとノートごとの索引に登録する（一括取得に使う）
+        qa_index (_type_): 質問応答用のチャンクとBM25の索引（qa_util.build_qa_indexの結果）
 
     Returns:
         bool: True - REDISへの格納が成功、False - 失敗
     """
     Status = True
+    fields = {"text": text}
+    if pages is not None:
+        fields["text_pages"] = pack_result(pages)
+    if qa_index is not None:
+        fields["qa_index"] = pack_result(qa_index)
     # REDISにテキストを格納
     try:
-        r_client.hset(key, "text", text)
-        r_client.expire(key, redis_duration)  # 有効期限を設定する
+        Status = _put_fields(key, fields, index)
     except Exception as e:
         print(e)
         Status = False
@@ -229,7 +965,7 @@ def redis_text_get(key) -> dict:
         dict: 抽出したテキストを含むJSON形式
     """
     # REDISからテキストを取得する
-    text = r_client.hget(key, "text")
+    text = _get_field(key, "text")
     if text is None:
         return {"outputText": "テキストはありません"}
 
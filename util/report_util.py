@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# [FILE] report_util.py
+#
+# [DESCRIPTION]
+#  ノートのページごとの物体検出結果・抽出したテキスト・表をPDFの報告書にする
+#  - ページごとの結果は描画に投入するときに1ページずつ読み込み、ノート全体をまとめて保持しない
+#  - ページごとの章をプロセスプールで並列にreportlabで描画する（フォントの登録と画像の読み込みはワーカーごとに1回だけ行う）
+#  - 描画し終えた章から順にPDFium上の1つの文書に取り込み、一時ファイルに保存する
+#  - クライアントには、報告書をすべて組み立てて一時ファイルに保存し終えてから、一時ファイルをチャンクごとに送る
+#    （出力全体をbytesで保持しない。PDFは末尾のxrefで完結するため、最初のバイトを送るのは報告書が完成した後）
+#
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from xml.sax.saxutils import escape
+
+import pypdfium2 as pdfium
+from dotenv import load_dotenv
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import Flowable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from util.pdf_render_util import pdfium_lock
+
+load_dotenv()
+
+# 報告書に使う日本語フォント（TTF）。ファイルがない場合はreportlab内蔵のCIDフォントを使う
+report_font_file = os.environ.get("REPORT_FONT_FILE", "PoC/NotoSansJP-Regular.ttf")
+REPORT_FONT_NAME = "NotoSansJP"
+FALLBACK_FONT_NAME = "HeiseiKakuGo-W5"
+
+# 章を描画するプロセス数と、ワーカーごとに読み込んだ画像を保持する数
+report_workers = int(os.environ.get("REPORT_WORKERS", "2"))
+report_image_cache_size = int(os.environ.get("REPORT_IMAGE_CACHE_SIZE", "64"))
+
+# クライアントに送るときのチャンクの大きさ（バイト）
+REPORT_STREAM_CHUNK_BYTES = 64 * 1024
+
+# 検出画像の大きさの上限（ページの本文の幅・高さに対する割合）
+IMAGE_WIDTH_RATIO = 0.9
+IMAGE_HEIGHT_RATIO = 0.6
+
+# ワーカーごとに読み込んだ画像（{JPEGのハッシュ値: ImageReader}）
+_images = OrderedDict()
+
+
+@lru_cache(maxsize=1)
+def register_font() -> str:
+    """日本語フォントを登録する（プロセスごとに1回だけ登録する）
+
+    Returns:
+        str: 登録したフォント名
+    """
+    if os.path.exists(report_font_file):
+        pdfmetrics.registerFont(TTFont(REPORT_FONT_NAME, report_font_file))
+        return REPORT_FONT_NAME
+    print(f"[REPORT] フォントファイル({report_font_file})がないため、{FALLBACK_FONT_NAME}を使います")
+    pdfmetrics.registerFont(UnicodeCIDFont(FALLBACK_FONT_NAME))
+    return FALLBACK_FONT_NAME
+
+
+def _image_reader(jpeg: bytes) -> ImageReader:
+    """JPEGを読み込む（同じ画像はワーカーごとに1回だけ読み込む）"""
+    digest = hashlib.sha1(jpeg).digest()
+    reader = _images.get(digest)
+    if reader is None:
+        reader = ImageReader(io.BytesIO(jpeg))
+        _images[digest] = reader
+        while len(_images) > report_image_cache_size:
+            _images.popitem(last=False)
+    else:
+        _images.move_to_end(digest)
+    return reader
+
+
+class _CachedImage(Flowable):
+    """読み込み済みの画像を、縦横比を保って指定した大きさに収めて描画する"""
+
+    def __init__(self, reader: ImageReader, max_width: float, max_height: float):
+        super().__init__()
+        self.reader = reader
+        width, height = reader.getSize()
+        scale = min(max_width / width, max_height / height, 1.0)
+        self.drawWidth = width * scale
+        self.drawHeight = height * scale
+
+    def wrap(self, available_width, available_height):  # noqa: ARG002 - Flowable.wrapの引数。大きさは生成時に決めている
+        return self.drawWidth, self.drawHeight
+
+    def draw(self):
+        self.canv.drawImage(self.reader, 0, 0, width=self.drawWidth, height=self.drawHeight)
+
+
+def _init_worker():
+    register_font()
+
+
+@lru_cache(maxsize=1)
+def _get_pool() -> ProcessPoolExecutor:
+    """報告書用のプロセスプールを取得する（初回利用時に生成する）
+
+    NOTE: サーバーのスレッドを引き継がないよう、ワーカーはspawnで起動し、起動時にフォントを登録する
+    """
+    return ProcessPoolExecutor(
+        max_workers=report_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+    )
+
+
+# ==================================================================================================
+# 章の描画（プロセスプールのワーカーで実行する）
+# ==================================================================================================
+
+
+def _grid(keys: list, records: list, font: str) -> Table:
+    """keys/recordsの表を描画する"""
+    style = ParagraphStyle("cell", fontName=font, fontSize=8, leading=10)
+    # Paragraphはセルの文字列をマークアップとして解釈するため、<や&をエスケープする
+    rows = [[Paragraph(escape(str(key)), style) for key in keys]]
+    rows += [[Paragraph(escape(str(record.get(key, ""))), style) for key in keys] for record in records]
+    table = Table(rows, repeatRows=1)
+    table.setStyle(
+        TableStyle(
+            [
+                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+                ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
+                ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ]
+        )
+    )
+    return table
+
+
+def render_section(section: dict) -> bytes:
+    """ノートの1ページ分の章をPDFに描画する
+
+    Args:
+        section (dict): {'pageId': ページID, 'image': 検出画像（JPEG）, 'boxes': 検出結果, 'text': テキスト, 'table': 表}
+                        （pageId以外は、格納されていなければNone）
+
+    Returns:
+        bytes: 章のPDF
+    """
+    font = register_font()
+    heading = ParagraphStyle("heading", fontName=font, fontSize=14, leading=20, spaceAfter=4 * mm)
+    subheading = ParagraphStyle("subheading", fontName=font, fontSize=11, leading=16, spaceBefore=4 * mm)
+    body = ParagraphStyle("body", fontName=font, fontSize=9, leading=14)
+
+    buffer = io.BytesIO()
+    document = SimpleDocTemplate(
+        buffer, pagesize=A4, leftMargin=15 * mm, rightMargin=15 * mm, topMargin=15 * mm, bottomMargin=15 * mm
+    )
+    story = [Paragraph(f"ページ: {escape(str(section['pageId']))}", heading)]
+
+    if section.get("image"):
+        reader = _image_reader(section["image"])
+        story.append(_CachedImage(reader, document.width * IMAGE_WIDTH_RATIO, document.height * IMAGE_HEIGHT_RATIO))
+    boxes = section.get("boxes")
+    if boxes and boxes.get("records"):
+        story += [Paragraph("物体検出結果", subheading), _grid(boxes["keys"], boxes["records"], font)]
+
+    if section.get("text"):
+        story.append(Paragraph("抽出したテキスト", subheading))
+        for line in section["text"].splitlines():
+            if line.strip():
+                story.append(Paragraph(escape(line), body))
+
+    table = section.get("table")
+    if table and table.get("records"):
+        story += [Paragraph("表", subheading), _grid(table["keys"], table["records"], font)]
+
+    if len(story) == 1:
+        story += [Spacer(1, 4 * mm), Paragraph("結果はありません", body)]
+    document.build(story)
+    return buffer.getvalue()
+
+
+# ==================================================================================================
+# 報告書の生成と送信
+# ==================================================================================================
+
+
+def render_report(sections):
+    """章をプロセスプールで並列に描画し、描画し終えた順に1つの文書に取り込んで一時ファイルに保存する
+
+    NOTE: 章は必要になった時点でsectionsから1つずつ取り出し、描画中の章がREPORT_WORKERSの2倍を超えないように投入する。
+          sectionsにジェネレーターを渡せば、ノートの結果を保持するのは描画中の章の分だけになる。
+          取り込んだ章のPDFはすぐに解放する。
+          PDFiumの呼び出し（章の取り込みと保存）はpdfium_lockで他の処理と1つずつ実行し、
+          送信を始める前（アドミッション制御の実行枠を返す前）に保存まで終える。
+          PDFは末尾の相互参照表（xref）で完結するため、PDFiumは文書をすべて組み立ててからでないと保存できず、
+          描画した章から順にクライアントへ送ることはできない
+
+    Args:
+        sections (_type_): render_sectionに渡す章（報告書の順）のイテラブル
+
+    Returns:
+        _type_: 報告書を保存した一時ファイル（先頭に戻したもの。stream_reportで送信し、閉じると削除される）
+    """
+    pool = _get_pool()
+    window = max(1, report_workers * 2)
+    sections = iter(sections)
+    futures = deque()
+    with pdfium_lock:
+        document = pdfium.PdfDocument.new()
+    output = tempfile.TemporaryFile(suffix=".pdf")
+    try:
+        futures.extend(pool.submit(render_section, section) for section in islice(sections, window))
+        while futures:
+            data = futures.popleft().result()
+            futures.extend(pool.submit(render_section, section) for section in islice(sections, 1))
+            with pdfium_lock:
+                piece = pdfium.PdfDocument(data)
+                try:
+                    document.import_pages(piece)
+                finally:
+                    piece.close()
+        with pdfium_lock:
+            document.save(output)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        output.close()
+        raise
+    finally:
+        with pdfium_lock:
+            document.close()
+    output.seek(0)
+    return output
+
+
+def stream_report(output):
+    """一時ファイルに保存した報告書をチャンクごとに返す（StreamingResponseに渡すジェネレーター）
+
+    Args:
+        output (_type_): render_reportが返した一時ファイル
+
+    Yields:
+        bytes: PDFのデータ（REPORT_STREAM_CHUNK_BYTESごと）
+    """
+    try:
+        while chunk := output.read(REPORT_STREAM_CHUNK_BYTES):
+            yield chunk
+    finally:
+        output.close()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+#
+# [FILE] response_util.py
+#
+# [DESCRIPTION]
+#  レスポンスのJSONをorjsonで高速にシリアライズするレスポンスクラスを定義する
+#  （FastAPIのORJSONResponseは非推奨になったため、同じ処理をここで定義する）
+#
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class FastJSONResponse(JSONResponse):
+    """orjsonでシリアライズするJSONレスポンス（numpyの配列・数値型、文字列以外の辞書のキーもそのまま扱える）"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# [FILE] result_util.py
+#
+# [DESCRIPTION]
+#  検出結果・テキスト・表の結果モデルと、REDIS格納用のシリアライズ処理を定義する
+#
+import json
+from array import array
+from dataclasses import dataclass, field
+
+import msgpack
+
+# ==================================================================================================
+# 結果モデル
+# ==================================================================================================
+
+
+@dataclass
+class DetectedBox:
+    """検出された物体1件"""
+
+    objName: str
+    probability: float
+    topX: int
+    topY: int
+    bottomX: int
+    bottomY: int
+
+    @classmethod
+    def from_detection(cls, detection: dict) -> "DetectedBox":
+        """ImageAIの検出結果1件から生成する（numpyの数値型はPythonの数値型に変換する）
+
+        Args:
+            detection (dict): {'name':..., 'percentage_probability':..., 'box_points':[x1, y1, x2, y2]}
+
+        Returns:
+            DetectedBox: 検出された物体
+        """
+        box = [int(v) for v in detection["box_points"]]
+        return cls(str(detection["name"]), float(detection["percentage_probability"]), box[0], box[1], box[2], box[3])
+
+    def to_dict(self) -> dict:
+        return {
+            "objName": self.objName,
+            "probability": self.probability,
+            "topX": self.topX,
+            "topY": self.topY,
+            "bottomX": self.bottomX,
+            "bottomY": self.bottomY,
+        }
+
+
+@dataclass
+class DetectionResult:
+    """物体検出結果"""
+
+    KEYS = ("objName", "probability", "topX", "topY", "bottomX", "bottomY")
+
+    records: list[DetectedBox] = field(default_factory=list)
+    message: str | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DetectionResult":
+        records = [DetectedBox(**record) for record in data.get("records", [])]
+        return cls(records, data.get("message"))
+
+    def to_dict(self) -> dict:
+        """REST用アグリゲーションの出力構造に変換する"""
+        return {"keys": list(self.KEYS), "records": [record.to_dict() for record in self.records], "message": self.message}
+
+
+@dataclass
+class TextResult:
+    """テキスト抽出結果"""
+
+    KEYS = ("outputText",)
+
+    text: str
+    message: str | None = None
+
+    def to_dict(self) -> dict:
+        """REST用アグリゲーションの出力構造に変換する"""
+        return {"keys": list(self.KEYS), "records": [{"outputText": self.text}], "message": self.message}
+
+
+def normalize_headers(headers: list) -> list[str]:
+    """表のヘッダーを、レコードの辞書のキーにできる重複のない文字列にする
+
+    NOTE: pdfplumberは結合セルや空のセルのヘッダーをNoneで返す。空のヘッダーは列番号（col1, col2, ...）にし、
+          重複したヘッダーには番号を付ける（例：数量, 数量_2）
+
+    Args:
+        headers (list): 表の1行目
+
+    Returns:
+        list[str]: ヘッダー
+    """
+    normalized = []
+    for col_idx, header in enumerate(headers):
+        name = f"col{col_idx + 1}" if header is None or str(header).strip() == "" else str(header)
+        candidate, suffix = name, 2
+        while candidate in normalized:
+            candidate, suffix = f"{name}_{suffix}", suffix + 1
+        normalized.append(candidate)
+    return normalized
+
+
+@dataclass
+class TableResult:
+    """表抽出結果"""
+
+    keys: list[str] = field(default_factory=list)
+    records: list[dict] = field(default_factory=list)
+    message: str | None = None
+
+    @classmethod
+    def from_rows(cls, rows: list[list]) -> "TableResult":
+        """pdfplumberが返す表（1行目がヘッダー）から生成する
+
+        Args:
+            rows (list[list]): [[header1, header2, ...], [record1_1, record1_2, ...], ...]
+
+        Returns:
+            TableResult: 表抽出結果
+        """
+        headers = normalize_headers(rows[0])
+        records = [{header: row[col_idx] for col_idx, header in enumerate(headers)} for row in rows[1:]]
+        return cls(headers, records)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TableResult":
+        return cls(data.get("keys", []), data.get("records", []), data.get("message"))
+
+    def to_dict(self) -> dict:
+        """REST用アグリゲーションの出力構造に変換する"""
+        return {"keys": self.keys, "records": self.records, "message": self.message}
+
+
+# 表の絞り込みの演算子（eq: 一致, ne: 不一致, contains: 部分一致（大文字・小文字を区別しない））
+TABLE_FILTER_OPS = ["eq", "ne", "contains"]
+
+
+class TableQueryError(ValueError):
+    """表の取得条件（範囲・列・絞り込み）が正しくない（ステータスコード400を返す）"""
+
+
+def _matches(value, op: str, operand) -> bool:
+    if op == "contains":
+        return value is not None and str(operand).casefold() in str(value).casefold()
+    equal = value == operand or (value is not None and operand is not None and str(value) == str(operand))
+    return equal if op == "eq" else not equal
+
+
+@dataclass
+class ColumnarTable:
+    """列ごとに辞書符号化した表（REDIS格納用）
+
+    列ごとに値の一覧（dictionaries）と、行ごとの値の番号（codes, 値の種類が65536未満なら2バイト、以上なら4バイトの配列）を持つ。
+    同じ値が繰り返される仕様表を小さく格納でき、一致の絞り込みは値の一覧を1回比べるだけで行える
+    """
+
+    keys: list
+    dictionaries: list[list]
+    codes: list[array]
+    rows: int
+    message: str | None = None
+
+    FORMAT = "columnar-v1"
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ColumnarTable":
+        """行形式の表（keys/records）から生成する
+
+        NOTE: ヘッダーを文字列にする前に格納された表は、Noneなどのヘッダーをnormalize_headersの名前に置き換える
+              （json.dumpsで格納された表では、レコードのキーは"null"などの文字列になっている）
+        """
+        original_keys = list(data.get("keys", []))
+        keys = normalize_headers(original_keys)
+        records = data.get("records", [])
+        dictionaries, codes = [], []
+        for original in original_keys:
+            alias = original if isinstance(original, str) else json.dumps(original)
+            index = {}
+            column = [
+                index.setdefault(_hashable(record[original] if original in record else record.get(alias)), len(index))
+                for record in records
+            ]
+            values = list(index)
+            dictionaries.append(values)
+            codes.append(array("H" if len(values) < 65536 else "I", column))
+        return cls(keys, dictionaries, codes, len(records), data.get("message"))
+
+    @classmethod
+    def from_packed(cls, data: dict) -> "ColumnarTable":
+        """REDISに格納した形式から復元する（ヘッダーを文字列にする前に格納された表のヘッダーも文字列にする）"""
+        rows = data["rows"]
+        codes = []
+        for raw in data["codes"]:
+            column = array("H" if rows == 0 or len(raw) // rows == 2 else "I")
+            column.frombytes(raw)
+            codes.append(column)
+        return cls(normalize_headers(data["keys"]), data["dictionaries"], codes, rows, data.get("message"))
+
+    def to_packed(self) -> dict:
+        """REDISに格納する形式に変換する（pack_resultでmsgpackにする）"""
+        return {
+            "format": self.FORMAT,
+            "keys": self.keys,
+            "dictionaries": self.dictionaries,
+            "codes": [column.tobytes() for column in self.codes],
+            "rows": self.rows,
+            "message": self.message,
+        }
+
+    def to_dict(self) -> dict:
+        """行形式の表（keys/records）に戻す"""
+        selected = self.select()
+        return {"keys": selected["keys"], "records": selected["records"], "message": self.message}
+
+    def select(self, offset: int = 0, limit: int | None = None, columns: list | None = None, filters: list | None = None) -> dict:
+        """条件に一致する行を絞り込み、指定した範囲・列だけを行形式で返す
+
+        Args:
+            offset (int): 返す最初の行（絞り込んだ後の行の番号, 0始まり）
+            limit (int | None): 返す行数の上限。Noneの場合はすべて
+            columns (list | None): 返す列。Noneの場合はすべての列
+            filters (list | None): [{'key': 列, 'op': eq/ne/contains, 'value': 値}, ...]（すべてを満たす行を返す）
+
+        Returns:
+            dict: {'keys': [...], 'records': [...], 'total': 絞り込んだ行数, 'offset': ..., 'limit': ..., 'message': ...}
+
+        Raises:
+            TableQueryError: offset・limitが負の場合、存在しない列や対応していない演算子を指定した場合
+        """
+        if offset < 0 or (limit is not None and limit < 0):
+            raise TableQueryError(f"offsetとlimitは0以上で指定してください: offset={offset}, limit={limit}")
+        columns = self.keys if columns is None else columns
+        positions = [self._position(key) for key in columns]
+
+        rows = range(self.rows)
+        for condition in filters or []:
+            op = condition.get("op", "eq")
+            if op not in TABLE_FILTER_OPS:
+                raise TableQueryError(f"対応していない演算子です: {op}")
+            position = self._position(condition.get("key"))
+            # 値の一覧で条件を評価し、一致した値の番号を持つ行だけを残す
+            matched = {
+                code for code, value in enumerate(self.dictionaries[position]) if _matches(value, op, condition.get("value"))
+            }
+            codes = self.codes[position]
+            rows = [row for row in rows if codes[row] in matched]
+
+        total = len(rows)
+        selected = rows[offset:] if limit is None else rows[offset : offset + limit]
+        records = [
+            {
+                key: self.dictionaries[position][self.codes[position][row]]
+                for key, position in zip(columns, positions, strict=True)
+            }
+            for row in selected
+        ]
+        return {
+            "keys": list(columns),
+            "records": records,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "message": self.message,
+        }
+
+    def _position(self, key) -> int:
+        if key not in self.keys:
+            raise TableQueryError(f"列がありません: {key}")
+        return self.keys.index(key)
+
+
+def _hashable(value):
+    """辞書符号化のため、セルの値を辞書のキーにできる形にする（リストなどは文字列にする）"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return json.dumps(value, ensure_ascii=False)
+
+
+def unpack_table(raw: bytes | str) -> ColumnarTable:
+    """REDISに格納された表を復元する（列形式にする前に格納された行形式の表も読み込める）
+
+    Args:
+        raw (bytes | str): REDISから取得した値
+
+    Returns:
+        ColumnarTable: 表
+    """
+    data = unpack_result(raw)
+    if data.get("format") == ColumnarTable.FORMAT:
+        return ColumnarTable.from_packed(data)
+    return ColumnarTable.from_dict(data)
+
+
+@dataclass
+class SegmentMask:
+    """セグメンテーションで抽出したマスク1件（座標は元の画像の座標）"""
+
+    maskId: int
+    score: float
+    area: int
+    topX: int
+    topY: int
+    bottomX: int
+    bottomY: int
+    rle: dict  # マスクのランレングス符号（前処理で縮小した画像の大きさ）
+    polygons: list  # 単純化した輪郭の多角形（[x1, y1, x2, y2, ...]のリスト）
+
+    def to_dict(self) -> dict:
+        return {
+            "maskId": self.maskId,
+            "score": self.score,
+            "area": self.area,
+            "topX": self.topX,
+            "topY": self.topY,
+            "bottomX": self.bottomX,
+            "bottomY": self.bottomY,
+            "rle": self.rle,
+            "polygons": self.polygons,
+        }
+
+
+@dataclass
+class SegmentationResult:
+    """セグメンテーション結果"""
+
+    KEYS = ("maskId", "score", "area", "topX", "topY", "bottomX", "bottomY", "rle", "polygons")
+
+    records: list[SegmentMask] = field(default_factory=list)
+    width: int = 0  # 元の画像の幅
+    height: int = 0  # 元の画像の高さ
+    message: str | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SegmentationResult":
+        records = [SegmentMask(**record) for record in data.get("records", [])]
+        return cls(records, data.get("width", 0), data.get("height", 0), data.get("message"))
+
+    def to_dict(self, keys: list[str] | None = None) -> dict:
+        """REST用アグリゲーションの出力構造に変換する
+
+        Args:
+            keys (list[str] | None): 出力するキー（rle・polygonsを省略する場合などに指定する）。Noneの場合はすべて
+        """
+        keys = keys or list(self.KEYS)
+        records = [{key: value for key, value in record.to_dict().items() if key in keys} for record in self.records]
+        return {"keys": keys, "records": records, "width": self.width, "height": self.height, "message": self.message}
+
+
+def merge_page_results(page_results: list) -> dict:
+    """ページごとの結果（keys/records）を、ページIDの列を付けて1つにまとめる
+
+    Args:
+        page_results (list): [(ページID, 結果（JSON形式）), ...]
+
+    Returns:
+        dict: {'keys': ['pageId', ...各ページのkeysの和集合], 'records': [{'pageId':..., ...}, ...],
+               'pages': ページ数, 'message':...}
+    """
+    keys = ["pageId"]
+    records = []
+    for page_id, result in page_results:
+        for key in result.get("keys", []):
+            if key not in keys:
+                keys.append(key)
+        records.extend({"pageId": page_id, **record} for record in result.get("records", []))
+    message = None if records else "結果がありません"
+    return {"keys": keys, "records": records, "pages": len(page_results), "message": message}
+
+
+# ==================================================================================================
+# REDIS格納用のシリアライズ処理
+# ==================================================================================================
+
+
+def pack_result(data: dict) -> bytes:
+    """結果をREDIS格納用のバイナリ（msgpack）に変換する
+
+    Args:
+        data (dict): 結果（JSON形式）
+
+    Returns:
+        bytes: msgpackでエンコードしたバイナリ
+    """
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack_result(raw: bytes | str) -> dict:
+    """REDISに格納された結果を復元する
+
+    NOTE: 移行前にjson.dumpsで格納されたデータ（先頭が"{"または"["）も読み込める。
+          ヘッダーがNoneの表など、文字列以外のキーを含む格納済みのデータも読み込めるよう、キーの型は制限しない
+
+    Args:
+        raw (bytes | str): REDISから取得した値
+
+    Returns:
+        dict: 結果（JSON形式）
+    """
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if raw[:1] in (b"{", b"["):
+        return json.loads(raw)
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+# [FILE] search_util.py
+#
+# [DESCRIPTION]
+#  抽出したテキストの全文検索（ノート・ページをまたいで検索する）
+#  - テキストの抽出のたびに、そのページの転置索引（語 → ソート済みセット{キー: 出現回数}）をREDISで更新する
+#  - 語は質問応答（qa_util）と同じく、英数字は単語、日本語などは文字bigramにする
+#  - 検索では最も出現の少ない語の索引から候補を取り、残りの語はZMSCOREで候補だけを確かめる（格納済みのテキストは走査しない）
+#
+import math
+import os
+import time
+import zlib
+from collections import Counter
+
+from dotenv import load_dotenv
+
+from util import redis_util
+from util.metrics_util import observe
+from util.qa_util import tokenize
+from util.redis_util import make_key
+from util.result_util import pack_result, unpack_result
+
+load_dotenv()
+
+# 全文検索の索引を作るか（1: 作る, 0: 作らない）
+fts_enabled = os.environ.get("FTS_ENABLED", "0") == "1"
+
+# 索引の有効期限（秒、既定は30日）。テキストより長く残し、テキストの有効期限が切れたページも検索できるようにする
+fts_expire = int(os.environ.get("FTS_EXPIRE", "2592000"))
+
+# スニペットに含める、一致した箇所の前後の文字数
+fts_snippet_chars = int(os.environ.get("FTS_SNIPPET_CHARS", "40"))
+
+# 語ごとの索引（ソート済みセット: キー → 出現回数）と、ページごとの情報（ハッシュ）のキーの接頭辞
+FTS_TERM_PREFIX = "fts:term:"
+FTS_DOC_PREFIX = "fts:doc:"
+
+# 索引に登録したページ（ソート済みセット: キー → 有効期限のUNIX時刻）と、ページごとの語数（ハッシュ: キー → 語数）
+# NOTE: ページの情報（FTS_DOC_PREFIX）は有効期限で消えるため、ページ数と語数の合計から取り除けるよう別に覚えておく
+FTS_DOCS_KEY = "fts:docs"
+FTS_LENGTHS_KEY = "fts:lengths"
+
+# 索引に登録したページの語数の合計（BM25の平均の長さに使う。ページ数はFTS_DOCS_KEYの要素数）
+FTS_STATS_KEY = "fts:stats"
+
+# 有効期限が切れたページを、ページ数と語数の合計から1回に取り除く数
+FTS_EXPIRE_BATCH = 100
+
+# BM25のパラメーター
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _term_key(term: str) -> str:
+    return FTS_TERM_PREFIX + term
+
+
+# ==================================================================================================
+# 索引の更新
+# ==================================================================================================
+
+
+def index_document(note_id: str, page_id: str, texts: list) -> bool:
+    """抽出したテキストをノート・ページの文書として索引に登録する（登録済みの場合は差し替える）
+
+    NOTE: 前回登録した語を覚えておき、今回のテキストに含まれない語の索引からだけページを削除する
+
+    Args:
+        note_id (str): ノートID
+        page_id (str): ページID
+        texts (list): PDFのページごとのテキスト
+
+    Returns:
+        bool: True - 登録が成功、False - 失敗
+    """
+    key = make_key(note_id, page_id)
+    doc_key = FTS_DOC_PREFIX + key
+    counts = Counter(term for text in texts for term in tokenize(text or ""))
+    length = sum(counts.values())
+    try:
+        # 語数の合計は、前回登録した語数（有効期限が切れて取り除く前のものを含む）との差だけ増減する
+        pipe = redis_util.r_client.pipeline(transaction=False)
+        pipe.hget(doc_key, "terms")
+        pipe.hget(FTS_LENGTHS_KEY, key)
+        previous_terms, previous_length = pipe.execute()
+        previous_terms = set(unpack_result(previous_terms)) if previous_terms else set()
+        previous_length = int(previous_length or 0)
+
+        pipe = redis_util.r_client.pipeline(transaction=False)
+        for term in previous_terms - counts.keys():
+            pipe.zrem(_term_key(term), key)
+        for term, count in counts.items():
+            pipe.zadd(_term_key(term), {key: count})
+            pipe.expire(_term_key(term), fts_expire)
+        pipe.hset(
+            doc_key,
+            mapping={
+                "note": note_id,
+                "page": page_id,
+                "length": length,
+                "terms": pack_result(list(counts)),
+                "texts": zlib.compress(pack_result({"texts": texts}), 6),
+            },
+        )
+        pipe.expire(doc_key, fts_expire)
+        pipe.zadd(FTS_DOCS_KEY, {key: time.time() + fts_expire})
+        pipe.hset(FTS_LENGTHS_KEY, key, length)
+        pipe.hincrby(FTS_STATS_KEY, "length", length - previous_length)
+        pipe.execute()
+        remove_expired_stats()
+    except Exception as e:
+        print("[FTS] 索引に登録できません:", e)
+        return False
+    return True
+
+
+def remove_expired_stats() -> int:
+    """有効期限が切れたページを、ページ数と語数の合計から取り除く（1回にFTS_EXPIRE_BATCHまで）
+
+    NOTE: 期限を過ぎていても、ページの情報がまだある（登録し直した）ページは取り除かない。
+          ZREMで取り除けたワーカーだけが語数の合計を減らすため、複数のワーカーが同時に実行しても二重に減らさない
+
+    Returns:
+        int: 取り除いたページ数
+    """
+    client = redis_util.r_client
+    expired = client.zrangebyscore(FTS_DOCS_KEY, "-inf", time.time(), start=0, num=FTS_EXPIRE_BATCH)
+    if not expired:
+        return 0
+    expired = [key.decode("utf-8") for key in expired]
+
+    pipe = client.pipeline(transaction=False)
+    for key in expired:
+        pipe.exists(FTS_DOC_PREFIX + key)
+    expired = [key for key, exists in zip(expired, pipe.execute(), strict=True) if not exists]
+    if not expired:
+        return 0
+
+    pipe = client.pipeline(transaction=False)
+    for key in expired:
+        pipe.zrem(FTS_DOCS_KEY, key)
+        pipe.hget(FTS_LENGTHS_KEY, key)
+    replies = pipe.execute()
+    removed = {key: int(length or 0) for key, done, length in zip(expired, replies[0::2], replies[1::2], strict=True) if done}
+    if removed:
+        pipe = client.pipeline(transaction=False)
+        pipe.hdel(FTS_LENGTHS_KEY, *removed)
+        pipe.hincrby(FTS_STATS_KEY, "length", -sum(removed.values()))
+        pipe.execute()
+    return len(removed)
+
+
+# ==================================================================================================
+# 検索
+# ==================================================================================================
+
+
+def _snippet(texts: list, query: str, terms: list) -> tuple:
+    """一致した箇所の前後を切り出す
+
+    Returns:
+        tuple: (PDFのページ番号（1始まり）, スニペット)。一致した箇所がなければ(None, 先頭の文字列)
+    """
+    needles = ["".join(query.lower().split()), *terms]
+    pages = [(text or "").replace("\r", "").replace("\n", "") for text in texts]
+    for needle in needles:
+        for page, text in enumerate(pages, start=1):
+            position = text.lower().find(needle)
+            if position >= 0:
+                start = max(0, position - fts_snippet_chars)
+                end = position + len(needle) + fts_snippet_chars
+                prefix = "…" if start > 0 else ""
+                suffix = "…" if end < len(text) else ""
+                return page, prefix + text[start:end] + suffix
+    return None, next((text[: fts_snippet_chars * 2] for text in pages if text), "")
+
+
+def search_documents(query: str, note_id: str | None = None, limit: int = 20) -> list:
+    """語をすべて含むページを検索し、BM25のスコアの高い順に返す
+
+    Args:
+        query (str): 検索する文字列
+        note_id (str | None): 指定した場合は、このノートのページだけを検索する
+        limit (int): 返すページの数
+
+    Returns:
+        list: [{'noteId', 'pageId', 'page', 'snippet', 'score'}, ...]
+    """
+    start = time.perf_counter()
+    client = redis_util.r_read_client
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+
+    pipe = client.pipeline(transaction=False)
+    for term in terms:
+        pipe.zcard(_term_key(term))
+    pipe.zcard(FTS_DOCS_KEY)
+    pipe.hget(FTS_STATS_KEY, "length")
+    *dfs, docs_count, total_length = pipe.execute()
+    if min(dfs) == 0:
+        return []
+
+    # 最も出現の少ない語の索引から候補を取り、残りの語は候補のページの出現回数だけを確かめる
+    order = sorted(range(len(terms)), key=dfs.__getitem__)
+    rarest = client.zrange(_term_key(terms[order[0]]), 0, -1, withscores=True)
+    candidates = {member.decode("utf-8"): score for member, score in rarest}
+    if note_id is not None:
+        # キーの接頭辞で大まかに絞り込む（別のノートIDが同じ接頭辞で始まる場合もあるため、後で登録したノートIDで確かめる）
+        prefix = make_key(note_id, "")
+        candidates = {key: score for key, score in candidates.items() if key.startswith(prefix)}
+    frequencies = {terms[order[0]]: candidates}
+    members = list(candidates)
+    for i in order[1:]:
+        if not members:
+            return []
+        scores = client.zmscore(_term_key(terms[i]), members)
+        frequencies[terms[i]] = {key: score for key, score in zip(members, scores, strict=True) if score is not None}
+        members = list(frequencies[terms[i]])
+    if not members:
+        return []
+
+    pipe = client.pipeline(transaction=False)
+    for key in members:
+        pipe.hmget(FTS_DOC_PREFIX + key, "length", "note")
+    docs = dict(zip(members, pipe.execute(), strict=True))
+    lengths = {key: length for key, (length, _) in docs.items()}
+
+    # 有効期限が切れたページを、検索した語の索引から削除する
+    # NOTE: レプリカから読み込んだ場合は書き込みの反映が遅れることがあるため、プライマリにもないことを確かめてから削除する
+    expired = [key for key, length in lengths.items() if length is None]
+    if expired:
+        pipe = redis_util.r_client.pipeline(transaction=False)
+        for key in expired:
+            pipe.exists(FTS_DOC_PREFIX + key)
+        expired = [key for key, exists in zip(expired, pipe.execute(), strict=True) if not exists]
+    if expired:
+        pipe = redis_util.r_client.pipeline(transaction=False)
+        for term in terms:
+            pipe.zrem(_term_key(term), *expired)
+        pipe.execute()
+        remove_expired_stats()
+
+    # ノートを指定した場合は、登録したノートIDが一致するページだけにする
+    if note_id is not None:
+        lengths = {key: length for key, length in lengths.items() if docs[key][1] == note_id.encode("utf-8")}
+
+    doc_count = max(int(docs_count or 0), *dfs, 1)
+    avg_length = max(int(total_length or 0) / doc_count, 1.0)
+    scores = {}
+    for key, length in lengths.items():
+        if length is None:
+            continue
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * int(length) / avg_length)
+        scores[key] = 0.0
+        for term, df in zip(terms, dfs, strict=True):
+            tf = frequencies[term][key]
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            scores[key] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+
+    # 上位のページだけ、登録したテキストからスニペットを作る
+    pipe = client.pipeline(transaction=False)
+    for key in ranked:
+        pipe.hmget(FTS_DOC_PREFIX + key, "note", "page", "texts")
+    results = []
+    for key, (note, page_id, packed) in zip(ranked, pipe.execute(), strict=True):
+        if packed is None:
+            continue
+        page, snippet = _snippet(unpack_result(zlib.decompress(packed))["texts"], query, terms)
+        results.append(
+            {
+                "noteId": note.decode("utf-8"),
+                "pageId": page_id.decode("utf-8"),
+                "page": page,
+                "snippet": snippet,
+                "score": round(scores[key], 4),
+            }
+        )
+    observe("search.seconds", time.perf_counter() - start)
+    return results
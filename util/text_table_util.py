@@ -1,36 +1,180 @@
 import json
+import os
 
-import pdfplumber
-from google.cloud import vision
+from dotenv import load_dotenv
 
+from util.ocr_util import ocr_dpi, ocr_enabled, ocr_pages
+from util.pdf_cache_util import load_pages
+from util.pdf_render_util import page_count, pdfium_lock
+from util.result_util import TableResult
+from util.vision_util import get_vision_client
 
-def run_ocr(pdf_path):
-    """PDFファイルからテキストを抽出する
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+load_dotenv()
+
+# テキスト抽出エンジン
+#  pdfium: PDFのテキストレイヤーをpypdfium2で直接読み込む（高速）
+#  pdfplumber: pdfplumberでレイアウト解析してから抽出する（低速だが表抽出と解析結果を共有できる）
+TEXT_ENGINES = ["pdfium", "pdfplumber"]
+pdf_text_engine = os.environ.get("PDF_TEXT_ENGINE", "pdfium")
+if pdf_text_engine not in TEXT_ENGINES:
+    print(f"環境変数PDF_TEXT_ENGINEの値が不正です({pdf_text_engine})。pdfplumberを使います")
+    pdf_text_engine = "pdfplumber"
+
+# 表を抽出するページ番号（0始まり）
+TABLE_PAGE_INDEX = 4
+
+# 置換文字（U+FFFD）がこの割合を超えたページは、レイアウトが特殊とみなしてpdfplumberで抽出し直す
+FALLBACK_REPLACEMENT_RATIO = 0.1
+
+
+def _extract_pages_pdfium(pdf_path, page_indexes: list | None = None) -> list:
+    """pypdfium2でページごとのテキストを抽出する
+
+    NOTE: テキストの抽出はスレッドプールで並行に実行されるため、PDFiumの呼び出しはpdfium_lockで1つずつ実行する
+    """
+    texts = []
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for i in range(len(pdf)) if page_indexes is None else page_indexes:
+                page = pdf[i]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    return texts
+
+
+def _needs_fallback(text: str) -> bool:
+    """pdfiumの抽出結果をpdfplumberで抽出し直す必要があるか判定する"""
+    if not text.strip():
+        return True
+    return text.count("\ufffd") > len(text) * FALLBACK_REPLACEMENT_RATIO
+
+
+def extract_page_texts(pdf_path, engine: str | None = None, page_indexes: list | None = None) -> list:
+    """PDFファイルからページごとのテキストを抽出する
 
     Args:
         pdf_path (_type_): PDFファイルのパス
+        engine (str | None): テキスト抽出エンジン（pdfium / pdfplumber）。Noneの場合は環境変数PDF_TEXT_ENGINE
+        page_indexes (list | None): 抽出するページ番号（0始まり）のリスト。Noneの場合は全ページ
 
     Returns:
-        _type_: _description_
+        list: ページごとのテキスト（テキストがないページは空文字列）
+    """
+    engine = engine or pdf_text_engine
+    if engine not in TEXT_ENGINES:
+        print(f"テキスト抽出エンジンの指定が不正です({engine})。{pdf_text_engine}を使います")
+        engine = pdf_text_engine
+    if engine == "pdfium" and pdfium is None:
+        print("pypdfium2がインストールされていないため、pdfplumberを使います")
+        engine = "pdfplumber"
+
+    if engine == "pdfplumber":
+        return [page.extract_text() or "" for page in load_pages(pdf_path, page_indexes)]
+
+    try:
+        texts = _extract_pages_pdfium(pdf_path, page_indexes)
+    except pdfium.PdfiumError as e:
+        print("pypdfium2で読み込めないため、pdfplumberを使います:", e)
+        return [page.extract_text() or "" for page in load_pages(pdf_path, page_indexes)]
+
+    # テキストが取れない、または文字化けしたページだけpdfplumberで抽出し直す
+    indexes = list(range(len(texts))) if page_indexes is None else list(page_indexes)
+    fallback = [pos for pos, text in enumerate(texts) if _needs_fallback(text)]
+    if fallback:
+        pages = load_pages(pdf_path, [indexes[pos] for pos in fallback])
+        for pos, page in zip(fallback, pages, strict=True):
+            texts[pos] = page.extract_text() or texts[pos]
+
+    return texts
+
+
+def extract_texts(
+    pdf_path, engine: str | None = None, ocr: bool | None = None, dpi: int | None = None, reuse: dict | None = None
+) -> list:
+    """PDFファイルからページごとのテキストを抽出する（テキストレイヤーのないページはOCRする）
+
+    Args:
+        pdf_path (_type_): PDFファイルのパス
+        engine (str | None): テキスト抽出エンジン（pdfium / pdfplumber）。Noneの場合は環境変数PDF_TEXT_ENGINE
+        ocr (bool | None): テキストレイヤーのないページをOCRするか。Noneの場合は環境変数OCR_ENABLED
+        dpi (int | None): OCRでラスタライズする解像度。Noneの場合は環境変数OCR_DPI
+        reuse (dict | None): {ページ番号: テキスト}。指定したページは抽出せずにこのテキストを使う
+
+    Returns:
+        list: ページごとのテキスト
+    """
+    reuse = reuse or {}
+    targets = [i for i in range(page_count(pdf_path)) if i not in reuse]
+    texts = dict(reuse)
+    if targets:
+        texts.update(zip(targets, extract_page_texts(pdf_path, engine, targets), strict=True))
+
+    # テキストレイヤーのないページをOCRし、ページ順に結果を戻す
+    if ocr_enabled if ocr is None else ocr:
+        no_text = [i for i in targets if not texts[i].strip()]
+        if no_text:
+            texts.update(ocr_pages(pdf_path, no_text, dpi))
+
+    return [texts[i] for i in sorted(texts)]
+
+
+def extraction_settings(engine: str | None = None, ocr: bool | None = None, dpi: int | None = None) -> list:
+    """抽出結果を左右する設定（エンジン・OCRするか・OCRの解像度）を、省略された値を環境変数で補って返す
+
+    NOTE: 前回の抽出結果を再利用するとき、同じ設定で抽出したものか確かめるために使う
+
+    Returns:
+        list: [エンジン, OCRするか, OCRの解像度（OCRしない場合はNone）]
+    """
+    ocr = bool(ocr_enabled if ocr is None else ocr)
+    return [engine or pdf_text_engine, ocr, (dpi or ocr_dpi) if ocr else None]
+
+
+def format_pages(texts: list) -> str:
+    """ページごとのテキストを[Page N]ごとに改行を除いて連結する
+
+    Args:
+        texts (list): ページごとのテキスト
+
+    Returns:
+        str: 連結した文字列
     """
     page_num = 1
     all_text = ""
-    # PDFファイルを開く
-    with pdfplumber.open(pdf_path) as pdf:
-        # 全てのページを取得して
-        for page in pdf.pages:
-            # ページごとにテキストを抽出
-            text = page.extract_text()
-            if text:
-                text_no_newline = text.replace("\n", "")
-                all_text += f"[Page {page_num}]\n\n{text_no_newline}\n\n"
-                page_num += 1
-        #     print(text)
-        # first_page = pdf.pages[0]
-
-        # # テキストを抽出
-        # text = first_page.extract_text()
-        return all_text
+    for text in texts:
+        # ページごとにテキストを連結（pdfiumの改行はCRLF）
+        if text:
+            text_no_newline = text.replace("\r", "").replace("\n", "")
+            all_text += f"[Page {page_num}]\n\n{text_no_newline}\n\n"
+            page_num += 1
+    return all_text
+
+
+def run_ocr(pdf_path, engine: str | None = None, ocr: bool | None = None, dpi: int | None = None):
+    """PDFファイルからテキストを抽出する
+
+    NOTE: テキストレイヤーのないページ（スキャンしたページ）は、ラスタライズしてOCRエンジンで認識する
+
+    Args:
+        pdf_path (_type_): PDFファイルのパス
+        engine (str | None): テキスト抽出エンジン（pdfium / pdfplumber）。Noneの場合は環境変数PDF_TEXT_ENGINE
+        ocr (bool | None): テキストレイヤーのないページをOCRするか。Noneの場合は環境変数OCR_ENABLED
+        dpi (int | None): OCRでラスタライズする解像度。Noneの場合は環境変数OCR_DPI
+
+    Returns:
+        _type_: [Page N]ごとに改行を除いたテキストを連結した文字列
+    """
+    return format_pages(extract_texts(pdf_path, engine, ocr, dpi))
 
 
 def extract_table(pdf_path):
@@ -49,34 +193,23 @@ def extract_table(pdf_path):
     Returns:
         _type_: _description_
     """
-    results = {}
-    with pdfplumber.open(pdf_path) as pdf:
-        num_page = 4
-        print(len(pdf.pages))
-        tables = pdf.pages[num_page].extract_tables()
-        print(f"Page {num_page} has {len(tables)} tables")
-        # for i, table in enumerate(tables):
-        #     print(f"Table {i+1}")
-        #     for row in table:
-        #         print(row)
-
-        headers = tables[0][0]
-        results["keys"] = headers
-        # 2行目以降をレコードとして格納
-        records = []
-        for row in tables[0][1:]:
-            record = {}
-            # ヘッダーと各データのペアを作成
-            for col_idx, header in enumerate(headers):
-                record[header] = row[col_idx]
-            records.append(record)
-
-        results["records"] = records
-
-        # 確認用にコンソールへ表示（任意）
-        print(json.dumps(results, ensure_ascii=False, indent=2))
-
-        return results
+    num_page = TABLE_PAGE_INDEX
+    # レイアウト解析済みのページを取得する（テキスト抽出で解析済みならキャッシュを使う）
+    page = load_pages(pdf_path, [num_page])[0]
+    tables = page.extract_tables()
+    print(f"Page {num_page} has {len(tables)} tables")
+    # for i, table in enumerate(tables):
+    #     print(f"Table {i+1}")
+    #     for row in table:
+    #         print(row)
+
+    # 1行目をヘッダー、2行目以降をレコードとして格納
+    results = TableResult.from_rows(tables[0]).to_dict()
+
+    # 確認用にコンソールへ表示（任意）
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    return results
 
     # import fitz
 
@@ -101,29 +234,14 @@ def extract_table(pdf_path):
 def async_detect_document(gcs_source_uri: str, gcs_destination_uri: str) -> None:
     """Cloud Vision APIのOCR機能を使ってPDFから文字情報を取得してJSONファイルとしてGCSに保存
 
+    NOTE: プロセス内で共有するクライアントを使い、完了は専用のイベントループ上でポーリングする
+
     Args:
         gcs_source_uri (str): PDFのソースが保存されてるGCSのURI
         gcs_destination_uri (str): 文字情報を保存するGCSのURI
     """
-    # Supported mime_types are: 'application/pdf' and 'image/tiff'
-    mime_type = "application/pdf"
-
     # How many pages should be grouped into each json output file.
     batch_size = 2
 
-    client = vision.ImageAnnotatorClient()
-
-    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
-
-    gcs_source = vision.GcsSource(uri=gcs_source_uri)
-    input_config = vision.InputConfig(gcs_source=gcs_source, mime_type=mime_type)
-
-    gcs_destination = vision.GcsDestination(uri=gcs_destination_uri)
-    output_config = vision.OutputConfig(gcs_destination=gcs_destination, batch_size=batch_size)
-
-    async_request = vision.AsyncAnnotateFileRequest(features=[feature], input_config=input_config, output_config=output_config)
-
-    operation = client.async_batch_annotate_files(requests=[async_request])
-
     print("Waiting for the document detection to complete.")
-    operation.result(timeout=420)
+    get_vision_client().detect_document(gcs_source_uri, gcs_destination_uri, batch_size)
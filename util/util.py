@@ -5,9 +5,14 @@
 # [DESCRIPTION]
 #  ユーティリティ関数を定義する
 #
+import os
 import sys
 
 
+class InvalidRequestError(ValueError):
+    """リクエストボディの値が正しくない（ステータスコード400を返す）"""
+
+
 def getNoteId(notelink):
     """eYACHO/GEMBA NoteのノートリンクからノートIDを抽出する
 
@@ -32,6 +37,44 @@ def getNoteId(notelink):
     return splitString[0]
 
 
+def web_concurrency() -> int:
+    """ワーカー数（環境変数WEB_CONCURRENCY）を取得する
+
+    NOTE: 推論のスレッド数・OCRのプロセス数・CPUアフィニティは、この値でCPUを等分する。
+          gunicornで起動する場合は、gunicorn.conf.pyがワーカー数をWEB_CONCURRENCYに書き出す。
+          未設定の場合（uvicornで1プロセスで起動する場合）は1
+
+    Returns:
+        int: ワーカー数
+    """
+    return max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+
+def parse_clamped_int(value, default, minimum: int, maximum: int, name: str):
+    """リクエストボディの値を整数にして、下限〜上限の範囲に収める
+
+    Args:
+        value (_type_): JSONの値（数値または数字の文字列）。Noneの場合は既定値
+        default (_type_): 既定値（範囲に収めずにそのまま返す）
+        minimum (int): 下限
+        maximum (int): 上限
+        name (str): キーの名前（エラーメッセージに使う）
+
+    Raises:
+        InvalidRequestError: 整数にできない値の場合
+
+    Returns:
+        _type_: 範囲に収めた整数（値がNoneの場合は既定値）
+    """
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError) as e:
+        raise InvalidRequestError(f"{name}が正しくありません: {value!r}") from e
+    return min(max(number, minimum), maximum)
+
+
 def is_reload_enabled():
     """実行するコマンドに--reloadが含まれるか判定する
 
@@ -42,3 +85,18 @@ def is_reload_enabled():
         bool: True: 含まれる False: 含まれない
     """
     return "--reload" in sys.argv
+
+
+def parse_flag(value, default: bool = False) -> bool:
+    """リクエストボディのフラグを真偽値にする（環境変数のフラグと同じく、"1"・"true"をTrueとみなす）
+
+    Args:
+        value (_type_): JSONの値（true/false, 1/0, "1"/"0", "true"/"false"など）。Noneの場合は既定値
+        default (bool): 既定値
+
+    Returns:
+        bool: フラグ
+    """
+    if value is None:
+        return default
+    return str(value).strip().lower() in ("1", "true")
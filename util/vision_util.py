@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# [FILE] vision_util.py
+#
+# [DESCRIPTION]
+#  Cloud Vision APIのOCRクライアントを定義する
+#  - クライアントはプロセス内で使い回し、専用のイベントループ上で非同期に通信する
+#  - 複数の画像をまとめて1リクエストで送信し、同時リクエスト数を制限し、一時的なエラーは間隔を空けて再試行する
+#  - VISION_BACKEND=restとVISION_ENDPOINTを指定すると、ローカルのスタブサーバー（benchmark/vision_stub_server.py）に接続できる
+#
+import asyncio
+import base64
+import os
+import random
+import threading
+from functools import lru_cache, partial
+
+import httpx
+from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from google.cloud import vision
+
+load_dotenv()
+
+# 接続方式（google: Google Cloudのクライアントライブラリ / rest: REST API（スタブサーバーにも接続できる））
+vision_backend = os.environ.get("VISION_BACKEND", "google")
+
+# REST APIのエンドポイントとAPIキー（VISION_BACKEND=restの場合）
+vision_endpoint = os.environ.get("VISION_ENDPOINT", "https://vision.googleapis.com")
+vision_api_key = os.environ.get("VISION_API_KEY")
+
+# 1リクエストにまとめる画像の数（Cloud Vision APIの上限は16）
+vision_batch_size = int(os.environ.get("VISION_BATCH_SIZE", "16"))
+
+# 同時に送信するリクエスト数の上限
+vision_max_concurrency = int(os.environ.get("VISION_MAX_CONCURRENCY", "4"))
+
+# 一時的なエラーの再試行回数と、初回の待ち時間（秒、再試行ごとに2倍にする）
+vision_max_retries = int(os.environ.get("VISION_MAX_RETRIES", "5"))
+vision_retry_delay = float(os.environ.get("VISION_RETRY_DELAY", "0.5"))
+
+# PDFなどのファイルOCR（非同期オペレーション）の完了を待つ時間（秒）
+vision_timeout = float(os.environ.get("VISION_TIMEOUT", "420"))
+
+# 再試行するHTTPステータスコード
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class VisionError(Exception):
+    """Cloud Vision APIがエラーを返した"""
+
+
+class RetryableVisionError(VisionError):
+    """再試行すれば成功する可能性のあるエラー"""
+
+
+# ==================================================================================================
+# 接続方式ごとの通信処理
+# ==================================================================================================
+
+
+class GoogleVisionTransport:
+    """Google Cloudのクライアントライブラリ（非同期クライアント）で通信する"""
+
+    def __init__(self):
+        self.vision = vision
+        self.client = vision.ImageAnnotatorAsyncClient()
+        self.retryable = (
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.TooManyRequests,
+            google_exceptions.InternalServerError,
+        )
+
+    async def annotate_images(self, images: list) -> list:
+        vision = self.vision
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        requests = [vision.AnnotateImageRequest(image=vision.Image(content=image), features=[feature]) for image in images]
+        try:
+            response = await self.client.batch_annotate_images(requests=requests)
+        except self.retryable as e:
+            raise RetryableVisionError(str(e)) from e
+
+        texts = []
+        for each_response in response.responses:
+            if each_response.error.message:
+                raise VisionError(each_response.error.message)
+            texts.append(each_response.full_text_annotation.text)
+        return texts
+
+    async def annotate_file(self, gcs_source_uri: str, gcs_destination_uri: str, batch_size: int):
+        vision = self.vision
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        input_config = vision.InputConfig(gcs_source=vision.GcsSource(uri=gcs_source_uri), mime_type="application/pdf")
+        output_config = vision.OutputConfig(gcs_destination=vision.GcsDestination(uri=gcs_destination_uri), batch_size=batch_size)
+        request = vision.AsyncAnnotateFileRequest(features=[feature], input_config=input_config, output_config=output_config)
+        try:
+            operation = await self.client.async_batch_annotate_files(requests=[request])
+        except self.retryable as e:
+            raise RetryableVisionError(str(e)) from e
+        # AsyncOperationはイベントループを止めずに完了をポーリングする
+        await operation.result(timeout=vision_timeout)
+
+
+class RestVisionTransport:
+    """Cloud Vision APIのREST API（またはローカルのスタブサーバー）と通信する"""
+
+    def __init__(self, endpoint: str, api_key: str | None):
+        params = {"key": api_key} if api_key else None
+        self.client = httpx.AsyncClient(base_url=endpoint, params=params, timeout=httpx.Timeout(60.0))
+
+    async def _request(self, method: str, url: str, **kwargs) -> dict:
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            raise RetryableVisionError(str(e)) from e
+        if response.status_code in RETRYABLE_STATUS:
+            raise RetryableVisionError(f"HTTP {response.status_code}")
+        if response.status_code != 200:
+            raise VisionError(f"HTTP {response.status_code}: {response.text}")
+        return response.json()
+
+    async def annotate_images(self, images: list) -> list:
+        body = {
+            "requests": [
+                {
+                    "image": {"content": base64.b64encode(image).decode("utf-8")},
+                    "features": [{"type": "DOCUMENT_TEXT_DETECTION"}],
+                }
+                for image in images
+            ]
+        }
+        result = await self._request("POST", "/v1/images:annotate", json=body)
+
+        texts = []
+        for each_response in result.get("responses", []):
+            if "error" in each_response:
+                raise VisionError(each_response["error"].get("message"))
+            texts.append(each_response.get("fullTextAnnotation", {}).get("text", ""))
+        return texts
+
+    async def annotate_file(self, gcs_source_uri: str, gcs_destination_uri: str, batch_size: int):
+        body = {
+            "requests": [
+                {
+                    "inputConfig": {"gcsSource": {"uri": gcs_source_uri}, "mimeType": "application/pdf"},
+                    "features": [{"type": "DOCUMENT_TEXT_DETECTION"}],
+                    "outputConfig": {"gcsDestination": {"uri": gcs_destination_uri}, "batchSize": batch_size},
+                }
+            ]
+        }
+        operation = await self._request("POST", "/v1/files:asyncBatchAnnotate", json=body)
+
+        # オペレーションが完了するまで間隔を広げながらポーリングする
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + vision_timeout
+        interval = 0.5
+        while operation.get("done") is not True:
+            if loop.time() > deadline:
+                raise VisionError("ファイルのOCRがタイムアウトしました")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 10.0)
+            operation = await self._request("GET", f"/v1/{operation['name']}")
+        if "error" in operation:
+            raise VisionError(operation["error"].get("message"))
+
+
+# ==================================================================================================
+# OCRクライアント
+# ==================================================================================================
+
+
+class VisionOcrClient:
+    """Cloud Vision APIのOCRクライアント
+
+    専用スレッドのイベントループ上で通信するため、同期処理（スレッドプールのワーカーなど）からも
+    非同期処理（エンドポイント）からも、呼び出し元をブロックせずに使える
+    """
+
+    def __init__(self, transport_factory, batch_size: int, max_concurrency: int):
+        self.batch_size = batch_size
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="vision-ocr", daemon=True)
+        self.thread.start()
+        # 非同期クライアントはイベントループに紐づくため、専用のイベントループ上で生成する
+        self.transport = self._submit(self._create(transport_factory)).result()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    @staticmethod
+    async def _create(transport_factory) -> "GoogleVisionTransport | RestVisionTransport":
+        return transport_factory()
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _with_retry(self, call):
+        """一時的なエラーを指数バックオフ（ジッター付き）で再試行する"""
+        for attempt in range(vision_max_retries + 1):
+            try:
+                async with self.semaphore:
+                    return await call()
+            except RetryableVisionError as e:  # noqa: PERF203 - 再試行するため、例外は試行ごとに捕まえる
+                if attempt == vision_max_retries:
+                    raise
+                delay = vision_retry_delay * (2**attempt) * (0.5 + random.random())
+                print(f"[VISION] 再試行します({attempt + 1}/{vision_max_retries}, {delay:.1f}秒後):", e)
+                await asyncio.sleep(delay)
+        return None
+
+    async def _ocr_images(self, images: list) -> list:
+        batches = [images[i : i + self.batch_size] for i in range(0, len(images), self.batch_size)]
+        results = await asyncio.gather(*[self._with_retry(partial(self.transport.annotate_images, batch)) for batch in batches])
+        return [text for texts in results for text in texts]
+
+    def ocr_images(self, images: list) -> list:
+        """画像をOCRする（同期処理から呼び出す）
+
+        Args:
+            images (list): 画像（PNG・JPEGなどのバイナリ）のリスト
+
+        Returns:
+            list: 画像ごとに認識したテキスト
+        """
+        return self._submit(self._ocr_images(images)).result()
+
+    async def aocr_images(self, images: list) -> list:
+        """画像をOCRする（非同期処理から呼び出す）"""
+        return await asyncio.wrap_future(self._submit(self._ocr_images(images)))
+
+    def detect_document(self, gcs_source_uri: str, gcs_destination_uri: str, batch_size: int = 2):
+        """GCS上のPDFをOCRし、結果のJSONファイルをGCSに保存する（同期処理から呼び出す）"""
+        call = partial(self.transport.annotate_file, gcs_source_uri, gcs_destination_uri, batch_size)
+        return self._submit(self._with_retry(call)).result()
+
+    async def adetect_document(self, gcs_source_uri: str, gcs_destination_uri: str, batch_size: int = 2):
+        """GCS上のPDFをOCRし、結果のJSONファイルをGCSに保存する（非同期処理から呼び出す）"""
+        call = partial(self.transport.annotate_file, gcs_source_uri, gcs_destination_uri, batch_size)
+        return await asyncio.wrap_future(self._submit(self._with_retry(call)))
+
+
+# プロセス内で共有するクライアントを生成するときのロック
+_client_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _create_vision_client() -> VisionOcrClient:
+    """環境変数の設定に従ったOCRクライアントを生成する（初回のみ）"""
+    if vision_backend == "rest":
+        factory = partial(RestVisionTransport, vision_endpoint, vision_api_key)
+    else:
+        factory = GoogleVisionTransport
+    return VisionOcrClient(factory, vision_batch_size, vision_max_concurrency)
+
+
+def get_vision_client() -> VisionOcrClient:
+    """環境変数の設定に従ったOCRクライアントを取得する
+
+    Returns:
+        VisionOcrClient: プロセス内で共有するOCRクライアント
+    """
+    # NOTE: lru_cacheは同時に呼び出されると複数回生成することがあるため、ロックを取ってから呼び出す
+    with _client_lock:
+        return _create_vision_client()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#
+# [FILE] warmup_util.py
+#
+# [DESCRIPTION]
+#  ワーカーの起動時に、想定するサイズのダミー画像でYOLOとSAMの推論を実行しておく（ウォームアップ）
+#  最初のリクエストでメモリの確保やカーネルの初期化が起きて遅くなるのを防ぎ、完了するまでは/health/readyで準備中を返す
+#  MODEL_COMPILEを指定すると、ウォームアップの前にモデルをコンパイルし、コンパイル結果をディスクにキャッシュする
+#
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from dotenv import load_dotenv
+
+from util.cpu_util import engine_threads
+from util.model_util import get_sam_model, sam_lock
+from util.yolo_util import (
+    detector_lock,
+    get_detector,
+    yolo_cascade,
+    yolo_detect_batch,
+    yolo_fast_model_file,
+    yolo_fast_model_type,
+)
+
+load_dotenv()
+
+yolo_model_file = os.environ.get("YOLO_MODEL_FILE")
+sam_model_file = os.environ.get("SAM_MODEL_FILE")
+
+# ウォームアップするか（1: する, 0: しない）
+warmup_enabled = os.environ.get("WARMUP_ENABLED", "1") == "1"
+
+# ウォームアップに使う画像のサイズ（幅x高さをカンマ区切りで指定する）と、サイズごとの推論回数
+warmup_image_sizes = [
+    tuple(int(value) for value in size.split("x"))
+    for size in os.environ.get("WARMUP_IMAGE_SIZES", "640x480,1280x960").split(",")
+    if size.strip()
+]
+warmup_iterations = int(os.environ.get("WARMUP_ITERATIONS", "2"))
+
+# ウォームアップに失敗したときにやり直す回数と、最初の待ち時間（秒、やり直すたびに2倍にする）
+warmup_max_retries = int(os.environ.get("WARMUP_MAX_RETRIES", "3"))
+warmup_retry_seconds = float(os.environ.get("WARMUP_RETRY_SECONDS", "5"))
+
+# モデルのコンパイル方式（空: しない / torchscript: TorchScriptにトレースする / inductor: torch.compileでコンパイルする）
+model_compile = os.environ.get("MODEL_COMPILE", "")
+
+# コンパイル結果をキャッシュするフォルダー（再起動してもコンパイルし直さない）
+model_compile_cache_dir = os.environ.get("MODEL_COMPILE_CACHE_DIR", "_model_cache")
+
+# コンパイルする部分の入力サイズ（ImageAIのYOLOv3は416×416、SAMの画像エンコーダーは1024×1024に変換してから推論する）
+YOLO_INPUT_SHAPE = (1, 3, 416, 416)
+SAM_INPUT_SHAPE = (1, 3, 1024, 1024)
+
+# ウォームアップの状態（/health/readyで返す）
+warmup_status = {"state": "pending", "ready": False, "compile": model_compile or None, "seconds": {}, "error": None}
+_status_lock = threading.Lock()
+
+# コンパイルしたモデルと差し替える前の元のモジュール（(差し替えた属性を持つオブジェクト, 属性名, 元のモジュール, ロック)のリスト）
+_original_modules = []
+
+
+def _set_status(**kwargs):
+    with _status_lock:
+        warmup_status.update(kwargs)
+
+
+def get_warmup_status() -> dict:
+    """ウォームアップの状態を取得する
+
+    Returns:
+        dict: {'state': pending/running/done/failed, 'ready': 推論を受け付けられるか, 'seconds': 処理ごとの所要時間, ...}
+    """
+    with _status_lock:
+        return {**warmup_status, "seconds": dict(warmup_status["seconds"])}
+
+
+# ==================================================================================================
+# モデルのコンパイル
+# ==================================================================================================
+
+
+def _cache_path(name: str, model_file: str, shape: tuple) -> str:
+    """コンパイル結果のキャッシュファイルのパス（モデルファイルの内容・PyTorchのバージョン・入力サイズごとに分ける）"""
+    with open(model_file, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    shape_name = "x".join(str(value) for value in shape)
+    return os.path.join(model_compile_cache_dir, f"{name}-{digest}-torch{torch.__version__}-{shape_name}.pt")
+
+
+def compile_module(module: torch.nn.Module, name: str, model_file: str, shape: tuple) -> torch.nn.Module:
+    """モデル（の一部）をMODEL_COMPILEの方式でコンパイルする
+
+    NOTE: torchscriptは入力サイズを固定してトレースし、トレース結果をファイルに保存して次回の起動時に読み込む。
+          inductorはtorch.compileのFXグラフキャッシュをMODEL_COMPILE_CACHE_DIRに保存する
+          （コンパイル自体は最初の推論、つまりウォームアップ中に行われる）。
+          コンパイルに失敗した場合は、元のモデルをそのまま使う
+
+    Args:
+        module (torch.nn.Module): コンパイルするモジュール
+        name (str): キャッシュファイル名に使う名前
+        model_file (str): モデルファイルのパス（キャッシュを区別するために使う）
+        shape (tuple): 入力のサイズ
+
+    Returns:
+        torch.nn.Module: コンパイルしたモジュール
+    """
+    if not model_compile:
+        return module
+
+    os.makedirs(model_compile_cache_dir, exist_ok=True)
+    try:
+        if model_compile == "torchscript":
+            path = _cache_path(name, model_file, shape)
+            if os.path.exists(path):
+                print("[COMPILE] キャッシュを読み込みます:", path)
+                return torch.jit.load(path, map_location="cpu")
+            module.eval()
+            with torch.no_grad():
+                traced = torch.jit.trace(module, torch.zeros(shape), check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, path)
+            print("[COMPILE] TorchScriptに変換しました:", path)
+            return traced
+
+        if model_compile == "inductor":
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(model_compile_cache_dir))
+            os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+            return torch.compile(module, dynamic=False)
+
+        print("[COMPILE] MODEL_COMPILEの値が正しくありません:", model_compile)
+    except Exception as e:
+        print(f"[COMPILE] {name}をコンパイルできないため、コンパイルせずに推論します:", e)
+    return module
+
+
+def compile_models():
+    """YOLOとSAMのモデルの推論部分をコンパイルし、読み込み済みのモデルと差し替える
+
+    NOTE: ウォームアップ中もリクエストを受け付けるため、推論と同じロックを取ってからコンパイルして差し替える
+    """
+    if yolo_model_file:
+        detector = get_detector(yolo_model_file)
+        with detector_lock:
+            # ImageAIは読み込んだモデルを非公開の属性に保持している
+            model = getattr(detector, "_ObjectDetection__model", None)
+            if isinstance(model, torch.nn.Module):
+                _original_modules.append((detector, "_ObjectDetection__model", model, detector_lock))
+                detector._ObjectDetection__model = compile_module(model, "yolo", yolo_model_file, YOLO_INPUT_SHAPE)
+            else:
+                print("[COMPILE] YOLOのモデルが見つからないため、コンパイルしません")
+
+    if sam_model_file:
+        # 推論時間の大半を占める画像エンコーダーだけをコンパイルする（プロンプトのエンコーダーとデコーダーは入力サイズが変わる）
+        sam = get_sam_model(sam_model_file).model
+        with sam_lock:
+            _original_modules.append((sam, "image_encoder", sam.image_encoder, sam_lock))
+            sam.image_encoder = compile_module(sam.image_encoder, "sam-encoder", sam_model_file, SAM_INPUT_SHAPE)
+
+
+def restore_models():
+    """コンパイルしたモデルを元のモジュールに戻す（コンパイルしたモデルで推論に失敗した場合に使う）
+
+    NOTE: inductorは最初の推論でコンパイルするため、コンパイルの失敗はウォームアップの推論で例外になる。
+          元に戻さないと、やり直しのウォームアップや以降のリクエストが失敗するモデルで推論し続けてしまう
+    """
+    while _original_modules:
+        owner, name, module, lock = _original_modules.pop()
+        with lock:
+            setattr(owner, name, module)
+    print("[COMPILE] コンパイルしたモデルを元のモデルに戻しました")
+
+
+# ==================================================================================================
+# ウォームアップ
+# ==================================================================================================
+
+
+def _synthetic_image(width: int, height: int) -> np.ndarray:
+    """ウォームアップ用の画像（グラデーション）を生成する"""
+    x = np.linspace(0, 255, width, dtype=np.uint8)
+    y = np.linspace(0, 255, height, dtype=np.uint8)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = x[np.newaxis, :]
+    image[..., 1] = y[:, np.newaxis]
+    image[..., 2] = 128
+    return image
+
+
+def warmup_models(with_compile: bool = True) -> dict:
+    """モデルをコンパイルし、想定するサイズのダミー画像で推論して初期化を済ませる
+
+    Args:
+        with_compile (bool): モデルをコンパイルするか（やり直すときはコンパイルし直さない）
+
+    Returns:
+        dict: 処理ごとの所要時間（秒）
+    """
+    seconds = {}
+    try:
+        if with_compile:
+            start = time.perf_counter()
+            compile_models()
+            seconds["compile"] = round(time.perf_counter() - start, 3)
+        seconds.update(_warmup_inference())
+    except Exception:
+        if with_compile and model_compile:
+            # コンパイルやコンパイルしたモデルの推論に失敗した場合は、元のモデルに戻してから（推論だけを）やり直す
+            restore_models()
+        raise
+    seconds["total"] = round(sum(seconds.values()), 3)
+    return seconds
+
+
+def _warmup_inference() -> dict:
+    """想定するサイズのダミー画像で、YOLO・軽量YOLO・SAMの推論を実行する
+
+    Returns:
+        dict: モデルごとの所要時間（秒）
+    """
+    seconds = {}
+    images = [_synthetic_image(width, height) for width, height in warmup_image_sizes]
+    if yolo_model_file:
+        start = time.perf_counter()
+        for _ in range(warmup_iterations):
+            yolo_detect_batch(images, yolo_model_file)
+        seconds["yolo"] = round(time.perf_counter() - start, 3)
+
+    if yolo_cascade and yolo_fast_model_file:
+        # カスケード検出の軽量モデル（YOLO_CASCADE=1の場合だけ）
+        start = time.perf_counter()
+        detector = get_detector(yolo_fast_model_file, yolo_fast_model_type)
+        for _ in range(warmup_iterations):
+            for image in images:
+                with detector_lock, engine_threads("yolo"):
+                    detector.detectObjectsFromImage(input_image=image, output_type="array")
+        seconds["yoloFast"] = round(time.perf_counter() - start, 3)
+
+    if sam_model_file:
+        start = time.perf_counter()
+        model = get_sam_model(sam_model_file)
+        for _ in range(warmup_iterations):
+            for image in images:
+                with sam_lock, engine_threads("sam"):
+                    model.predict(image, save=False, verbose=False)
+        seconds["sam"] = round(time.perf_counter() - start, 3)
+    return seconds
+
+
+def _run_warmup():
+    """ウォームアップを実行する（失敗した場合は、待ち時間を倍にしながらWARMUP_MAX_RETRIES回までやり直す）
+
+    NOTE: やり直すときはコンパイルし直さず、推論だけをやり直す
+          （コンパイルしたモデルで失敗した場合は、warmup_modelsが元のモデルに戻している）
+    """
+    _set_status(state="running")
+    delay = warmup_retry_seconds
+    for attempt in range(warmup_max_retries + 1):
+        try:
+            seconds = warmup_models(with_compile=attempt == 0)
+        except Exception as e:
+            print(f"[WARMUP] ウォームアップに失敗しました（{attempt + 1}回目）:", e)
+            if attempt >= warmup_max_retries:
+                _set_status(state="failed", error=str(e))
+                return
+            _set_status(error=str(e))
+            time.sleep(delay)
+            delay *= 2
+            continue
+        _set_status(state="done", ready=True, seconds=seconds, error=None)
+        print("[WARMUP]", seconds)
+        return
+
+
+def start_warmup():
+    """ウォームアップを別スレッドで開始する（ワーカーの起動時に呼び出す）
+
+    NOTE: サーバーはすぐにリクエストを受け付けるが、/health/readyは完了するまで503を返す
+    """
+    if not warmup_enabled:
+        _set_status(state="done", ready=True)
+        return
+    threading.Thread(target=_run_warmup, name="model-warmup", daemon=True).start()
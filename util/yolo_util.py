@@ -5,8 +5,79 @@
 # [DESCRIPTION]
 #   ImageAIを用いた物体検出に関わるメソッドを定義する
 # 0
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from dotenv import load_dotenv
 from imageai.Detection import ObjectDetection
 
+from util.cpu_util import engine_threads
+from util.metrics_util import increment, observe
+from util.pdf_render_util import page_count, render_page_bgr
+from util.result_util import DetectedBox, DetectionResult
+
+load_dotenv()
+
+# カスケード検出の設定
+# 軽量モデルで先に検出し、精度の低い画像だけを大きいモデルで検出し直すか（1: する, 0: しない。リクエストごとにも指定できる）
+yolo_cascade = os.environ.get("YOLO_CASCADE", "0") == "1"
+# 先に実行する軽量モデルのファイルと種類（tinyyolov3など）
+yolo_fast_model_file = os.environ.get("YOLO_FAST_MODEL_FILE")
+yolo_fast_model_type = os.environ.get("YOLO_FAST_MODEL_TYPE", "tinyyolov3")
+# 軽量モデルで検出した上位の物体の平均精度（%）がこの値を下回るか、物体の数が上限を超えたら、大きいモデルで検出し直す
+cascade_min_confidence = float(os.environ.get("CASCADE_MIN_CONFIDENCE", "60"))
+cascade_top_k = int(os.environ.get("CASCADE_TOP_K", "3"))
+cascade_max_objects = int(os.environ.get("CASCADE_MAX_OBJECTS", "20"))
+# 軽量モデルで何も検出できなかった場合に、大きいモデルで検出し直すか
+cascade_escalate_empty = os.environ.get("CASCADE_ESCALATE_EMPTY", "1") == "1"
+
+# 検出器はスレッドセーフではないため、推論は1つずつ実行する
+detector_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def get_detector(model_file, model_type: str = "yolov3") -> ObjectDetection:
+    """YOLOモデルを読み込んだ検出器を取得する（モデルファイルごとに1回だけ読み込む）
+
+    Args:
+        model_file (_type_): YOLOモデルファイル
+        model_type (str): モデルの種類（yolov3, tinyyolov3, retinanet）
+
+    Returns:
+        ObjectDetection: 検出器
+    """
+    detector = ObjectDetection()
+    if model_type == "tinyyolov3":
+        detector.setModelTypeAsTinyYOLOv3()
+    elif model_type == "retinanet":
+        detector.setModelTypeAsRetinaNet()
+    else:
+        detector.setModelTypeAsYOLOv3()
+    detector.setModelPath(model_file)
+    detector.loadModel()
+    return detector
+
+
+def _to_results(detections) -> DetectionResult:
+    """ImageAIの検出結果から、検出した対象物、認識精度、位置を抽出して結果を構成する"""
+    results = DetectionResult()
+    for each_object in detections:
+        box = DetectedBox.from_detection(each_object)
+        print("Detected:", box.to_dict())
+        results.records.append(box)
+
+    msg = "検出できません"
+    if len(results.records) > 0:
+        msg = "送信終了"
+    results.message = msg
+
+    return results
+
 
 def yolo_detect_objects(source_image_path, output_image_path, model_file):
     """物体検出を行う
@@ -21,30 +92,144 @@ def yolo_detect_objects(source_image_path, output_image_path, model_file):
 
     NOTE: output_image_pathには検出結果を描画した画像が保存されるが，detectionsには検出結果（JSON）が格納される
     """
-    detector = ObjectDetection()
-    detector.setModelTypeAsYOLOv3()
-    detector.setModelPath(model_file)
-    detector.loadModel()
+    detector = get_detector(model_file)
+    with detector_lock, engine_threads("yolo"):
+        detections = detector.detectObjectsFromImage(input_image=source_image_path, output_image_path=output_image_path)
 
-    detections = detector.detectObjectsFromImage(input_image=source_image_path, output_image_path=output_image_path)
+    return _to_results(detections).to_dict()
 
-    results = {}
-    results["keys"] = ["objName", "probability", "topX", "topY", "bottomX", "bottomY"]
-    detected_objects = []
 
-    # 検出した対象物、認識精度、位置を抽出してJSONを構成する
-    for each_object in detections:
-        name = each_object["name"]
-        prob = each_object["percentage_probability"]
-        box = each_object["box_points"]
-        elements = {"objName": name, "probability": prob, "topX": box[0], "topY": box[1], "bottomX": box[2], "bottomY": box[3]}
-        print("Detected:", elements)
-        detected_objects.append(elements)
-
-    results["records"] = detected_objects # 検出結果のリスト
-    msg = "検出できません"
-    if len(detected_objects) > 0:
-        msg = "送信終了"
-    results["message"] = msg
+def yolo_detect_batch(images: list, model_file, cascade: bool = False) -> list:
+    """複数の画像（OpenCV形式の配列）をまとめて物体検出する
 
-    return results
+    NOTE: ImageAIは1枚ずつしか推論できないため、読み込み済みのモデルでロックを1回だけ取得して連続して推論する
+
+    Args:
+        images (list): 画像（高さ×幅×3, BGR）のリスト
+        model_file (_type_): YOLOモデルファイル
+        cascade (bool): Trueの場合、軽量モデルで検出し、精度の低い画像だけをmodel_fileで検出し直す
+
+    Returns:
+        list: 画像ごとの(検出結果（JSON形式）, 検出結果を描画した画像)のリスト
+    """
+    if cascade and yolo_fast_model_file:
+        return [_detect_cascade(image, model_file) for image in images]
+
+    detector = get_detector(model_file)
+    outputs = []
+    with detector_lock, engine_threads("yolo"):
+        for image in images:
+            annotated, detections = detector.detectObjectsFromImage(input_image=image, output_type="array")
+            outputs.append((_to_results(detections).to_dict(), annotated))
+    return outputs
+
+
+# ==================================================================================================
+# カスケード検出
+# ==================================================================================================
+
+
+def escalation_reason(results: DetectionResult) -> str | None:
+    """軽量モデルの検出結果を大きいモデルで検出し直す理由を判定する
+
+    Args:
+        results (DetectionResult): 軽量モデルの検出結果
+
+    Returns:
+        str | None: no_objects, too_many_objects, low_confidence のいずれか。検出し直す必要がなければNone
+    """
+    if len(results.records) == 0:
+        return "no_objects" if cascade_escalate_empty else None
+    if len(results.records) > cascade_max_objects:
+        return "too_many_objects"
+    top = sorted((record.probability for record in results.records), reverse=True)[:cascade_top_k]
+    if sum(top) / len(top) < cascade_min_confidence:
+        return "low_confidence"
+    return None
+
+
+def _detect_cascade(image, model_file):
+    """軽量モデルで検出し、必要な場合だけ大きいモデルで検出し直す
+
+    Returns:
+        tuple: (検出結果（JSON形式）, 検出結果を描画した画像)
+    """
+    increment("detect.cascade.images")
+    start = time.perf_counter()
+    fast_detector = get_detector(yolo_fast_model_file, yolo_fast_model_type)
+    with detector_lock, engine_threads("yolo"):
+        annotated, detections = fast_detector.detectObjectsFromImage(input_image=image, output_type="array")
+    results = _to_results(detections)
+    observe("detect.cascade.fast_seconds", time.perf_counter() - start)
+
+    reason = escalation_reason(results)
+    if reason is None:
+        increment("detect.cascade.accepted")
+        return results.to_dict(), annotated
+
+    increment("detect.cascade.escalated")
+    increment("detect.cascade.escalated." + reason)
+    start = time.perf_counter()
+    detector = get_detector(model_file)
+    with detector_lock, engine_threads("yolo"):
+        annotated, detections = detector.detectObjectsFromImage(input_image=image, output_type="array")
+    observe("detect.cascade.full_seconds", time.perf_counter() - start)
+    return _to_results(detections).to_dict(), annotated
+
+
+def yolo_detect_image(image, model_file, cascade: bool = False) -> tuple:
+    """前処理済みの画像（OpenCV形式の配列）を物体検出する
+
+    Args:
+        image (np.ndarray): 画像（高さ×幅×3, BGR）
+        model_file (_type_): YOLOモデルファイル
+        cascade (bool): Trueの場合、軽量モデルで検出し、精度が低い場合だけmodel_fileで検出し直す
+
+    Returns:
+        tuple: (検出結果（JSON形式）, 検出結果を描画した画像)
+    """
+    return yolo_detect_batch([image], model_file, cascade)[0]
+
+
+def yolo_detect_pdf(pdf_path, model_file, dpi: int, workers: int, batch_size: int, on_page, cascade: bool = False):
+    """PDFの各ページを画像に変換して物体検出する
+
+    NOTE: ページの画像化はプロセスプールで並列に行う。メモリ使用量を抑えるため、同時に保持するページは
+          (ワーカー数 × 2 + バッチサイズ)までとし、検出を終えたページから順にon_pageへ渡して破棄する
+
+    Args:
+        pdf_path (_type_): PDFファイルのパス
+        model_file (_type_): YOLOモデルファイル
+        dpi (int): ページを画像にする解像度
+        workers (int): 画像化を並列に行うプロセス数
+        batch_size (int): まとめて検出するページ数
+        on_page (_type_): ページごとに呼び出す関数 on_page(ページ番号(0始まり), 検出結果, 検出結果を描画した画像)
+        cascade (bool): Trueの場合、軽量モデルで検出し、精度の低いページだけをmodel_fileで検出し直す
+
+    Returns:
+        int: 処理したページ数
+    """
+    total = page_count(pdf_path)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending = deque()
+        next_page = 0
+        batch = []
+        while next_page < total or pending or batch:
+            # 先読みするページ数を制限しながら画像化を依頼する
+            while next_page < total and len(pending) < workers * 2:
+                pending.append((next_page, pool.submit(render_page_bgr, pdf_path, next_page, dpi)))
+                next_page += 1
+
+            if pending:
+                page_index, future = pending.popleft()
+                batch.append((page_index, future.result()))
+
+            if batch and (len(batch) >= batch_size or (not pending and next_page >= total)):
+                indexes = [page_index for page_index, _ in batch]
+                outputs = yolo_detect_batch([image for _, image in batch], model_file, cascade)
+                batch = []
+                for page_index, (detected, annotated) in zip(indexes, outputs, strict=True):
+                    on_page(page_index, detected, annotated)
+
+    return total